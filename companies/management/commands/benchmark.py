@@ -0,0 +1,481 @@
+import os
+import re
+import random
+import resource
+import tempfile
+from time import time
+from hashlib import sha1
+from itertools import permutations, islice
+from io import StringIO
+from collections import OrderedDict, defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from Levenshtein import jaro
+
+from companies.models import (
+    Company,
+    Revision,
+    CompanyRecord,
+    Person,
+    CompanySnapshotFlags,
+    revision_registry,
+)
+from companies.tools.bulk import copy_insert
+from companies.tools.keys import make_company_key, make_company_keys
+from companies.tools.names import token_order_jaro
+from companies.tools.intervals import group_by_intervals
+from companies.management.commands.load_companies import EDR_Reader
+
+
+def generate_xml_dump(fp, size, broken_ratio=0.001):
+    """
+    Writes synthetic EDR dump (in the same format and encoding as
+    data.gov.ua exports) with `size` records into binary file object
+    """
+    rnd = random.Random(1337)
+
+    fp.write('<?xml version="1.0" encoding="windows-1251"?>\n<DATA>\n'.encode("cp1251"))
+    for i in range(size):
+        founders = "".join(
+            "<FOUNDER>Засновник {} {}, адреса засновника: Україна, м. Київ, вул. Хрещатик, {}</FOUNDER>".format(
+                i, j, rnd.randrange(100)
+            )
+            for j in range(rnd.randrange(4))
+        )
+
+        record = (
+            "<RECORD><NAME>ТОВАРИСТВО З ОБМЕЖЕНОЮ ВІДПОВІДАЛЬНІСТЮ &quot;КОМПАНІЯ {0}&quot;</NAME>"
+            "<SHORT_NAME>ТОВ &quot;КОМПАНІЯ {0}&quot;</SHORT_NAME><EDRPOU>{1:08d}</EDRPOU>"
+            "<ADDRESS>01001, м.Київ, вулиця Хрещатик, будинок {2}</ADDRESS>"
+            "<BOSS>Іваненко Іван Іванович</BOSS><KVED>46.90 Неспеціалізована оптова торгівля</KVED>"
+            "<STAN>зареєстровано</STAN><FOUNDERS>{3}</FOUNDERS></RECORD>\n"
+        ).format(i, i + 1, rnd.randrange(1000), founders)
+
+        if rnd.random() < broken_ratio:
+            record = record[: rnd.randrange(len(record))]
+
+        fp.write(record.encode("cp1251"))
+
+    fp.write("</DATA>\n".encode("cp1251"))
+
+
+def generate_revision_objects(size, revision_id):
+    """
+    Builds synthetic companies, company records and persons the same way
+    load_file does. Negative edrpou codes are used to never clash with the
+    real data
+    """
+    companies, records, persons = [], [], []
+
+    for i in range(1, size + 1):
+        edrpou = -i
+        companies.append(Company(edrpou=edrpou))
+        records.append(
+            CompanyRecord(
+                company_hash=sha1("record {}".format(i).encode()).hexdigest(),
+                company_id=edrpou,
+                name='ТОВАРИСТВО З ОБМЕЖЕНОЮ ВІДПОВІДАЛЬНІСТЮ "КОМПАНІЯ {}"'.format(i),
+                short_name='ТОВ "КОМПАНІЯ {}"'.format(i),
+                location="01001, м.Київ, вулиця Хрещатик, будинок {}".format(i % 1000),
+                company_profile="46.90 Неспеціалізована оптова торгівля",
+                status=1,
+                revisions=[revision_id],
+            )
+        )
+
+        for j in range(3):
+            persons.append(
+                Person(
+                    company_id=edrpou,
+                    person_type="founder",
+                    person_hash=sha1("person {} {}".format(i, j).encode()).hexdigest(),
+                    raw_record="Засновник {} {}, Україна, м. Київ".format(i, j),
+                    name=["Засновник {} {}".format(i, j)],
+                    address=["Україна, м. Київ, вул. Хрещатик, {}".format(j)],
+                    country=["україна"],
+                    revisions=[revision_id],
+                )
+            )
+
+    return companies, records, persons
+
+
+def legacy_make_company_key(company):
+    # Implementation of make_key_for_company before it was moved to
+    # companies.tools.keys, keys must stay identical to it
+    return sha1(
+        re.sub(
+            "[.,\/#!$%\^&\*;:{}=\-_`~()\s]",
+            "",
+            "|".join(
+                map(
+                    lambda x: (str(x) or "").strip(),
+                    [
+                        company["name"],
+                        company["short_name"],
+                        company["location"],
+                        company["edrpou"],
+                        company.get("company_profile"),
+                        company.get("status"),
+                    ]
+                )
+            ).lower()
+        )
+        .encode("utf8")
+    ).hexdigest()
+
+
+def legacy_compare_two_names(name1, name2):
+    # Permutation-based token order insensitive part of
+    # Company.compare_two_names before it was replaced by token_order_jaro
+    splits = name2.split(" ")
+    return max(jaro(name1, " ".join(opt)) for opt in islice(permutations(splits), 5040))
+
+
+def generate_name_pairs(size):
+    """
+    Pairs of synthetic persons/companies names: shuffled tokens, typos and
+    completely different names
+    """
+    rnd = random.Random(1337)
+    tokens = [
+        "іваненко", "петренко", "коваленко", "шевченко", "бондаренко", "олександр",
+        "микола", "марія", "олена", "іванович", "петрівна", "товариство", "обмеженою",
+        "відповідальністю", "компанія", "холдинг", "лімітед", "кіпр", "нікосія", "україна",
+    ]
+
+    pairs = []
+    for _ in range(size):
+        name = [rnd.choice(tokens) for _ in range(rnd.randrange(2, 8))]
+        other = list(name)
+        rnd.shuffle(other)
+
+        if rnd.random() < 0.3:
+            pos = rnd.randrange(len(other))
+            other[pos] = other[pos][:-1]
+        if rnd.random() < 0.3:
+            other = [rnd.choice(tokens) for _ in range(rnd.randrange(2, 8))]
+
+        pairs.append((" ".join(name), " ".join(other)))
+
+    return pairs
+
+
+def generate_histories(size, num_revisions=1000):
+    """
+    Synthetic timeline and persons of companies with long histories: every
+    person is present in a few long runs of revisions
+    """
+    rnd = random.Random(1337)
+    timeline = OrderedDict(
+        (i, Revision(revision_id=i, created=timezone.now())) for i in range(1, num_revisions + 1)
+    )
+
+    histories = []
+    for i in range(size):
+        persons = []
+        for j in range(rnd.randrange(1, 10)):
+            revisions = []
+            for _ in range(rnd.randrange(1, 4)):
+                first = rnd.randrange(1, num_revisions + 1)
+                revisions.extend(range(first, rnd.randrange(first, num_revisions + 1) + 1))
+
+            persons.append(
+                Person(
+                    person_hash=sha1("person {} {}".format(i, j).encode()).hexdigest(),
+                    revisions=sorted(set(revisions)),
+                )
+            )
+
+        histories.append(persons)
+
+    return timeline, histories
+
+
+class Command(BaseCommand):
+    help = "Runs benchmarks of import/processing stages on synthetic data"
+
+    BENCHMARKS = ["xml_reader", "bulk_insert", "keys", "revisions_layout", "flags", "names", "group_revisions"]
+
+    def add_arguments(self, parser):
+        parser.add_argument("benchmark", choices=self.BENCHMARKS)
+
+        parser.add_argument(
+            "--size", type=int, default=100000, help="Number of synthetic records"
+        )
+
+    def report(self, name, count, elapsed, extra=""):
+        self.stdout.write(
+            "{}: {} records in {:.2f}s, {:.0f} records/s{}".format(
+                name, count, elapsed, count / elapsed if elapsed else 0, extra
+            )
+        )
+
+    def bench_xml_reader(self, options):
+        with tempfile.NamedTemporaryFile(suffix=".xml") as fp:
+            generate_xml_dump(fp, options["size"])
+            fp.flush()
+            dump_size = os.path.getsize(fp.name)
+
+            with open(fp.name, "rb") as in_file:
+                reader = EDR_Reader(in_file, timezone.now(), None, "xml")
+
+                started = time()
+                count = sum(1 for _ in reader.iter_docs())
+                elapsed = time() - started
+
+        self.report(
+            "xml_reader",
+            count,
+            elapsed,
+            ", {:.1f}MB/s, peak RSS {:.1f}MB".format(
+                dump_size / elapsed / 2 ** 20 if elapsed else 0,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            ),
+        )
+
+    def bench_bulk_insert(self, options):
+        def write_bulk_create(model, objs):
+            model.objects.bulk_create(objs, batch_size=100)
+
+        for name, writer in [("bulk_create", write_bulk_create), ("copy_insert", copy_insert)]:
+            companies, records, persons = generate_revision_objects(options["size"], 0)
+
+            # Everything is rolled back once measured
+            with transaction.atomic():
+                started = time()
+                for model, objs in [(Company, companies), (CompanyRecord, records), (Person, persons)]:
+                    for i in range(0, len(objs), 10000):
+                        writer(model, objs[i:i + 10000])
+                elapsed = time() - started
+
+                transaction.set_rollback(True)
+
+            self.report(name, len(companies) + len(records) + len(persons), elapsed)
+
+    def bench_keys(self, options):
+        with tempfile.TemporaryFile() as fp:
+            generate_xml_dump(fp, options["size"], broken_ratio=0)
+            fp.seek(0)
+            companies = list(EDR_Reader(fp, timezone.now(), None, "xml").iter_docs())
+
+        results = {}
+        for name, hasher in [
+            ("legacy", lambda: list(map(legacy_make_company_key, companies))),
+            ("make_company_key", lambda: list(map(make_company_key, companies))),
+            ("make_company_keys", lambda: make_company_keys(companies)),
+        ]:
+            started = time()
+            results[name] = hasher()
+            elapsed = time() - started
+
+            self.report(
+                name,
+                len(companies),
+                elapsed,
+                ", {:.2f}us per record".format(elapsed / len(companies) * 1e6 if companies else 0),
+            )
+
+        for name, keys in results.items():
+            if keys != results["legacy"]:
+                self.stderr.write("{} produced keys different from the legacy ones".format(name))
+
+    def bench_revisions_layout(self, options):
+        """
+        Compares revisions arrays with GIN index (what we have now) with
+        the table of (hash, first_rev, last_rev) intervals on the typical
+        queries: rows present in the revision and appending next revision
+        """
+        rnd = random.Random(1337)
+        num_revisions = 50
+
+        arrays, intervals = StringIO(), StringIO()
+        for i in range(options["size"]):
+            row_hash = sha1(str(i).encode()).hexdigest()
+
+            # Most of the records live for a while and then disappear,
+            # some of them come back later
+            first_rev = rnd.randrange(1, num_revisions + 1)
+            last_rev = rnd.randrange(first_rev, num_revisions + 1)
+            ranges = [(first_rev, last_rev)]
+            if last_rev < num_revisions - 1 and rnd.random() < 0.1:
+                ranges.append((rnd.randrange(last_rev + 2, num_revisions + 1), num_revisions))
+
+            revs = [r for first, last in ranges for r in range(first, last + 1)]
+            arrays.write("{}\t{{{}}}\n".format(row_hash, ",".join(map(str, revs))))
+            for first, last in ranges:
+                intervals.write("{}\t{}\t{}\n".format(row_hash, first, last))
+
+        def timed(cursor, sql, params=None):
+            started = time()
+            cursor.execute(sql, params)
+            return time() - started, cursor.fetchone()[0] if cursor.description else cursor.rowcount
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("CREATE TEMPORARY TABLE bench_arrays (row_hash text PRIMARY KEY, revisions integer[])")
+            cursor.execute(
+                "CREATE TEMPORARY TABLE bench_intervals (row_hash text, first_rev integer, last_rev integer)"
+            )
+
+            arrays.seek(0)
+            cursor.copy_from(arrays, "bench_arrays")
+            intervals.seek(0)
+            cursor.copy_from(intervals, "bench_intervals")
+
+            cursor.execute("CREATE INDEX ON bench_arrays USING gin (revisions)")
+            cursor.execute("CREATE INDEX ON bench_intervals (row_hash)")
+            cursor.execute("CREATE INDEX ON bench_intervals (last_rev, first_rev)")
+            cursor.execute("ANALYZE bench_arrays")
+            cursor.execute("ANALYZE bench_intervals")
+
+            for table in ["bench_arrays", "bench_intervals"]:
+                cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+                self.stdout.write("{}: {:.1f}MB".format(table, cursor.fetchone()[0] / 2 ** 20))
+
+            for rev in [1, num_revisions // 2, num_revisions]:
+                elapsed, count = timed(
+                    cursor, "SELECT count(*) FROM bench_arrays WHERE revisions @> ARRAY[%s]", [rev]
+                )
+                self.report("arrays, present in {}".format(rev), count, elapsed)
+
+                elapsed, count = timed(
+                    cursor,
+                    "SELECT count(*) FROM bench_intervals WHERE first_rev <= %s AND last_rev >= %s",
+                    [rev, rev],
+                )
+                self.report("intervals, present in {}".format(rev), count, elapsed)
+
+            # Next revision continues all the records of the latest one
+            elapsed, count = timed(
+                cursor,
+                "UPDATE bench_arrays SET revisions = array_append(revisions, %s) "
+                "WHERE revisions @> ARRAY[%s]",
+                [num_revisions + 1, num_revisions],
+            )
+            self.report("arrays, append revision", count, elapsed)
+
+            elapsed, count = timed(
+                cursor,
+                "UPDATE bench_intervals SET last_rev = %s WHERE last_rev = %s",
+                [num_revisions + 1, num_revisions],
+            )
+            self.report("intervals, append revision", count, elapsed)
+
+            transaction.set_rollback(True)
+
+    def bench_flags(self, options):
+        """
+        Calculates flags for the first companies in db company by company
+        and in bulk (everything is rolled back). Results of both are compared
+        by the tests
+        """
+        revision = revision_registry.latest()
+        mass_registration = CompanyRecord.objects.mass_registration_addresses(revision.pk)
+        company_ids = list(
+            Company.objects.order_by("pk").values_list("pk", flat=True)[: options["size"]]
+        )
+
+        with transaction.atomic():
+            CompanySnapshotFlags.objects.filter(
+                company_id__in=company_ids, revision=revision
+            ).delete()
+
+            started = time()
+            for company in Company.objects.filter(pk__in=company_ids).nocache():
+                company.take_snapshot_of_flags(revision, False, mass_registration)
+            self.report("per company", len(company_ids), time() - started)
+
+            CompanySnapshotFlags.objects.filter(
+                company_id__in=company_ids, revision=revision
+            ).delete()
+
+            started = time()
+            for i in range(0, len(company_ids), 500):
+                Company.take_snapshots_of_flags(
+                    company_ids[i:i + 500], revision, False, mass_registration
+                )
+            self.report("bulk", len(company_ids), time() - started)
+
+            transaction.set_rollback(True)
+
+    def bench_names(self, options):
+        """
+        Compares token order insensitive similarity over all the permutations
+        of tokens with token_order_jaro, and the lists of names
+        """
+        pairs = generate_name_pairs(options["size"])
+
+        results = {}
+        for name, scorer in [
+            ("legacy", legacy_compare_two_names),
+            ("token_order_jaro", token_order_jaro),
+        ]:
+            started = time()
+            results[name] = [scorer(a, b) for a, b in pairs]
+            self.report(name, len(pairs), time() - started)
+
+        flips = sum(
+            (legacy > 0.93) != (new > 0.93)
+            for legacy, new in zip(results["legacy"], results["token_order_jaro"])
+        )
+        self.stdout.write("{} of {} decisions differ at 0.93".format(flips, len(pairs)))
+
+        list_a = [a for a, _ in pairs[:500]]
+        list_b = [b for _, b in pairs[:500]]
+        started = time()
+        found = Company.compare_two_list_of_names(list_a, list_b)
+        self.report(
+            "compare_two_list_of_names",
+            len(list_a) * len(list_b),
+            time() - started,
+            ", {} similar pairs".format(len(found)),
+        )
+
+    def bench_group_revisions(self, options):
+        """
+        Groups synthetic histories of persons with group_revisions (hashes
+        persons of every revision) and group_by_intervals (merges intervals
+        of revisions of every person) and compares the groups
+        """
+        timeline, histories = generate_histories(options["size"])
+        company = Company()
+
+        def persons_revisions(persons):
+            by_revision = defaultdict(set)
+            for p in persons:
+                for r in p.revisions:
+                    by_revision[r].add(p)
+            return by_revision
+
+        prepared = [(persons, persons_revisions(persons)) for persons in histories]
+
+        started = time()
+        legacy = [
+            company.group_revisions(
+                timeline,
+                by_revision,
+                hash_field_getter=lambda records: tuple(sorted(r.person_hash for r in records)),
+            )
+            for persons, by_revision in prepared
+        ]
+        self.report("group_revisions", len(prepared), time() - started)
+
+        started = time()
+        intervals = [
+            group_by_intervals(timeline, by_revision, (p.revisions for p in persons))
+            for persons, by_revision in prepared
+        ]
+        self.report("group_by_intervals", len(prepared), time() - started)
+
+        mismatches = sum(
+            [(g["start_revision"].pk, g["finish_revision"].pk, g["record"]) for g in a]
+            != [(g["start_revision"].pk, g["finish_revision"].pk, g["record"]) for g in b]
+            for a, b in zip(legacy, intervals)
+        )
+        if mismatches:
+            self.stderr.write("Groups differ for {} companies".format(mismatches))
+
+    def handle(self, *args, **options):
+        getattr(self, "bench_{}".format(options["benchmark"]))(options)
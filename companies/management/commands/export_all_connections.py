@@ -3,11 +3,17 @@ import sys
 import json
 import argparse
 
-from tools.names import compare_two_names, full_compare
+from tools.names import (
+    compare_two_names,
+    full_compare,
+    load_name_caches,
+    save_name_caches,
+    name_cache_stats,
+)
 
 from django.core.management.base import BaseCommand
 from tqdm import tqdm
-from companies.models import Company, Revision
+from companies.models import Company, revision_registry
 
 
 class SetEncoder(json.JSONEncoder):
@@ -30,8 +36,26 @@ class Command(BaseCommand):
 
         parser.add_argument("--limit", type=int)
 
+        parser.add_argument(
+            "--names_cache",
+            default=None,
+            help="File to load the cache of names comparisons from and to save it to after the run",
+        )
+
     def handle(self, *args, **options):
-        latest_rev = Revision.objects.order_by("-created").first()
+        if options["names_cache"]:
+            load_name_caches(options["names_cache"])
+
+        self.export(options)
+
+        if options["names_cache"]:
+            save_name_caches(options["names_cache"])
+
+        for line in name_cache_stats():
+            self.stderr.write(line)
+
+    def export(self, options):
+        latest_rev = revision_registry.latest()
         qs = Company.objects.all()  # .filter(edrpou__in=["41112805", "39032637"])
         for i, company in tqdm(enumerate(qs.nocache().iterator()), total=qs.count()):
             company_rec = {
@@ -6,7 +6,7 @@ from csv import DictReader
 from tqdm import tqdm
 from dateutil.parser import parse as dt_parse
 
-from companies.models import CompanySnapshotFlags, CompanyRecord
+from companies.models import Company, CompanySnapshotFlags, CompanyRecord, CompanyHistory
 
 
 class Command(BaseCommand):
@@ -20,6 +20,7 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         reader = DictReader(options["in_file"])
+        touched_companies = set()
 
 
         for l in tqdm(reader):
@@ -48,3 +49,13 @@ class Command(BaseCommand):
                 email=l["email"],
                 fax=l["fax"],
             )
+            touched_companies.add(edrpou)
+
+        # Details of records are packed into the cached history, so it's
+        # dropped (CompanyDetail falls back to the live one) until the next
+        # reindex rebuilds it
+        touched_companies = list(touched_companies)
+        for i in range(0, len(touched_companies), 1000):
+            CompanyHistory.objects.filter(company_id__in=touched_companies[i:i + 1000]).delete()
+
+        Company.mark_dirty(touched_companies)
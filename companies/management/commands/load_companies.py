@@ -1,6 +1,6 @@
-import re
 import sys
 import json
+import resource
 import yaml
 import gzip
 import redis
@@ -9,16 +9,21 @@ import os.path
 import logging
 import xml.etree.ElementTree as ET
 from itertools import islice
+from collections import deque
+from functools import partial
+from contextlib import ExitStack
 from time import sleep
 from hashlib import sha1
-from csv import DictReader
+from csv import reader as csv_reader
+from operator import itemgetter
 from zipfile import ZipFile, BadZipFile
 from io import TextIOWrapper
 from random import randrange
+from threading import BoundedSemaphore, Event
+from multiprocessing import Pool
 
 from django.conf import settings
-from django.db import connection
-from django.utils import timezone
+from django.db import connection, transaction
 from django.core.management.base import BaseCommand
 
 from tqdm import tqdm
@@ -27,7 +32,12 @@ import requests
 import requests_cache
 
 
-from companies.models import Revision, Company, CompanyRecord, Person
+from companies.models import Revision, Company, CompanyRecord, Person, MassRegistrationAddress
+from companies.tools.bulk import RevisionStamp, copy_insert
+from companies.tools.hashset import CompactHashSet
+from companies.tools.prefetch import prefetching
+from companies.tools.manifest import RevisionManifest
+from companies.tools.keys import make_company_key, make_person_key, make_person_keys
 sys.path.append(settings.PATH_TO_SECRET_SAUCE)
 from evaluate import Pipeline
 
@@ -66,6 +76,196 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("reader")
 
 
+class FounderCache(object):
+    """
+    Redis cache of parsed founders records, keyed by sha1 of the record.
+    Lookups and writes are done in batches to save on round-trips
+    """
+
+    def __init__(self, redis_conn, cache_key):
+        self.redis = redis_conn
+        self.cache_key = cache_key
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(founder_rec):
+        return sha1(founder_rec.lower().encode("utf8")).hexdigest()
+
+    def get_many(self, rec_hashes):
+        """
+        Retrieves cached results with one HMGET
+
+        :param rec_hashes: list of keys to look up
+        :type rec_hashes: list
+        :return: parsed results for the keys found in cache
+        :rtype: dict
+        """
+        found = {}
+        if not rec_hashes:
+            return found
+
+        for rec_hash, cached in zip(rec_hashes, self.redis.hmget(self.cache_key, rec_hashes)):
+            if cached is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                found[rec_hash] = json.loads(gzip.decompress(cached).decode("utf8"))
+
+        return found
+
+    def set_many(self, results):
+        """
+        Stores parsed results in one pipelined batch of HSETs
+
+        :param results: parsed results by key
+        :type results: dict
+        """
+        if not results:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        for rec_hash, result in results.items():
+            pipe.hset(
+                self.cache_key,
+                rec_hash,
+                # Whoooo, we even have gzip compression
+                gzip.compress(json.dumps(result).encode("utf8"))
+            )
+        pipe.execute()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+
+class FounderParser(object):
+    """
+    Parses founders/BO records of the company with the pipeline and keeps
+    results in redis
+    """
+
+    FIELDS = [
+        "Is beneficial owner", "BO is absent", "Has reference",
+        "Was dereferenced", "Name", "Country of residence",
+        "Address of residence", "raw_record"
+    ]
+
+    def __init__(self, parser_profile):
+        """
+        Reads parser profile to parse BO and founders using ML power!
+
+        :param parser_profile: path to the pipeline configuration file
+        :type parser_profile: string
+        """
+        with open(parser_profile, "r") as fp:
+            profile = yaml.load(fp.read())
+
+            # Loading the pipeline
+            self.pipe = Pipeline(profile["pipeline"])
+
+        # Initializing redis to store extracted named entities in it
+        self.redis = redis.StrictRedis.from_url(settings.PARSING_REDIS)
+        self.redis_cache_key = "extractor_{}".format(self.pipe.config_key)
+        self.cache = FounderCache(self.redis, self.redis_cache_key)
+
+    def transform(self, company, founder_rec):
+        company_mock = company.copy()
+        company_mock["founders"] = [founder_rec]
+
+        result = []
+
+        # Call the magic sauce!
+        for r in self.pipe.transform_company(company_mock):
+            r["raw_record"] = founder_rec
+
+            result = [whitelist(r, self.FIELDS)]
+
+        return result
+
+    def parse_many(self, companies):
+        """
+        Parses founders of the batch of companies, resolving all of them
+        against the cache at once and running the pipeline only on misses
+
+        :param companies: company lines from the dump
+        :type companies: list
+        :return: list of parsed founders for each of the companies
+        :rtype: list
+        """
+
+        founders_recs = []
+        for company in companies:
+            company_founders = []
+            for founder_rec in company.get("founders", []) or []:
+                if founder_rec is None:
+                    logger.warning(f"Degenerated record {company}")
+                    continue
+
+                company_founders.append((founder_rec, self.cache.make_key(founder_rec)))
+            founders_recs.append(company_founders)
+
+        results = self.cache.get_many(
+            list(set(rec_hash for company_founders in founders_recs for _, rec_hash in company_founders))
+        )
+
+        parsed = {}
+        for company, company_founders in zip(companies, founders_recs):
+            for founder_rec, rec_hash in company_founders:
+                if rec_hash not in results and rec_hash not in parsed:
+                    parsed[rec_hash] = self.transform(company, founder_rec)
+
+        self.cache.set_many(parsed)
+        results.update(parsed)
+
+        return [
+            [subp for _, rec_hash in company_founders for subp in results[rec_hash]]
+            for company_founders in founders_recs
+        ]
+
+    def parse(self, company):
+        return self.parse_many([company])[0]
+
+
+# Parser instance of the worker process, see init_founder_parser
+worker_founder_parser = None
+
+
+def init_founder_parser(parser_profile):
+    """
+    Initializer for the pool of worker processes: every worker loads
+    the pipeline only once
+    """
+    global worker_founder_parser
+    worker_founder_parser = FounderParser(parser_profile)
+
+
+def parse_founders_chunk(chunk, parser=None):
+    """
+    Parses founders for the chunk of company lines (in the worker process
+    unless parser is given)
+
+    :param chunk: pairs of position in the file and company line
+    :type chunk: list
+    :returns: list of triples of position, company line and parsed founders
+        and number of cache hits and misses for the chunk
+    :rtype: tuple
+    """
+    parser = parser or worker_founder_parser
+    hits, misses = parser.cache.hits, parser.cache.misses
+
+    founders = parser.parse_many([company_line for _, company_line in chunk])
+
+    return (
+        [
+            (position, company_line, company_founders)
+            for (position, company_line), company_founders in zip(chunk, founders)
+        ],
+        (parser.cache.hits - hits, parser.cache.misses - misses),
+    )
+
+
 class EDR_Reader(object):
     """
     Simple reader class which allows to iterate over Zipped/not Zipped XML/CSV file
@@ -98,41 +298,124 @@ class EDR_Reader(object):
         :rtype: collections.Iterable[dict]
         """
 
+        for _, company in self.iter_docs_with_positions():
+            yield company
+
+    def iter_docs_with_positions(self, skip=0):
+        """
+        Reads input file record by record, keeping track of the position in
+        the file. Position is the number of raw records (including broken
+        ones) read so far, so the file can be re-read later starting
+        from the given position
+
+        :param skip: number of raw records to skip without parsing them
+        :type skip: int
+        :returns: iterator over pairs of position and company record
+        :rtype: collections.Iterable[tuple]
+        """
+
+        position = 0
+        for member_iter in self._iter_members():
+            for company in member_iter(max(skip - position, 0)):
+                position += 1
+                if company is not None:
+                    yield position, company
+
+    def _iter_members(self):
+        """
+        Iterates over the parts of the input file. Every part is a function
+        which accepts number of records to skip and returns iterator over
+        the company records, with None for broken or skipped ones
+        """
+
         if self.file_type == "zip":
             try:
-                with ZipFile(self.file) as zip_arch:
+                with ZipFile(self.file) as zip_arch, ExitStack() as members:
+                    parsers = []
+
+                    # All the members are opened at once and decompressed
+                    # concurrently in background threads, while records are
+                    # still read member by member in the archive order
                     for fname in zip_arch.namelist():
                         if "uo" in fname.lower():
-                            logger.info("Reading {} file from archive {}".format(fname, self.file))
-
                             if fname.lower().endswith(".xml"):
-                                with zip_arch.open(fname, 'r') as fp_raw:
-                                    for l in self._iter_xml(fp_raw):
-                                        yield l
-
-                            if fname.lower().endswith(".csv"):
-                                with zip_arch.open(fname, 'r') as fp_raw:
-                                    for l in self._iter_csv(fp_raw):
-                                        yield l
+                                parser = self._iter_xml
+                            elif fname.lower().endswith(".csv"):
+                                parser = self._iter_csv
+                            else:
+                                continue
+
+                            fp_raw = members.enter_context(zip_arch.open(fname, 'r'))
+                            parsers.append((
+                                fname,
+                                parser,
+                                members.enter_context(prefetching(fp_raw))
+                            ))
+
+                    for fname, parser, fp_raw in parsers:
+                        logger.info("Reading {} file from archive {}".format(fname, self.file))
+                        yield partial(parser, fp_raw)
             except BadZipFile as e:
                 logger.error("Zipfile {} is broken: {}".format(self.file, e))
-                return 
+                return
         elif self.file_type == "xml":
-            for l in self._iter_xml(self.file):
-                yield l
+            yield lambda skip: self._iter_xml(self.file, skip)
 
         elif self.file_type == "csv":
-            for l in self._iter_csv(self.file):
-                yield l
+            yield lambda skip: self._iter_csv(self.file, skip)
 
-    def _iter_xml(self, fp_raw):
+    def _iter_raw_xml_records(self, fp, chunk_size=1 << 20):
+        """
+        Incrementally splits decoded XML stream into raw record strings,
+        reading it in chunks of `chunk_size` characters, so only the current
+        chunk and the record being assembled are held in memory.
+        Boundaries are looked up exactly like non-greedy regex
+        <RECORD>.*?</RECORD> would do, so broken records are skipped in the
+        same way as before
+        """
+
+        buf = fp.read(max(chunk_size, 1000))
+        if "RECORD" in buf[:1000]:
+            open_tag, close_tag = "<RECORD>", "</RECORD>"
+        else:
+            open_tag, close_tag = "<ROW>", "</ROW>"
+
+        pos = 0
+        eof = not buf
+        while True:
+            start = buf.find(open_tag, pos)
+            if start != -1:
+                end = buf.find(close_tag, start + len(open_tag))
+                if end != -1:
+                    end += len(close_tag)
+                    yield buf[start:end]
+                    pos = end
+                    continue
+
+            if eof:
+                return
+
+            # Keeping the tail which might contain an incomplete record
+            # (or a tag split between two chunks)
+            if start != -1:
+                buf = buf[start:]
+            else:
+                buf = buf[max(pos, len(buf) - len(open_tag)):]
+
+            pos = 0
+            chunk = fp.read(chunk_size)
+            eof = not chunk
+            buf += chunk
+
+    def _iter_xml(self, fp_raw, skip=0):
         """
         Iterate over XML file (usually EDR dumps are exported in XML, which,
         howerver, might have different field names, that's covered by mapping
         below)
-        Regex magic is required to
+        File is read incrementally and every record is parsed separately to
         cover records that was incorrectly exported and incomplete, thus
-        make whole XML file invalid (happens sometime)
+        make whole XML file invalid (happens sometime). None is yielded for
+        such records and for the first `skip` records, which aren't parsed
         """
 
         with TextIOWrapper(fp_raw, encoding="cp1251") as fp:
@@ -156,23 +439,22 @@ class EDR_Reader(object):
                 "C0": ""
             }
 
-            content = fp.read()
-            if "RECORD" in content[:1000]:
-                regex = '<RECORD>.*?</RECORD>'
-            else:
-                regex = '<ROW>.*?</ROW>'
+            for i, chunk in enumerate(self._iter_raw_xml_records(fp)):
+                if i < skip:
+                    yield None
+                    continue
 
-            for i, chunk in enumerate(re.finditer(regex, content, flags=re.S | re.U)):
                 company = {}
                 founders_list = []
                 try:
                     # Fucking ET!
-                    etree = ET.fromstring(chunk.group(0).replace("Місцезнаходження", "ADDRESS").encode("utf-8"))
+                    etree = ET.fromstring(chunk.replace("Місцезнаходження", "ADDRESS"))
                 except ET.ParseError:
                     logger.error('Cannot parse record #{}, {}'.format(i, chunk))
+                    yield None
                     continue
 
-                for el in etree.getchildren():
+                for el in etree:
                     field = mapping.get(el.tag)
                     if field == 'edrpou':
                         if el.text and el.text.lstrip('0'):
@@ -180,7 +462,7 @@ class EDR_Reader(object):
                         else:
                             company[field] = 0
                     elif field == 'founders':
-                        for founder in el.getchildren():
+                        for founder in el:
                             founders_list.append(founder.text)
                     elif field:
                         company[field] = el.text
@@ -194,12 +476,17 @@ class EDR_Reader(object):
 
                 yield company
 
-    def _iter_csv(self, fp_raw):
+    def _iter_csv(self, fp_raw, skip=0):
         """
-        Iterate over CSV file (some old dumps were exported in CSV)
+        Iterate over CSV file (some old dumps were exported in CSV).
+        None is yielded for the first `skip` records
         """
         with TextIOWrapper(fp_raw, encoding="cp1251") as fp:
-            r = DictReader(fp, delimiter=str(";"))
+            r = csv_reader(fp, delimiter=str(";"))
+            header = next(r, None)
+
+            if header is None:
+                return
 
             mapping = {
                 "Найменування": 'name',
@@ -211,15 +498,36 @@ class EDR_Reader(object):
                 "Стан": 'status',
             }
 
-            for i, chunk in enumerate(r):
-                company = {}
+            # Header is resolved to the fields once, rows are then read
+            # by position (columns with blank headers are ignored)
+            columns = [(j, mapping[k]) for j, k in enumerate(header) if k.strip()]
+            fields = [field for _, field in columns]
+            positions = [j for j, _ in columns]
+            get_values = itemgetter(*positions) if len(positions) > 1 else (
+                lambda row: tuple(row[j] for j in positions)
+            )
+            padding = [None] * len(header)
+            has_edrpou = "edrpou" in fields
 
-                for k, v in chunk.items():
-                    if k.strip():
-                        if mapping[k] == "edrpou" and v:
-                            company[mapping[k]] = int(v)
-                        else:
-                            company[mapping[k]] = v
+            i = -1
+            for row in r:
+                # Blank lines aren't records
+                if not row:
+                    continue
+
+                i += 1
+                if i < skip:
+                    yield None
+                    continue
+
+                # Missing trailing values are None, same as DictReader did
+                if len(row) < len(header):
+                    row += padding[len(row):]
+
+                company = dict(zip(fields, get_values(row)))
+
+                if has_edrpou and company["edrpou"]:
+                    company["edrpou"] = int(company["edrpou"])
 
                 company['founders'] = []
                 company["last_update"] = self.timestamp
@@ -235,6 +543,11 @@ class Command(BaseCommand):
     help = ('Loads XML with data from registry of companies of Ukraine into '
             'the database')
 
+    # Number of lines of the dump between two checkpoints of the import
+    checkpoint_every = 50000
+    # Number of new companies/records/persons to accumulate before writing
+    batch_size = 10000
+
     def add_arguments(self, parser):
         parser.add_argument(
             '--revision',
@@ -270,54 +583,99 @@ class Command(BaseCommand):
             help="Local file timestamp"
         )
 
+        parser.add_argument(
+            "--num_workers",
+            type=int,
+            default=settings.NUM_THREADS,
+            help="Number of processes to parse founders records"
+        )
+
+        parser.add_argument(
+            "--resume",
+            default=False,
+            action="store_true",
+            help="Continue interrupted import of the revision from the last checkpoint"
+        )
+
+        parser.add_argument(
+            "--delta",
+            default=False,
+            action="store_true",
+            help="Do not parse company lines which didn't change since the previous revision"
+        )
+
+    def init_loader(self, options):
+        self.resume = options["resume"]
+        self.delta = options["delta"]
+        self.parser_profile = options["parser_profile"]
+        self.num_workers = options["num_workers"]
+
+        # With more than one worker founders are parsed by the pool
+        # where each process loads it's own pipeline
+        self.founder_parser = None
+        if self.num_workers <= 1:
+            self.founder_parser = FounderParser(self.parser_profile)
+
+    def manifest_path(self, revision):
+        return os.path.join(
+            settings.DATA_STORAGE_PATH, "manifests", "{}.manifest".format(revision.pk)
+        )
+
+    def load_previous_manifest(self, revision):
+        """
+        Loads manifest of the revision which was imported right before the
+        given one (if there is one and it was built with the same parser
+        profile)
+        """
+        previous = (
+            Revision.objects.filter(imported=True, created__lt=revision.created)
+            .exclude(pk=revision.pk)
+            .order_by("-created")
+            .first()
+        )
+
+        if previous is None:
+            return None
+
+        manifest = RevisionManifest.load(self.manifest_path(previous))
+        if manifest is None:
+            logger.warning("There is no manifest for revision {}, all lines will be parsed".format(
+                previous.pk))
+            return None
+
+        if manifest.parser_profile != self.parser_profile:
+            logger.warning("Manifest of revision {} was built with other parser profile, ignoring it".format(
+                previous.pk))
+            return None
+
+        logger.info("Loaded manifest of revision {} with {} lines".format(previous.pk, len(manifest)))
+        return manifest
+
+    def save_manifest(self, revision, manifest):
+        path = self.manifest_path(revision)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        manifest.save(path)
+
     def make_key_for_company(self, company):
         """
         That's sha1 key for company record built out of
         company name/shortname, location, edrpou and other fields
         """
-        return sha1(
-            re.sub(
-                "[.,\/#!$%\^&\*;:{}=\-_`~()\s]",
-                "",
-                "|".join(
-                    map(
-                        lambda x: (str(x) or "").strip(),
-                        [
-                            company["name"],
-                            company["short_name"],
-                            company["location"],
-                            company["edrpou"],
-                            company.get("company_profile"),
-                            company.get("status"),
-                        ]
-                    )
-                ).lower()
-            )
-            .encode("utf8")
-        ).hexdigest()
+        return make_company_key(company)
 
     def make_key_for_person(self, edrpou, raw_description, position):
         """
         That's sha1 key for person record built out of
         company edrpou and some raw text and position
         """
-        return sha1(
-            re.sub(
-                "[.,\/#!$%\^&\*;:{}=\-_`~()\s]",
-                "",
-                "|".join(
-                    map(
-                        lambda x: (str(x) or "").strip(),
-                        [
-                            raw_description,
-                            edrpou,
-                            position
-                        ]
-                    )
-                ).lower()
-            )
-            .encode("utf8")
-        ).hexdigest()
+        return make_person_key(edrpou, raw_description, position)
+
+    def make_keys_for_persons(self, persons):
+        """
+        Same as make_key_for_person for the list of
+        (edrpou, raw_description, position) triples
+        """
+        return make_person_keys(persons)
 
     def handle_one_revision_from_old_data_gov(self, guid, dataset_info, overwrite=False, revision=None):
         """
@@ -426,24 +784,44 @@ class Command(BaseCommand):
         # Where company is an entity, and the company record is the state of that entity in a given period
         # of time
         companies_in_bd = set(Company.objects.values_list("pk", flat=True))
-        company_records_in_bd = set(CompanyRecord.objects.values_list("company_hash", flat=True))
+        # Hashes are kept in compact form, as there are tens of millions of them
+        company_records_in_bd = CompactHashSet(
+            CompanyRecord.objects.values_list("company_hash", flat=True).nocache().iterator()
+        )
 
         # list of company records where current revision is already set
-        company_records_with_no_revision = set(
-            CompanyRecord.objects.filter(revisions__contains=[revision.pk]).values_list("company_hash", flat=True)
+        company_records_with_no_revision = CompactHashSet(
+            CompanyRecord.objects.present_in(revision)
+            .values_list("company_hash", flat=True).nocache().iterator()
         )
 
         # Accumulator for the company records to set current revision in bulk
-        company_records_to_add_revision = []
+        company_records_to_add_revision = RevisionStamp(CompanyRecord, revision.pk)
 
         # List of persons that is already in db
-        persons_in_bd = set(Person.objects.values_list("person_hash", flat=True))
+        persons_in_bd = CompactHashSet(
+            Person.objects.values_list("person_hash", flat=True).nocache().iterator()
+        )
         # list of persons where current revision is already set
-        persons_with_no_revision = set(
-            Person.objects.filter(revisions__contains=[revision.pk]).values_list("person_hash", flat=True)
+        persons_with_no_revision = CompactHashSet(
+            Person.objects.present_in(revision)
+            .values_list("person_hash", flat=True).nocache().iterator()
+        )
+
+        hash_sets = [
+            company_records_in_bd, company_records_with_no_revision,
+            persons_in_bd, persons_with_no_revision
+        ]
+
+        logger.info(
+            "Preloaded {} company records and {} persons, hashes are taking {:.1f}MB".format(
+                len(company_records_in_bd),
+                len(persons_in_bd),
+                sum(h.nbytes for h in hash_sets) / 2 ** 20
+            )
         )
         # Accumulator for the persons to set current revision in bulk
-        persons_to_add_revision = []
+        persons_to_add_revision = RevisionStamp(Person, revision.pk)
 
         # Accumulator for the companies to create in bulk
         companies_to_create = []
@@ -455,20 +833,104 @@ class Command(BaseCommand):
 
         # Accumulator for the persons to create in bulk
         persons_to_create = []
-        with tqdm() as pbar:
-            for company_line in reader.iter_docs():
+
+        stats = {
+            "records_stamped": 0,
+            "persons_stamped": 0,
+            "last_checkpoint": 0,
+            "unchanged_lines": 0,
+        }
+
+        def flush(position):
+            # Everything collected since the last checkpoint is written in one
+            # transaction along with the checkpoint itself, so if the import
+            # dies it can be resumed exactly from that point
+            with transaction.atomic():
+                copy_insert(Company, companies_to_create)
+                copy_insert(CompanyRecord, company_records_to_create)
+                copy_insert(Person, persons_to_create)
+
+                stats["records_stamped"] += company_records_to_add_revision.apply()
+                stats["persons_stamped"] += persons_to_add_revision.apply()
+
+                Company.mark_dirty(dirty_companies, chunk_size=300)
+
+                revision.checkpoint = position
+                revision.save(update_fields=["checkpoint"])
+
+            companies_to_create.clear()
+            company_records_to_create.clear()
+            persons_to_create.clear()
+            dirty_companies.clear()
+            stats["last_checkpoint"] = position
+
+        skip = 0
+        if self.resume and revision.checkpoint:
+            skip = revision.checkpoint
+            logger.info("Resuming revision {} from record #{}".format(revision.pk, skip))
+
+        # In delta mode lines which are the same as in the previous revision
+        # aren't parsed, hashes built from them are taken from the manifest
+        # of the previous revision and only stamped with the current one
+        known = None
+        previous_manifest = None
+        manifest = None
+        if self.delta:
+            manifest = RevisionManifest(self.parser_profile)
+            previous_manifest = self.load_previous_manifest(revision)
+
+        if previous_manifest is not None:
+            def known(line_digest):
+                hashes = previous_manifest.get(line_digest)
+                if hashes is None:
+                    return False
+
+                # Just in case if something was removed from db since then
+                company_hash, person_hashes = hashes
+                return company_hash in company_records_in_bd and all(
+                    person_hash in persons_in_bd for person_hash in person_hashes
+                )
+        elif manifest is not None:
+            def known(line_digest):
+                return False
+
+        position = skip
+        with tqdm(initial=skip) as pbar:
+            for position, company_line, founders, line_digest in self.iter_parsed_lines(reader, skip, known):
                 pbar.update(1)
 
+                if position - stats["last_checkpoint"] >= self.checkpoint_every:
+                    flush(position - 1)
+
                 # Basic sanity checks
                 if company_line["edrpou"] == 0 or isinstance(company_line["edrpou"], str):
                     continue
 
+                if founders is None:
+                    company_record_hash, person_hashes = previous_manifest.get(line_digest)
+
+                    for person_hash in person_hashes:
+                        if person_hash not in persons_with_no_revision:
+                            persons_to_add_revision.add(person_hash)
+                            persons_with_no_revision.add(person_hash)
+
+                    if company_record_hash not in company_records_with_no_revision:
+                        company_records_to_add_revision.add(company_record_hash)
+                        company_records_with_no_revision.add(company_record_hash)
+
+                    manifest.add(line_digest, company_record_hash, person_hashes)
+                    stats["unchanged_lines"] += 1
+                    continue
+
+                person_hashes = []
+
                 if company_line.get("head", ""):
                     head_hash = self.make_key_for_person(
                         company_line["edrpou"],
                         company_line["head"],
                         "head"
                     )
+                    person_hashes.append(head_hash)
                     if head_hash not in persons_in_bd:
                         person = Person(
                             company_id=company_line["edrpou"],
@@ -483,21 +945,22 @@ class Command(BaseCommand):
                         persons_in_bd.add(head_hash)
                     else:
                         if head_hash not in persons_with_no_revision:
-                            persons_to_add_revision.append(head_hash)
+                            persons_to_add_revision.add(head_hash)
                             persons_with_no_revision.add(head_hash)
 
                 # Parsing founder records
-                if company_line.get("founders"):
-                    founders = self.parse_raw_rec(company_line)
+                if founders:
+                    founder_hashes = self.make_keys_for_persons(
+                        (company_line["edrpou"], f["raw_record"], "owner")
+                        for f in founders
+                    )
+
+                    person_hashes += founder_hashes
 
-                    for f in founders:
+                    for f, founder_hash in zip(founders, founder_hashes):
                         if f["Is beneficial owner"]:
                             # That's BO and we know a name
-                            bo_hash = self.make_key_for_person(
-                                company_line["edrpou"],
-                                f["raw_record"],
-                                "owner"
-                            )
+                            bo_hash = founder_hash
 
                             if bo_hash not in persons_in_bd:
                                 person = Person(
@@ -516,15 +979,9 @@ class Command(BaseCommand):
                                 persons_in_bd.add(bo_hash)
                             else:
                                 if bo_hash not in persons_with_no_revision:
-                                    persons_to_add_revision.append(bo_hash)
+                                    persons_to_add_revision.add(bo_hash)
                                     persons_with_no_revision.add(bo_hash)
                         else:
-                            founder_hash = self.make_key_for_person(
-                                company_line["edrpou"],
-                                f["raw_record"],
-                                "owner"
-                            )
-
                             if founder_hash not in persons_in_bd:
                                 person = Person(
                                     company_id=company_line["edrpou"],
@@ -540,7 +997,7 @@ class Command(BaseCommand):
                                 persons_in_bd.add(founder_hash)
                             else:
                                 if founder_hash not in persons_with_no_revision:
-                                    persons_to_add_revision.append(founder_hash)
+                                    persons_to_add_revision.add(founder_hash)
                                     persons_with_no_revision.add(founder_hash)
 
                 # If company is not in db yet, let's add it to the accum
@@ -570,151 +1027,156 @@ class Command(BaseCommand):
                     company_records_in_bd.add(company_record_hash)
                 else:
                     if company_record_hash not in company_records_with_no_revision:
-                        company_records_to_add_revision.append(company_record_hash)
+                        company_records_to_add_revision.add(company_record_hash)
                         company_records_with_no_revision.add(company_record_hash)
 
-                if len(companies_to_create) >= 1000 or len(persons_to_create) >= 1000:
-                    Company.objects.bulk_create(companies_to_create, batch_size=100)
-                    CompanyRecord.objects.bulk_create(company_records_to_create, batch_size=100)
-                    companies_to_create = []
-                    company_records_to_create = []
-
-                    if company_records_to_add_revision:
-                        with connection.cursor() as cursor:
-                            # Fuck, cannot believe I'm doing that
-                            for update_me in chunkify(company_records_to_add_revision, 100):
-                                hashes_str = ",".join("'{}'".format(s) for s in update_me)
-                                # Guess what? There are no support of adding something to PG arrays through django ORM
-                                cursor.execute(
-                                    "UPDATE " + CompanyRecord._meta.db_table + "  SET revisions = revisions || '{%s}' " +
-                                    "WHERE company_hash IN (" + hashes_str + ")",
-                                    [int(revision.pk)]
-                                )
-
-                        company_records_to_add_revision = []
-
-                if len(persons_to_create) >= 1000:
-                    Person.objects.bulk_create(persons_to_create, batch_size=100)
-                    persons_to_create = []
-
-                    if persons_to_add_revision:
-                        logger.info("Adding revisions to {} persons".format(len(persons_to_add_revision)))
-                        with connection.cursor() as cursor:
-                            for update_me in chunkify(persons_to_add_revision, 100):
-                                hashes_str = ",".join("'{}'".format(s) for s in update_me)
-                                cursor.execute(
-                                    "UPDATE " + Person._meta.db_table + "  SET revisions = revisions || '{%s}' " +
-                                    "WHERE person_hash IN (" + hashes_str + ")",
-                                    [int(revision.pk)]
-                                )
+                if manifest is not None:
+                    manifest.add(line_digest, company_record_hash, person_hashes)
 
-                        persons_to_add_revision = []
+                if (
+                    len(companies_to_create) >= self.batch_size
+                    or len(company_records_to_create) >= self.batch_size
+                    or len(persons_to_create) >= self.batch_size
+                ):
+                    flush(position)
 
-        if companies_to_create:
-            Company.objects.bulk_create(companies_to_create, batch_size=100)
+        flush(position)
 
-        if company_records_to_create:
-            CompanyRecord.objects.bulk_create(company_records_to_create, batch_size=100)
+        logger.info("Revision {} was added to {} company records and {} persons".format(
+            revision.pk, stats["records_stamped"], stats["persons_stamped"]))
 
-        if persons_to_create:
-            Person.objects.bulk_create(persons_to_create, batch_size=100)
+        logger.info("Founders cache: {} hits, {} misses".format(self.cache_hits, self.cache_misses))
 
-        if company_records_to_add_revision:
-            with connection.cursor() as cursor:
-                hashes_str = ",".join("'{}'".format(s) for s in company_records_to_add_revision)
-                cursor.execute(
-                    "UPDATE " + CompanyRecord._meta.db_table + "  SET revisions = revisions || '{%s}' " +
-                    "WHERE company_hash IN (" + hashes_str + ")",
-                    [int(revision.pk)]
-                )
+        # Hashes of the records stamped with the revision are added to the
+        # sets during the import, so that's where they are the largest
+        logger.info(
+            "Hashes are taking {:.1f}MB after the import, peak RSS is {:.1f}MB".format(
+                sum(h.nbytes for h in hash_sets) / 2 ** 20,
+                # ru_maxrss is in kilobytes on linux
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+            )
+        )
 
-        if persons_to_add_revision:
-            logger.info("Adding revisions to {} persons".format(len(persons_to_add_revision)))
-            with connection.cursor() as cursor:
-                for update_me in chunkify(persons_to_add_revision, 300):
-                    hashes_str = ",".join("'{}'".format(s) for s in update_me)
-                    cursor.execute(
-                        "UPDATE " + Person._meta.db_table + "  SET revisions = revisions || '{%s}' " +
-                        "WHERE person_hash IN (" + hashes_str + ")",
-                        [int(revision.pk)]
-                    )
+        if manifest is not None:
+            logger.info("{} company lines were the same as in the previous revision".format(
+                stats["unchanged_lines"]))
 
-        if dirty_companies:
-            for update_me in chunkify(dirty_companies, 300):
-                logger.debug(
-                    "Updating {} records in db as dirty".format(len(update_me))
-                )
-                Company.objects.filter(pk__in=update_me).update(
-                    is_dirty=True, last_modified=timezone.now()
-                )
+            # Manifest of partially imported revision is incomplete
+            if skip:
+                logger.warning("Revision {} was resumed, manifest won't be saved".format(revision.pk))
+            else:
+                self.save_manifest(revision, manifest)
 
         revision.imported = True
+        revision.checkpoint = 0
         revision.save()
 
+        logger.info("{} addresses of mass registration in revision {}".format(
+            MassRegistrationAddress.materialize(revision), revision.pk))
+
     def parse_raw_rec(self, company):
         """
         That's just a glue to make edr parser work with all the data + extra layer
         of caching
         """
+        return self.founder_parser.parse(company)
 
-        parsed = []
+    def iter_parsed_lines(self, reader, skip=0, known=None, chunk_size=100):
+        """
+        Reads company lines from the dump and parses founders for them in
+        chunks. When more than one worker is requested, founders are parsed by
+        the pool of processes (each one loads it's own pipeline), while the
+        lines are still yielded in the same order as in the dump
+
+        :param skip: number of raw records to skip at the beginning of the dump
+        :type skip: int
+        :param known: function which tells by the digest of the company line
+            (see RevisionManifest.line_digest) if the line was already
+            imported before. Founders of such lines aren't parsed at all.
+            If not set, digests aren't calculated
+        :type known: callable
+        :returns: iterator over position in the dump, company line, parsed
+            founders (None for the known lines) and digest of the line
+        :rtype: collections.Iterable[tuple]
+        """
 
-        for founder_rec in company.get("founders", []) or []:
-            if founder_rec is None:
-                logger.warning(f"Degenerated record {company}")
-                continue
+        self.cache_hits = 0
+        self.cache_misses = 0
 
-            rec_hash = sha1(founder_rec.lower().encode("utf8")).hexdigest()
+        def split_chunk(chunk):
+            if known is None:
+                return [None] * len(chunk), [False] * len(chunk), chunk
 
-            cached = self.redis.hget(self.redis_cache_key, rec_hash)
+            line_digests = [RevisionManifest.line_digest(company_line) for _, company_line in chunk]
+            is_known = [known(line_digest) for line_digest in line_digests]
 
-            company_mock = company.copy()
-            company_mock["founders"] = [founder_rec]
+            return line_digests, is_known, [
+                line for line, line_is_known in zip(chunk, is_known) if not line_is_known
+            ]
 
-            if cached is None:
-                result = []
-
-                # Call the magic sauce!
-                for r in self.pipe.transform_company(company_mock):
-                    r["raw_record"] = founder_rec
-
-                    result = [
-                        whitelist(
-                            r,
-                            [
-                                "Is beneficial owner", "BO is absent", "Has reference",
-                                "Was dereferenced", "Name", "Country of residence",
-                                "Address of residence", "raw_record"
-                            ]
-                        )
-                    ]
+        def merge_chunk(chunk, line_digests, is_known, parsed_chunk):
+            parsed_chunk = iter(parsed_chunk)
 
-                self.redis.hset(
-                    self.redis_cache_key,
-                    rec_hash,
-                    # Whoooo, we even have gzip compression
-                    gzip.compress(json.dumps(result).encode("utf8"))
-                )
+            for (position, company_line), line_digest, line_is_known in zip(chunk, line_digests, is_known):
+                if line_is_known:
+                    yield position, company_line, None, line_digest
+                else:
+                    yield next(parsed_chunk) + (line_digest,)
 
-                parsed.append(result)
-            else:
-                res = json.loads(gzip.decompress(cached).decode("utf8"))
-                parsed.append(res)
+        if self.num_workers <= 1:
+            for chunk in chunkify(reader.iter_docs_with_positions(skip), chunk_size):
+                line_digests, is_known, to_parse = split_chunk(chunk)
+                parsed_chunk, (hits, misses) = parse_founders_chunk(to_parse, self.founder_parser)
+                self.cache_hits += hits
+                self.cache_misses += misses
 
-        return [subp for p in parsed for subp in p]
+                for parsed_line in merge_chunk(chunk, line_digests, is_known, parsed_chunk):
+                    yield parsed_line
+            return
 
-    def handle(self, *args, **options):
-        # Reading parser profile to parse BO and founders using
-        # ML power!
-        with open(options["parser_profile"], "r") as fp:
-            profile = yaml.load(fp.read())
+        # Pool.imap reads tasks as fast as it can, so we limit the number of
+        # chunks in flight to keep memory bounded
+        in_flight = BoundedSemaphore(self.num_workers * 4)
+        # Chunks sent to the pool, results are coming in the same order
+        pending = deque()
+        # Set when the iteration is over (or abandoned by the consumer), so
+        # the task feeding thread of the pool doesn't wait for the free slot
+        # forever and the pool can be terminated
+        stopped = Event()
+
+        def throttled_chunks():
+            for chunk in chunkify(reader.iter_docs_with_positions(skip), chunk_size):
+                line_digests, is_known, to_parse = split_chunk(chunk)
+
+                while not in_flight.acquire(timeout=1):
+                    if stopped.is_set():
+                        return
+
+                if stopped.is_set():
+                    return
 
-            # Loading the pipeline
-            self.pipe = Pipeline(profile["pipeline"])
+                pending.append((chunk, line_digests, is_known))
+                yield to_parse
 
-        # Initializing redis to store extracted named entities in it
-        self.redis = redis.StrictRedis.from_url(settings.PARSING_REDIS)
-        self.redis_cache_key = "extractor_{}".format(self.pipe.config_key)
+        with Pool(
+            self.num_workers,
+            initializer=init_founder_parser,
+            initargs=(self.parser_profile,),
+        ) as pool:
+            try:
+                for parsed_chunk, (hits, misses) in pool.imap(parse_founders_chunk, throttled_chunks()):
+                    in_flight.release()
+                    self.cache_hits += hits
+                    self.cache_misses += misses
+
+                    chunk, line_digests, is_known = pending.popleft()
+                    for parsed_line in merge_chunk(chunk, line_digests, is_known, parsed_chunk):
+                        yield parsed_line
+            finally:
+                stopped.set()
+
+    def handle(self, *args, **options):
+        self.init_loader(options)
 
         if options["local_file"]:
             _, ext = os.path.splitext(options["local_file"])
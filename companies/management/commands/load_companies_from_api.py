@@ -1,24 +1,16 @@
-import re
-import sys
-import json
-import yaml
-import gzip
-import redis
 import shutil
 import os.path
 from time import sleep
-import logging
 from random import randrange
 from datetime import datetime
+from queue import Queue, Empty
+from threading import Thread, Event, BoundedSemaphore
 
 from django.conf import settings
-from django.db import connection
 
 from companies.management.commands.load_companies import (
     Command as LoadCommand,
     logger,
-    proxies,
-    Pipeline
 )
 from tqdm import tqdm
 from dateutil.parser import parse
@@ -30,6 +22,9 @@ class Command(LoadCommand):
         "Loads XML with data from registry of companies of Ukraine into " "the database"
     )
 
+    # Pause after every download, in seconds, not to hammer data.gov.ua
+    download_pause = 5
+
     def add_arguments(self, parser):
         parser.add_argument(
             "--revision",
@@ -55,11 +50,55 @@ class Command(LoadCommand):
             help="Pipeline configuration file",
         )
 
-    def handle_one_revision_from_new_data_gov(
-        self, guid, timestamp, data_url, revision, overwrite=False
-    ):
+        parser.add_argument(
+            "--num_workers",
+            type=int,
+            default=settings.NUM_THREADS,
+            help="Number of processes to parse founders records",
+        )
+
+        parser.add_argument(
+            "--resume",
+            default=False,
+            action="store_true",
+            help="Continue interrupted import of the revision from the last checkpoint",
+        )
+
+        parser.add_argument(
+            "--delta",
+            default=False,
+            action="store_true",
+            help="Do not parse company lines which didn't change since the previous revision",
+        )
+
+        parser.add_argument(
+            "--prefetch",
+            type=int,
+            default=0,
+            help="Number of dumps to keep on disk at once (including the one being imported), "
+            "following revisions are downloaded in background while importing the current one "
+            "(0 to process revisions strictly one by one)",
+        )
+
+        parser.add_argument(
+            "--cleanup",
+            default=False,
+            action="store_true",
+            help="Remove dumps downloaded by the backfill once they are imported",
+        )
+
+    def download_revision(self, timestamp, data_url, revision, stop=None):
         """
-        Process one revision: retrieved from data.gov.ua, parse, unify, load to DB
+        Retrieves dump of one revision from data.gov.ua (unless it's already
+        stored locally)
+
+        :param stop: event which interrupts the download, partially
+            downloaded file is removed then
+        :type stop: threading.Event
+        :returns: path to the local file, extension of the file and flag
+            if the file was downloaded right now (or None if the download
+            was interrupted)
+        :rtype: tuple
         """
 
         _, ext = os.path.splitext(data_url)
@@ -74,14 +113,35 @@ class Command(LoadCommand):
         # Caching it dump file locally to avoid downloading 100Gb over and over again
         if os.path.exists(full_path):
             logger.warning("Skipping {} as it's already exists".format(full_path))
-        else:
-            r = requests.get(data_url, stream=True)
+            return full_path, ext, False
+
+        r = requests.get(data_url, stream=True)
 
-            with open(full_path, "wb") as f:
+        # Partially downloaded file should never be taken for the cached one
+        with open(full_path + ".part", "wb") as f:
+            if stop is None:
                 shutil.copyfileobj(r.raw, f)
+            else:
+                for chunk in iter(lambda: r.raw.read(1 << 20), b""):
+                    if stop.is_set():
+                        break
+
+                    f.write(chunk)
 
-            sleep(5)
+        if stop is not None and stop.is_set():
+            os.remove(full_path + ".part")
+            return None
 
+        os.rename(full_path + ".part", full_path)
+
+        if stop is None:
+            sleep(self.download_pause)
+        else:
+            stop.wait(self.download_pause)
+
+        return full_path, ext, True
+
+    def import_revision(self, guid, timestamp, data_url, revision, full_path, ext, overwrite=False):
         with open(full_path, "rb") as fp:
             self.load_file(
                 fp,
@@ -94,18 +154,104 @@ class Command(LoadCommand):
                 url=data_url,
             )
 
-    def handle(self, *args, **options):
-        # Reading parser profile to parse BO and founders using
-        # ML power!
-        with open(options["parser_profile"], "r") as fp:
-            profile = yaml.load(fp.read())
+    def handle_one_revision_from_new_data_gov(
+        self, guid, timestamp, data_url, revision, overwrite=False
+    ):
+        """
+        Process one revision: retrieved from data.gov.ua, parse, unify, load to DB
+        """
+
+        full_path, ext, _ = self.download_revision(timestamp, data_url, revision)
+        self.import_revision(guid, timestamp, data_url, revision, full_path, ext, overwrite)
+
+    def prefetch_revisions(self, jobs, prefetched, slots, stop):
+        """
+        Downloads dumps of given revisions one by one in the background
+        thread and puts them to the queue. Every download takes a slot first,
+        slot is freed only when the dump is imported, so no more than
+        the number of slots dumps are on disk at any time.
+        Last item in the queue is always None (or an exception if something
+        went wrong), nothing is put there once the stop event is set
+        """
+
+        try:
+            for timestamp, data_url, revision in jobs:
+                while not slots.acquire(timeout=1):
+                    if stop.is_set():
+                        return
+
+                if stop.is_set():
+                    return
+
+                downloaded = self.download_revision(timestamp, data_url, revision, stop)
+
+                if downloaded is None:
+                    return
+
+                prefetched.put((timestamp, data_url, revision) + downloaded)
+        except Exception as e:
+            prefetched.put(e)
+        else:
+            prefetched.put(None)
+
+    def backfill(self, guid, jobs, prefetch, overwrite=False, cleanup=False):
+        """
+        Imports given revisions in the same strict order, while dumps of the
+        following revisions are being downloaded in the background. No more
+        than prefetch dumps (the one being imported included) are kept on
+        disk at once
+        """
 
-            # Loading the pipeline
-            self.pipe = Pipeline(profile["pipeline"])
+        prefetched = Queue()
+        slots = BoundedSemaphore(prefetch)
+        stop = Event()
+        downloader = Thread(
+            target=self.prefetch_revisions, args=(jobs, prefetched, slots, stop), daemon=True
+        )
+        downloader.start()
+
+        try:
+            with tqdm(total=len(jobs)) as pbar:
+                while True:
+                    item = prefetched.get()
+
+                    if item is None:
+                        break
+
+                    if isinstance(item, Exception):
+                        raise item
+
+                    timestamp, data_url, revision, full_path, ext, downloaded = item
+
+                    tqdm.write("Processing revision {}".format(revision))
+                    self.import_revision(
+                        guid, timestamp, data_url, revision, full_path, ext, overwrite
+                    )
+
+                    # Only dumps retrieved by this run are removed, to keep
+                    # the disk usage bounded during the long backfills
+                    if cleanup and downloaded:
+                        os.remove(full_path)
+
+                    slots.release()
+                    pbar.update(1)
+        finally:
+            stop.set()
+            downloader.join()
+
+            # Dumps which were downloaded but never imported because of
+            # the error
+            while cleanup:
+                try:
+                    item = prefetched.get_nowait()
+                except Empty:
+                    break
+
+                if isinstance(item, tuple) and item[-1]:
+                    os.remove(item[3])
 
-        # Initializing redis to store extracted named entities in it
-        self.redis = redis.StrictRedis.from_url(settings.PARSING_REDIS)
-        self.redis_cache_key = "extractor_{}".format(self.pipe.config_key)
+    def handle(self, *args, **options):
+        self.init_loader(options)
 
         # Retrieving all the datasets we know about
         response = requests.get(
@@ -122,7 +268,8 @@ class Command(LoadCommand):
             key=lambda x: parse(x["resource_created"])
         )
 
-        for rev in tqdm(revisions):
+        jobs = []
+        for rev in revisions:
             revision = rev["url"].strip("/").rsplit("/", 1)[-1]
 
             if (
@@ -135,13 +282,20 @@ class Command(LoadCommand):
                     tqdm.write("Skipping revision {}".format(revision))
                     continue
 
-                data_url = rev["url"]
-
-                tqdm.write("Processing revision {}".format(revision))
-                # Revision by revision
-                self.handle_one_revision_from_new_data_gov(
-                    options["guid"], timestamp, data_url, revision, options["overwrite"]
-                )
+                jobs.append((timestamp, rev["url"], revision))
 
                 if options["revision"] != "all":
                     break
+
+        if options["prefetch"] > 0:
+            self.backfill(
+                options["guid"], jobs, options["prefetch"], options["overwrite"], options["cleanup"]
+            )
+            return
+
+        for timestamp, data_url, revision in tqdm(jobs):
+            tqdm.write("Processing revision {}".format(revision))
+            # Revision by revision
+            self.handle_one_revision_from_new_data_gov(
+                options["guid"], timestamp, data_url, revision, options["overwrite"]
+            )
@@ -20,6 +20,8 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         reader = DictReader(options["in_file"])
 
+        touched_companies = set(OwnedByCompany.objects.values_list("company_id", flat=True))
+
         OwnedByCompany.objects.all().delete()
 
         for l in tqdm(reader):
@@ -37,3 +39,6 @@ class Command(BaseCommand):
             )
 
             owner.save()
+            touched_companies.add(company.pk)
+
+        Company.mark_dirty(touched_companies)
@@ -20,6 +20,8 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         reader = DictReader(options["in_file"])
 
+        touched_companies = set(PEPOwner.objects.values_list("company_id", flat=True))
+
         PEPOwner.objects.all().delete()
 
         for l in tqdm(reader):
@@ -48,3 +50,6 @@ class Command(BaseCommand):
             )
 
             pep.save()
+            touched_companies.add(company.pk)
+
+        Company.mark_dirty(touched_companies)
@@ -20,6 +20,8 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         reader = DictReader(options["in_file"])
 
+        touched_companies = set(SelfOwned.objects.values_list("company_id", flat=True))
+
         SelfOwned.objects.all().delete()
 
         for l in tqdm(reader):
@@ -42,3 +44,6 @@ class Command(BaseCommand):
             )
 
             pep.save()
+            touched_companies.add(company.pk)
+
+        Company.mark_dirty(touched_companies)
@@ -6,7 +6,7 @@ from Levenshtein import distance
 from tqdm import tqdm
 from multiprocessing import Pool
 
-from companies.models import CompanyRecord
+from companies.models import CompanyRecord, MassRegistrationAddress, revision_registry
 from companies.tools.address_parser import PyJsHoisted_getAddress_ as get_address
 from companies.elastic_models import Address
 
@@ -118,3 +118,11 @@ class Command(BaseCommand):
             )
 
             self.write_to_db(rec_buffer)
+
+        # Shortened locations were changed, so addresses of mass registration
+        # are recalculated for the latest revision and the rest of them will
+        # be recalculated on demand
+        latest_revision = revision_registry.latest()
+        if latest_revision is not None:
+            MassRegistrationAddress.materialize(latest_revision)
+        MassRegistrationAddress.invalidate(exclude=latest_revision)
@@ -4,7 +4,7 @@ from elasticsearch.helpers import parallel_bulk
 from elasticsearch_dsl.connections import connections
 from tqdm import tqdm
 
-from companies.models import Company, CompanySnapshotFlags
+from companies.models import Company, CompanyHistory, CompanySnapshotFlags, Revision, revision_registry
 from companies.elastic_models import Company as ElasticCompany, companies_idx
 
 
@@ -26,10 +26,71 @@ class Command(BaseCommand):
             help="Forcely reindex everything",
         )
 
+        parser.add_argument(
+            "--chunk_size",
+            type=int,
+            default=1000,
+            help="Number of companies to build documents for at once",
+        )
+
+        parser.add_argument(
+            "--skip_history",
+            action="store_true",
+            default=False,
+            help="Don't rebuild cached histories of companies",
+        )
+
     def bulk_write(self, conn, docs_to_index):
         for response in parallel_bulk(conn, (d.to_dict(True) for d in docs_to_index)):
             pass
 
+    def rebuild_history(self, dirty_ids, force=False):
+        """
+        Rebuilds cached histories of companies which were changed by the
+        revisions that were imported since the previous rebuild (or of all
+        companies, when the timeline was changed otherwise). Histories of the
+        rest of companies are extended to the new revisions on the fly
+        """
+        revision_registry.invalidate()
+        global_revisions = Company.get_global_revisions()
+        timeline = list(global_revisions.values())
+
+        pending = [r for r in timeline if not r.history_calculated]
+        first_pending = timeline.index(pending[0]) if pending else len(timeline)
+
+        # Histories can be extended only if they were packed for some prefix
+        # of the current timeline
+        valid_fingerprints = set(CompanyHistory.prefix_fingerprints(list(global_revisions.keys())))
+        stale_fingerprints = set(
+            CompanyHistory.objects.values_list("timeline_fingerprint", flat=True)
+            .distinct()
+            .nocache()
+        ) - valid_fingerprints
+
+        if stale_fingerprints and not force:
+            self.stderr.write(
+                "Timeline of revisions was changed since histories were packed, "
+                "rebuilding all of them"
+            )
+            force = True
+
+        # Only appended revisions can be processed incrementally
+        if force or first_pending == 0 or len(pending) != len(timeline) - first_pending:
+            company_ids = list(
+                Company.objects.order_by("pk").values_list("pk", flat=True).nocache().iterator()
+            )
+        else:
+            changed = set(dirty_ids)
+            for pos in range(first_pending, len(timeline)):
+                changed |= Company.get_changed_between(timeline[pos], timeline[pos - 1])
+            company_ids = sorted(changed)
+
+        for i in tqdm(range(0, len(company_ids), 500)):
+            Company.rebuild_history(company_ids[i:i + 500], global_revisions)
+
+        Revision.objects.filter(pk__in=[r.pk for r in pending]).update(history_calculated=True)
+        revision_registry.invalidate()
+
     def handle(self, *args, **options):
         conn = connections.get_connection("default")
 
@@ -49,11 +110,34 @@ class Command(BaseCommand):
 
         docs_to_index = []
 
-        for p in tqdm(qs.nocache().iterator(), total=qs.count()):
-            docs_to_index.append(ElasticCompany(**p.to_dict()))
-            if len(docs_to_index) > 2000:
-                self.bulk_write(conn, docs_to_index)
-                docs_to_index = []
+        company_ids = list(qs.order_by("pk").values_list("pk", flat=True).nocache().iterator())
+        chunk_size = options["chunk_size"]
+
+        with tqdm(total=len(company_ids)) as pbar:
+            for i in range(0, len(company_ids), chunk_size):
+                companies = list(
+                    Company.objects.filter(pk__in=company_ids[i:i + chunk_size])
+                    .order_by("pk")
+                    .nocache()
+                )
+
+                # Documents for the whole chunk are built with a fixed
+                # number of queries
+                for doc in Company.to_dicts(companies):
+                    docs_to_index.append(ElasticCompany(**doc))
+
+                if len(docs_to_index) > 2000:
+                    self.bulk_write(conn, docs_to_index)
+                    docs_to_index = []
+
+                pbar.update(len(companies))
 
         self.bulk_write(conn, docs_to_index)
+
+        if not options["skip_history"]:
+            self.rebuild_history(
+                list(Company.objects.filter(is_dirty=True).values_list("pk", flat=True).nocache()),
+                force=options["force"] or options["drop_indices"],
+            )
+
         qs.update(is_dirty=False)
@@ -1,8 +1,81 @@
-from django.core.management.base import BaseCommand
-from django.db import models
+from io import StringIO
+from time import time
+from queue import Empty
+from multiprocessing import Pool, Queue
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
 
 from tqdm import tqdm
-from companies.models import Company, CompanyRecord
+from companies.tools.names import load_name_caches, save_name_caches, name_cache_stats
+from companies.models import (
+    Company,
+    CompanyRecord,
+    Revision,
+    revision_registry,
+    CompanySnapshotFlags,
+)
+
+
+# State of the worker process, see init_worker
+worker_state = {}
+
+
+def init_worker(revision, force, mass_registration, global_revisions, chunk_size, progress):
+    """
+    Initializer of the worker processes. Connections inherited from the
+    parent can't be shared, so each worker opens it's own one. Everything
+    else is inherited from the parent once, when the pool starts
+    """
+    connections.close_all()
+
+    worker_state.update(
+        revision=revision,
+        force=force,
+        mass_registration=mass_registration,
+        global_revisions=global_revisions,
+        chunk_size=chunk_size,
+        progress=progress,
+    )
+
+
+def process_shard(shard):
+    """
+    Takes snapshots for the shard (range of edrpou codes) in the worker
+    process, reporting progress after each chunk
+
+    :param shard: number of the shard and sorted company ids in it
+    :type shard: tuple
+    :returns: number of the shard, first and last edrpou, number of companies,
+        time spent and ids of companies which snapshots were calculated
+    :rtype: tuple
+    """
+    shard_no, company_ids = shard
+    chunk_size = worker_state["chunk_size"]
+    started = time()
+    recalculated = []
+
+    for i in range(0, len(company_ids), chunk_size):
+        chunk = company_ids[i:i + chunk_size]
+        recalculated += Company.take_snapshots_of_flags(
+            chunk,
+            worker_state["revision"],
+            worker_state["force"],
+            worker_state["mass_registration"],
+            worker_state["global_revisions"],
+        )
+        worker_state["progress"].put((shard_no, len(chunk)))
+
+    connection.close()
+
+    return (
+        shard_no,
+        company_ids[0] if company_ids else None,
+        company_ids[-1] if company_ids else None,
+        len(company_ids),
+        time() - started,
+        recalculated,
+    )
 
 
 class Command(BaseCommand):
@@ -18,20 +91,323 @@ class Command(BaseCommand):
 
         parser.add_argument("--limit", type=int)
 
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            default=False,
+            help="Recalculate flags only for companies that were changed since the previous "
+            "snapshot and carry forward snapshots of the rest",
+        )
+
+        parser.add_argument(
+            "--chunk_size",
+            type=int,
+            default=500,
+            help="Number of companies to calculate flags for at once",
+        )
+
+        parser.add_argument(
+            "--per_company",
+            action="store_true",
+            default=False,
+            help="Calculate flags company by company (slow, the same results as in bulk)",
+        )
+
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes to calculate flags, companies are split between them "
+            "by ranges of edrpou",
+        )
+
+        parser.add_argument(
+            "--names_cache",
+            default=None,
+            help="File to load the cache of names comparisons from and to save it to after "
+            "the run (with --workers every worker starts with the loaded cache, but they "
+            "aren't saved back)",
+        )
+
+    def get_revision(self, revision_id):
+        if revision_id is None:
+            return revision_registry.latest()
+
+        return revision_registry.get(revision_id)
+
+    def get_previous_snapshot_revision(self, revision):
+        """
+        Latest revision before the given one which has snapshots of flags
+        """
+        for prev in (
+            Revision.objects.filter(created__lt=revision.created)
+            .exclude(pk=revision.pk)
+            .order_by("-created")
+        ):
+            if CompanySnapshotFlags.objects.filter(revision=prev).exists():
+                return prev
+
+        return None
+
+    def get_dirty_companies(self):
+        """
+        Companies which were marked by the loaders as having their flags
+        outdated (new records, persons, PEP links, self-ownership, owners).
+        Unlike is_dirty (which is cleared by reindex) that mark is cleared
+        only by the snapshot run
+        """
+        return set(
+            Company.objects.filter(flags_dirty=True).values_list("pk", flat=True).nocache().iterator()
+        )
+
+    def clear_dirty_companies(self, dirty, recalculated):
+        """
+        Clears the mark from the dirty companies which flags were calculated
+        by this run (the ones marked while it was running and the ones which
+        existing snapshots were kept are left intact)
+        """
+        cleared = sorted(dirty.intersection(recalculated))
+        for i in range(0, len(cleared), 1000):
+            Company.objects.filter(pk__in=cleared[i:i + 1000]).update(flags_dirty=False)
+
+    def get_changed_companies(self, revision, previous, mass_registration, dirty):
+        """
+        Companies which flags for the revision might differ from the flags for
+        the previous one: the dirty ones (see get_dirty_companies), that have
+        records or persons present in only one of two revisions, that have
+        their address added or removed from the list of mass registration
+        addresses or that have no snapshot for the previous revision at all
+        """
+
+        changed = set(dirty)
+
+        changed.update(Company.get_changed_between(revision, previous))
+
+        prev_mass_registration = CompanyRecord.objects.mass_registration_addresses(
+            previous.pk
+        )
+        changed_addresses = list(set(mass_registration) ^ set(prev_mass_registration))
+
+        for i in range(0, len(changed_addresses), 1000):
+            changed.update(
+                CompanyRecord.objects.present_in(revision)
+                .filter(shortened_validated_location__in=changed_addresses[i:i + 1000])
+                .values_list("company_id", flat=True)
+                .nocache()
+                .iterator()
+            )
+
+        changed.update(
+            Company.objects.exclude(
+                pk__in=CompanySnapshotFlags.objects.filter(revision=previous).values(
+                    "company_id"
+                )
+            )
+            .values_list("pk", flat=True)
+            .nocache()
+            .iterator()
+        )
+
+        return changed
+
+    def carry_forward(self, revision, previous, changed):
+        """
+        Copies snapshots of all the companies except changed ones from
+        the previous revision to the given one with a single INSERT ... SELECT
+        (unless the company already has a snapshot for the revision)
+
+        :return: number of copied snapshots
+        :rtype: int
+        """
+        table = CompanySnapshotFlags._meta.db_table
+        columns = [
+            f.column
+            for f in CompanySnapshotFlags._meta.concrete_fields
+            if f.name not in ("id", "revision")
+        ]
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE tmp_changed_companies (company_id integer PRIMARY KEY) "
+                "ON COMMIT DROP"
+            )
+            cursor.copy_from(
+                StringIO("".join("{}\n".format(c) for c in changed)),
+                "tmp_changed_companies",
+                columns=("company_id",),
+            )
+            cursor.execute("ANALYZE tmp_changed_companies")
+
+            cursor.execute(
+                "INSERT INTO {table} ({columns}, revision_id) "
+                "SELECT {columns}, %s FROM {table} AS f "
+                "WHERE f.revision_id = %s "
+                "AND NOT EXISTS (SELECT 1 FROM tmp_changed_companies AS c WHERE c.company_id = f.company_id) "
+                "AND NOT EXISTS (SELECT 1 FROM {table} AS e "
+                "WHERE e.company_id = f.company_id AND e.revision_id = %s)".format(
+                    table=table,
+                    columns=", ".join(connection.ops.quote_name(c) for c in columns),
+                ),
+                [revision.pk, previous.pk, revision.pk],
+            )
+
+            return cursor.rowcount
+
     def handle(self, *args, **options):
-        qs = Company.objects.all()
+        if options["names_cache"]:
+            self.stdout.write(
+                "{} cached names comparisons were loaded".format(
+                    load_name_caches(options["names_cache"])
+                )
+            )
+
+        self.take_snapshots(options)
+
+        if options["names_cache"]:
+            save_name_caches(options["names_cache"])
+
+        for line in name_cache_stats():
+            self.stdout.write(line)
+
+    def take_snapshots(self, options):
+        # Limited incremental run would carry forward outdated snapshots of
+        # the changed companies which are left out by the limit
+        if options["incremental"] and options["limit"] is not None:
+            raise CommandError("--limit can't be used with --incremental")
 
         mass_registration = CompanyRecord.objects.mass_registration_addresses(
             options["revision_id"]
         )
-        total = qs.count()
+
+        revision = self.get_revision(options["revision_id"])
+        company_ids = None
+        force = options["force"]
+        dirty = self.get_dirty_companies()
+
+        if options["incremental"]:
+            previous = self.get_previous_snapshot_revision(revision)
+
+            if previous is None:
+                self.stderr.write(
+                    "There are no snapshots before revision {}, calculating all of them".format(
+                        revision.pk
+                    )
+                )
+            else:
+                changed = self.get_changed_companies(revision, previous, mass_registration, dirty)
+                copied = self.carry_forward(revision, previous, changed)
+
+                self.stdout.write(
+                    "{} snapshots were carried forward from revision {}, {} companies were changed".format(
+                        copied, previous.pk, len(changed)
+                    )
+                )
+
+                company_ids = sorted(changed)
+                # Changed companies are recalculated even if they already
+                # have the snapshot for the revision
+                force = True
+
+        if company_ids is None:
+            company_ids = list(
+                Company.objects.order_by("pk").values_list("pk", flat=True).nocache().iterator()
+            )
+
         if options["limit"] is not None:
-            total = min(total, options["limit"])
+            company_ids = company_ids[:options["limit"]]
+
+        recalculated = []
+        if options["per_company"]:
+            for i in tqdm(range(0, len(company_ids), 1000)):
+                for company in Company.objects.filter(
+                    pk__in=company_ids[i:i + 1000]
+                ).order_by("pk").nocache():
+                    if company.take_snapshot_of_flags(revision, force, mass_registration):
+                        recalculated.append(company.pk)
+        elif options["workers"] > 1:
+            recalculated = self.run_workers(
+                company_ids, options["workers"], revision, force,
+                mass_registration, Company.get_global_revisions(), options["chunk_size"]
+            )
+        else:
+            global_revisions = Company.get_global_revisions()
+            chunk_size = options["chunk_size"]
+
+            with tqdm(total=len(company_ids)) as pbar:
+                for i in range(0, len(company_ids), chunk_size):
+                    chunk = company_ids[i:i + chunk_size]
+                    recalculated += Company.take_snapshots_of_flags(
+                        chunk, revision, force, mass_registration, global_revisions
+                    )
+                    pbar.update(len(chunk))
+
+        # Snapshots for the older revisions don't make flags of the latest
+        # one up to date
+        if revision.pk == revision_registry.latest().pk:
+            self.clear_dirty_companies(dirty, recalculated)
+
+    def run_workers(
+        self, company_ids, workers, revision, force, mass_registration, global_revisions, chunk_size
+    ):
+        if not company_ids:
+            return []
+
+        shard_size = -(-len(company_ids) // workers)
+        shards = [
+            (shard_no, company_ids[i:i + shard_size])
+            for shard_no, i in enumerate(range(0, len(company_ids), shard_size))
+        ]
 
-        for i, company in tqdm(enumerate(qs.iterator()), total=total):
-            company.take_snapshot_of_flags(
-                options["revision_id"], options["force"], mass_registration
+        progress = Queue()
+        bars = [
+            tqdm(total=len(ids), position=shard_no, desc="worker {}".format(shard_no))
+            for shard_no, ids in shards
+        ]
+
+        # Workers must not inherit the connection of the parent process
+        connection.close()
+
+        started = time()
+        with Pool(
+            len(shards),
+            initializer=init_worker,
+            initargs=(revision, force, mass_registration, global_revisions, chunk_size, progress),
+        ) as pool:
+            result = pool.map_async(process_shard, shards, chunksize=1)
+
+            done = 0
+            while done < len(company_ids):
+                if result.ready() and progress.empty():
+                    break
+
+                try:
+                    shard_no, processed = progress.get(timeout=1)
+                except Empty:
+                    continue
+
+                bars[shard_no].update(processed)
+                done += processed
+
+            stats = result.get()
+
+        for bar in bars:
+            bar.close()
+
+        elapsed = time() - started
+        recalculated = []
+        for shard_no, first, last, count, shard_elapsed, shard_recalculated in stats:
+            recalculated += shard_recalculated
+            self.stdout.write(
+                "worker {}: edrpou {}-{}, {} companies in {:.1f}s, {:.1f} companies/s".format(
+                    shard_no, first, last, count, shard_elapsed,
+                    count / shard_elapsed if shard_elapsed else 0
+                )
             )
 
-            if options["limit"] is not None and i + 1 > options["limit"]:
-                break
+        self.stdout.write(
+            "{} companies in {:.1f}s, {:.1f} companies/s".format(
+                len(company_ids), elapsed, len(company_ids) / elapsed if elapsed else 0
+            )
+        )
+
+        return recalculated
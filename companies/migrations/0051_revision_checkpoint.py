@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companies', '0050_auto_20191110_1548'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='revision',
+            name='checkpoint',
+            field=models.IntegerField(default=0, verbose_name='Кількість записів, збережених до бази'),
+        ),
+    ]
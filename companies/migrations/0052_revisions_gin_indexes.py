@@ -0,0 +1,40 @@
+# Generated by Django 2.2.16 on 2026-10-18 11:02
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Indexes are built concurrently, so the import isn't blocked
+    atomic = False
+
+    dependencies = [
+        ('companies', '0051_revision_checkpoint'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    'CREATE INDEX CONCURRENTLY IF NOT EXISTS "companies_rec_revisions_gin" '
+                    'ON "companies_companyrecord" USING gin ("revisions")',
+                    'DROP INDEX CONCURRENTLY IF EXISTS "companies_rec_revisions_gin"',
+                ),
+                migrations.RunSQL(
+                    'CREATE INDEX CONCURRENTLY IF NOT EXISTS "companies_per_revisions_gin" '
+                    'ON "companies_person" USING gin ("revisions")',
+                    'DROP INDEX CONCURRENTLY IF EXISTS "companies_per_revisions_gin"',
+                ),
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='companyrecord',
+                    index=django.contrib.postgres.indexes.GinIndex(fields=['revisions'], name='companies_rec_revisions_gin'),
+                ),
+                migrations.AddIndex(
+                    model_name='person',
+                    index=django.contrib.postgres.indexes.GinIndex(fields=['revisions'], name='companies_per_revisions_gin'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.16 on 2026-10-18 14:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companies', '0052_revisions_gin_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='revision',
+            name='mass_registration_calculated',
+            field=models.BooleanField(default=False, verbose_name='Адреси масової реєстрації пораховано'),
+        ),
+        migrations.CreateModel(
+            name='MassRegistrationAddress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.TextField(verbose_name='Адреса')),
+                ('company_count', models.IntegerField(verbose_name='Кількість записів')),
+                ('revision', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mass_registration_addresses', to='companies.Revision', verbose_name='Ревізія')),
+            ],
+            options={
+                'unique_together': {('revision', 'address')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.16 on 2026-10-18 16:25
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companies', '0053_massregistrationaddress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='revision',
+            name='history_calculated',
+            field=models.BooleanField(default=False, verbose_name='Кеш історії змін компаній оновлено'),
+        ),
+        migrations.CreateModel(
+            name='CompanyHistory',
+            fields=[
+                ('company', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='history', serialize=False, to='companies.Company', verbose_name='Компанія')),
+                ('data', django.contrib.postgres.fields.jsonb.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, verbose_name='Історія змін')),
+            ],
+        ),
+    ]
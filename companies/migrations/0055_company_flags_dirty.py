@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companies', '0054_companyhistory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='flags_dirty',
+            field=models.BooleanField(db_index=True, default=True, verbose_name='Потребує перерахунку прапорців'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-18 21:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companies', '0055_company_flags_dirty'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='companyhistory',
+            name='timeline_fingerprint',
+            field=models.CharField(db_index=True, default='', max_length=40, verbose_name='Відбиток ревізій історії'),
+        ),
+    ]
@@ -1,20 +1,26 @@
 import re
 import logging
-from functools import reduce
-from itertools import permutations, product, islice
-from operator import mul
+from time import time
+from hashlib import sha1
 
 from collections import OrderedDict, defaultdict
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils.translation import ugettext_noop as _
+from django.utils import timezone
 from django.contrib.postgres.fields import ArrayField, JSONField
+from django.contrib.postgres.indexes import GinIndex
 from django.urls import reverse
 from django.forms.models import model_to_dict
 from Levenshtein import jaro
 from fuzzywuzzy import fuzz
 from tokenize_uk import tokenize_words
-from companies.exceptions import StatusDoesntExist, TooManyVariantsError
+from companies.exceptions import StatusDoesntExist
 from companies.tools.phones import phone_variants
+from companies.tools.territories import territory_classifier
+from companies.tools.names import token_order_jaro, memoize
+from companies.tools.intervals import group_by_intervals
 
 from names_translator.name_utils import parse_and_generate, autocomplete_suggestions
 
@@ -22,6 +28,18 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("models")
 
 
+# Same persons are in many companies, so name variants for documents
+# are cached. Results are shared, so they must not be modified
+@memoize("parse_and_generate", maxsize=20000)
+def cached_parse_and_generate(name, position):
+    return parse_and_generate(name, position)
+
+
+@memoize("autocomplete_suggestions", maxsize=20000)
+def cached_autocomplete_suggestions(name):
+    return autocomplete_suggestions(name)
+
+
 class Revision(models.Model):
     revision_id = models.AutoField("Номер ревізії", primary_key=True)
     subrevision_id = models.CharField(
@@ -32,17 +50,161 @@ class Revision(models.Model):
     imported = models.BooleanField("Імпорт завершено", default=False)
     ignore = models.BooleanField("Ігнорувати через помилки імпорту", default=False)
     url = models.URLField("Посилання на набір данних")
+    checkpoint = models.IntegerField(
+        "Кількість записів, збережених до бази", default=0
+    )
+    mass_registration_calculated = models.BooleanField(
+        "Адреси масової реєстрації пораховано", default=False
+    )
+    history_calculated = models.BooleanField(
+        "Кеш історії змін компаній оновлено", default=False
+    )
 
     def get_absolute_url(self):
         return reverse("revision>detail", kwargs={"pk": self.pk})
 
 
+class RevisionRegistry(object):
+    """
+    Timeline of revisions loaded once per process. It's reloaded when
+    revision is saved or deleted in the same process, and after ttl seconds,
+    so revisions imported/ignored by other processes are picked up too.
+
+    Returned revisions and dicts are shared, so they must not be modified
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.state = None
+
+    def load(self):
+        state = self.state
+        if state is None or time() - state["loaded"] > self.ttl:
+            revisions = list(Revision.objects.order_by("created").nocache())
+            state = {
+                "loaded": time(),
+                "all": revisions,
+                "ordered": OrderedDict(
+                    (r.pk, r) for r in revisions if r.imported and not r.ignore
+                ),
+                "by_pk": {r.pk: r for r in revisions},
+            }
+            # Replaced at once, so concurrent readers see either old or
+            # new state
+            self.state = state
+
+        return state
+
+    def invalidate(self, **kwargs):
+        self.state = None
+
+    def latest(self):
+        """
+        Latest revision (imported or not), same as
+        Revision.objects.order_by("-created").first()
+        """
+        revisions = self.load()["all"]
+        return revisions[-1] if revisions else None
+
+    def ordered(self):
+        """
+        :returns: imported and not ignored revisions by id, oldest first
+        :rtype: OrderedDict
+        """
+        return self.load()["ordered"]
+
+    def get(self, pk):
+        """
+        Same as Revision.objects.get(pk=pk)
+        """
+        pk = int(pk)
+        revision = self.load()["by_pk"].get(pk)
+
+        if revision is None:
+            # Might be created by another process after the timeline was loaded
+            self.invalidate()
+            revision = self.load()["by_pk"].get(pk)
+
+        if revision is None:
+            raise Revision.DoesNotExist("Revision {} does not exist".format(pk))
+
+        return revision
+
+
+revision_registry = RevisionRegistry()
+post_save.connect(revision_registry.invalidate, sender=Revision)
+post_delete.connect(revision_registry.invalidate, sender=Revision)
+
+
+class MassRegistrationAddress(models.Model):
+    """
+    Materialised list of the addresses of mass registration for the revision
+    (number of company records with the same shortened validated location).
+    Only addresses with at least MIN_COUNT records are kept
+    """
+
+    MIN_COUNT = 10
+
+    revision = models.ForeignKey(
+        Revision,
+        on_delete=models.CASCADE,
+        verbose_name="Ревізія",
+        related_name="mass_registration_addresses",
+    )
+    address = models.TextField("Адреса")
+    company_count = models.IntegerField("Кількість записів")
+
+    @classmethod
+    def materialize(cls, revision):
+        """
+        (Re)calculates addresses of mass registration for the revision
+
+        :param revision: revision or it's id
+        :returns: number of addresses
+        :rtype: int
+        """
+        revision_id = getattr(revision, "pk", revision)
+
+        with transaction.atomic():
+            cls.objects.filter(revision_id=revision_id).delete()
+            addresses = cls.objects.bulk_create(
+                [
+                    cls(revision_id=revision_id, address=address, company_count=count)
+                    for address, count in CompanyRecord.objects.group_mass_registration_addresses(
+                        revision_id, cls.MIN_COUNT
+                    ).items()
+                ],
+                batch_size=1000,
+            )
+            Revision.objects.filter(pk=revision_id).update(mass_registration_calculated=True)
+
+        return len(addresses)
+
+    @staticmethod
+    def invalidate(exclude=None):
+        """
+        Marks addresses of all the revisions (except of the given one) as
+        outdated, they are recalculated next time they are requested
+        """
+        qs = Revision.objects.filter(mass_registration_calculated=True)
+        if exclude is not None:
+            qs = qs.exclude(pk=getattr(exclude, "pk", exclude))
+
+        qs.update(mass_registration_calculated=False)
+
+    class Meta:
+        unique_together = [("revision", "address")]
+
+
 class Company(models.Model):
     edrpou = models.IntegerField(primary_key=True)
     last_modified = models.DateTimeField(auto_now=True)
     is_dirty = models.BooleanField(
         "Потребує повторної індексації", db_index=True, default=True
     )
+    flags_dirty = models.BooleanField(
+        "Потребує перерахунку прапорців", db_index=True, default=True
+    )
 
     status_order = (
         "зареєстровано",
@@ -53,82 +215,6 @@ class Company(models.Model):
         "припинено",
     )
 
-    CRIMEA_MARKERS = [
-        re.compile(s, flags=re.U | re.I) for s in [r"\bАРК\b", r"\bКрим\b"]
-    ]
-
-    DONETSK_MARKER_LEVEL1 = [
-        re.compile(s, flags=re.U | re.I) for s in [r"\bДонецк", r"\bДонецьк"]
-    ]
-
-    DONETSK_MARKER_LEVEL2 = [
-        re.compile(r"\b{}\b".format(s), flags=re.U | re.I)
-        for s in [
-            "Авдіївка",
-            "Адвеевка",
-            "Горлівка",
-            "Горловка",
-            "Донецьк",
-            "Донецк",
-            "Єнакієве",
-            "Енакиево",
-            "Жданівка",
-            "Ждановка",
-            "Макіївка",
-            "Макеевка",
-            "Сніжне",
-            "Снежное",
-            "Харцизьк",
-            "Харцызск",
-            "Хрестівка",
-            "Чистякове",
-            "Чистяково",
-            "Шахтарськ",
-            "Шахтерск",
-            "Ясинувата",
-            "Ясиноватая",
-            "Дебальцеве",
-            "Дебальцево",
-        ]
-    ]
-
-    LUHANSK_MARKER_LEVEL1 = [
-        re.compile(s, flags=re.U | re.I) for s in [r"\bЛуганськ", r"\bЛуганск"]
-    ]
-
-    LUHANSK_MARKER_LEVEL2 = [
-        re.compile(r"\b{}\b".format(s), flags=re.U | re.I)
-        for s in [
-            "Алчевськ",
-            "Алчевск",
-            "Антрацит",
-            "Брянка",
-            "Голубівка",
-            "Голубевка",
-            "Довжанськ",
-            "Должанск",
-            "Кадіївка",
-            "Кадиевка",
-            "Луганськ",
-            "Луганск",
-            "Первомайськ",
-            "Первомайск",
-            "Ровеньки",
-            "Сорокине",
-            "Сорокино",
-            "Хрустальний",
-            "Хрустальный",
-            "Золоте",
-            "Золотое",
-        ]
-    ]
-
-    COUNTRY_MARKERS = {
-        "британія": ["сполучене королівство", "британія", "англія"],
-        "кіпр": ["кіпр"],
-        "росія": ["росія", "російська", "россія"],
-    }
-
     @property
     def full_edrpou(self):
         return str(self.pk).rjust(8, "0")
@@ -137,132 +223,172 @@ class Company(models.Model):
         return reverse("company>detail", kwargs={"pk": self.full_edrpou})
 
     @staticmethod
-    def compare_two_names(name1, name2, max_splits=7):
-        def normalize_name(s):
-            return re.sub(r"\s+", " ", s.lower().strip().replace("-", " "))
-
-        def slugify_name(s):
-            return (
-                s.replace(" ", "")
-                .replace(".", "")
-                .replace('"', "")
-                .replace("'", "")
-                .replace("’", "")
-            )
+    @memoize("normalize_name")
+    def normalize_name(s):
+        return re.sub(r"\s+", " ", s.lower().strip().replace("-", " "))
 
-        name1 = normalize_name(name1)
-        name2 = normalize_name(name2)
+    @staticmethod
+    @memoize("slugify_name")
+    def slugify_name(s):
+        return (
+            s.replace(" ", "")
+            .replace(".", "")
+            .replace('"', "")
+            .replace("'", "")
+            .replace("’", "")
+        )
+
+    @staticmethod
+    def compare_two_names(name1, name2, max_splits=7):
+        # max_splits is kept for compatibility, token_order_jaro enumerates
+        # permutations only for names of EXACT_PERMUTATIONS_LIMIT tokens or
+        # less, longer ones are compared by the assignment of tokens
+        return Company.compare_normalized_names(
+            Company.normalize_name(name1), Company.normalize_name(name2)
+        )
 
-        if slugify_name(name1) == slugify_name(name2):
+    @staticmethod
+    @memoize("compare_normalized_names")
+    def compare_normalized_names(name1, name2):
+        if Company.slugify_name(name1) == Company.slugify_name(name2):
             return 1
 
         if jaro(name1, name2) > 0.95:
             return 1
 
-        splits = name2.split(" ")
-        limit = reduce(mul, range(1, max_splits + 1))
-
-        if len(splits) > max_splits:
-            print("Too much permutations for {}".format(name2))
+        return token_order_jaro(name1, name2)
 
-        return max(
-            jaro(name1, " ".join(opt)) for opt in islice(permutations(splits), limit)
-        )
+    @staticmethod
+    @memoize("token_set_ratio")
+    def names_set_ratio(names_a, names_b):
+        """
+        fuzz.token_set_ratio of two sets of names. It doesn't depend on the
+        order of tokens, so sets are passed as frozensets to be cached
+        """
+        return fuzz.token_set_ratio(" ".join(names_a), " ".join(names_b))
 
     @staticmethod
     def compare_two_list_of_names(list_a, list_b, cutoff=0.93):
+        """
+        Finds pairs of similar names in two lists. Names are normalized once
+        and pairs which can't reach the cutoff are skipped without scoring:
+        jaro can't be greater than (2 + shorter / longer) / 3, so names which
+        lengths differ too much are never similar (unless their slugs match)
+        """
         result = []
 
-        if len(list_a) * len(list_b) > 1000:
-            raise TooManyVariantsError()
+        def prepare(names):
+            prepared = []
+            for name in names:
+                normalized = Company.normalize_name(name)
+                prepared.append((name, len(normalized), Company.slugify_name(normalized)))
+            return prepared
 
-        for i, (side_a, side_b) in enumerate(product(list_a, list_b)):
-            if side_a == side_b:
-                continue
+        min_ratio = 3 * cutoff - 2
+        prepared_b = prepare(list_b)
+
+        for side_a, len_a, slug_a in prepare(list_a):
+            for side_b, len_b, slug_b in prepared_b:
+                if side_a == side_b:
+                    continue
 
-            score = Company.compare_two_names(side_a, side_b)
-            if score > cutoff:
-                result.append({"side_a": side_a, "side_b": side_b, "score": score})
+                if slug_a != slug_b and min(len_a, len_b) < min_ratio * max(len_a, len_b):
+                    continue
 
-            if i > 1000:
-                break
+                score = Company.compare_two_names(side_a, side_b)
+                if score > cutoff:
+                    result.append({"side_a": side_a, "side_b": side_b, "score": score})
 
         return result
 
     @staticmethod
+    @memoize("ugly_strip")
     def ugly_strip(s):
         return s.strip(" -.’,0\"139472856)/;№&`%+“‘”*¦:'").strip().lower()
 
-    def take_snapshot_of_flags(
-        self, revision=None, force=False, mass_registration=None
-    ):
-        if revision is None:
-            revision = Revision.objects.order_by("-created").first()
-        else:
-            revision = Revision.objects.get(revision)
-
-        if mass_registration is None:
-            mass_registration = CompanyRecord.objects.mass_registration_addresses(
-                revision=revision.pk
-            )
+    @staticmethod
+    def reset_snapshot_of_flags(snapshot):
+        """
+        Resets values of existing snapshot before the recalculation
+        """
+        snapshot.charter_capital = None
+        snapshot.reg_date = None
+        snapshot.has_bo = False
+        snapshot.has_bo_companies = False
+        snapshot.has_bo_persons = False
+        snapshot.has_founder_companies = False
+        snapshot.has_founder_persons = False
+        snapshot.has_only_companies_bo = False
+        snapshot.has_only_companies_founder = False
+        snapshot.has_only_persons_bo = False
+        snapshot.has_only_persons_founder = False
+        snapshot.has_same_person_as_bo_and_founder = False
+        snapshot.has_same_person_as_bo_and_head = False
+        snapshot.has_very_similar_person_as_bo_and_founder = False
+        snapshot.has_very_similar_person_as_bo_and_head = False
+        snapshot.has_bo_on_occupied_soil = False
+        snapshot.has_bo_in_crimea = False
+        snapshot.acting_and_explicitly_stated_that_has_no_bo = False
+        snapshot.has_mass_registration_address = False
+        snapshot.has_changes_in_bo = False
+        snapshot.has_changes_in_ownership = False
+        snapshot.has_pep_owner = False
+        snapshot.had_pep_owner_in_the_past = False
+        snapshot.has_undeclared_pep_owner = False
+        snapshot.has_discrepancy_with_declarations = False
+        snapshot.self_owned = False
+        snapshot.indirectly_self_owned = False
+        snapshot.has_same_person_as_head_and_founder = False
+        snapshot.status = 0
+        snapshot.has_founders_on_occupied_soil = False
+        snapshot.has_founders_in_crimea = False
+        snapshot.has_high_risk = False
+        snapshot.has_foreign_bo = False
+        snapshot.has_foreign_founders = False
+        snapshot.has_russian_bo = False
+        snapshot.has_russian_founders = False
+        snapshot.has_pep_founder = False
+        snapshot.had_pep_founder_in_the_past = False
+        snapshot.bo_changes_dates = []
+
+    def get_grouped_persons_history(self, global_revisions, persons):
+        """
+        Same as get_grouped_record(...)["grouped_persons_records"] but for
+        already retrieved persons of the company
+        """
+        persons_revisions = defaultdict(set)
+        for p in persons:
+            for r in p.revisions:
+                persons_revisions[r].add(p)
 
-        # Let the rampage begin
-        existing_snapshot = CompanySnapshotFlags.objects.filter(
-            company=self, revision=revision
+        return group_by_intervals(
+            global_revisions, persons_revisions, (p.revisions for p in persons)
         )
-        if existing_snapshot:
-            if force:
-                snapshot = existing_snapshot.first()
-
-                # Resetting existing values
-                snapshot.charter_capital = None
-                snapshot.reg_date = None
-                snapshot.has_bo = False
-                snapshot.has_bo_companies = False
-                snapshot.has_bo_persons = False
-                snapshot.has_founder_companies = False
-                snapshot.has_founder_persons = False
-                snapshot.has_only_companies_bo = False
-                snapshot.has_only_companies_founder = False
-                snapshot.has_only_persons_bo = False
-                snapshot.has_only_persons_founder = False
-                snapshot.has_same_person_as_bo_and_founder = False
-                snapshot.has_same_person_as_bo_and_head = False
-                snapshot.has_very_similar_person_as_bo_and_founder = False
-                snapshot.has_very_similar_person_as_bo_and_head = False
-                snapshot.has_bo_on_occupied_soil = False
-                snapshot.has_bo_in_crimea = False
-                snapshot.acting_and_explicitly_stated_that_has_no_bo = False
-                snapshot.has_mass_registration_address = False
-                snapshot.has_changes_in_bo = False
-                snapshot.has_changes_in_ownership = False
-                snapshot.has_pep_owner = False
-                snapshot.had_pep_owner_in_the_past = False
-                snapshot.has_undeclared_pep_owner = False
-                snapshot.has_discrepancy_with_declarations = False
-                snapshot.self_owned = False
-                snapshot.indirectly_self_owned = False
-                snapshot.has_same_person_as_head_and_founder = False
-                snapshot.status = 0
-                snapshot.has_founders_on_occupied_soil = False
-                snapshot.has_founders_in_crimea = False
-                snapshot.has_high_risk = False
-                snapshot.has_foreign_bo = False
-                snapshot.has_foreign_founders = False
-                snapshot.has_russian_bo = False
-                snapshot.has_russian_founders = False
-                snapshot.has_pep_founder = False
-                snapshot.had_pep_founder_in_the_past = False
-                snapshot.bo_changes_dates = []
-            else:
-                return
-        else:
-            snapshot = CompanySnapshotFlags(company=self, revision=revision)
-
-        latest_record = CompanyRecord.objects.filter(
-            company=self, revisions__contains=[revision.pk]
-        ).first()
 
+    def calculate_flags(
+        self,
+        snapshot,
+        mass_registration,
+        latest_record,
+        persons,
+        get_grouped_persons_records,
+        peps,
+        self_owned_levels,
+        has_owned_by_company,
+    ):
+        """
+        Fills snapshot of flags from the data of the company which is
+        retrieved beforehand (per company or in bulk).
+
+        :param latest_record: record of the company in the revision
+            (or None if company isn't present there)
+        :param persons: persons of the company in the revision
+        :param get_grouped_persons_records: function that returns grouped
+            history of owners and founders of the company
+        :param peps: PEP links of the company ordered by id
+        :param self_owned_levels: levels of self ownership of the company
+        :param has_owned_by_company: if company has OwnedByCompany records
+        """
         company_is_acting = False
         if not latest_record:
             snapshot.not_present_in_revision = True
@@ -275,8 +401,6 @@ class Company(models.Model):
             snapshot.charter_capital = latest_record.charter_capital
             snapshot.reg_date = latest_record.reg_date
 
-        persons = Person.objects.filter(company=self, revisions__contains=[revision.pk])
-
         all_founder_persons = set()
         all_owner_persons = set()
         all_head_persons = set()
@@ -286,39 +410,21 @@ class Company(models.Model):
         for p in persons:
             if p.person_type in ["owner", "founder"]:
                 for addr in p.address:
-                    for r in self.CRIMEA_MARKERS:
-                        if r.search(addr):
-                            if p.person_type == "owner":
-                                snapshot.has_bo_in_crimea = True
-                            else:
-                                snapshot.has_founders_in_crimea = True
-                            break
-
-                    for r1 in self.LUHANSK_MARKER_LEVEL1:
-                        if r1.search(addr):
-                            for r2 in self.LUHANSK_MARKER_LEVEL2:
-                                if r2.search(addr):
-                                    if p.person_type == "owner":
-                                        snapshot.has_bo_on_occupied_soil = True
-                                    else:
-                                        snapshot.has_founders_on_occupied_soil = True
-                                    break
-
-                    for r1 in self.DONETSK_MARKER_LEVEL1:
-                        if r1.search(addr):
-                            for r2 in self.DONETSK_MARKER_LEVEL2:
-                                if r2.search(addr):
-                                    if p.person_type == "owner":
-                                        snapshot.has_bo_on_occupied_soil = True
-                                    else:
-                                        snapshot.has_founders_on_occupied_soil = True
-                                    break
-            extra_countries = set()
-
-            for country, markers in self.COUNTRY_MARKERS.items():
-                for marker in markers:
-                    if re.search(marker, p.raw_record, flags=re.I):
-                        extra_countries.add(country)
+                    address_flags = territory_classifier.classify_address(addr)
+
+                    if address_flags.crimea:
+                        if p.person_type == "owner":
+                            snapshot.has_bo_in_crimea = True
+                        else:
+                            snapshot.has_founders_in_crimea = True
+
+                    if address_flags.luhansk or address_flags.donetsk:
+                        if p.person_type == "owner":
+                            snapshot.has_bo_on_occupied_soil = True
+                        else:
+                            snapshot.has_founders_on_occupied_soil = True
+
+            extra_countries = territory_classifier.find_countries(p.raw_record)
 
             if p.person_type == "owner":
                 snapshot.has_bo = True
@@ -342,7 +448,7 @@ class Company(models.Model):
                     snapshot.has_founder_persons = True
                     all_founder_persons |= set(map(self.ugly_strip, p.name))
 
-            if OwnedByCompany.objects.filter(company=self).count():
+            if has_owned_by_company:
                 snapshot.has_founder_companies = True
 
             if p.person_type == "head":
@@ -351,9 +457,7 @@ class Company(models.Model):
 
         # TODO validate if we need to calculate ownership changes
         if snapshot.has_bo_persons:
-            grouped_records = self.get_grouped_record(
-                persons_filter_clause=models.Q(person_type__in=["owner", "founder"])
-            )["grouped_persons_records"]
+            grouped_records = get_grouped_persons_records()
 
             prev_names = {"founder": None, "owner": None}
 
@@ -378,8 +482,8 @@ class Company(models.Model):
                         on_the_right = names[k] - prev_names[k]
 
                         if len(on_the_left) == len(on_the_right):
-                            ratio = fuzz.token_set_ratio(
-                                " ".join(on_the_left), " ".join(on_the_right)
+                            ratio = self.names_set_ratio(
+                                frozenset(on_the_left), frozenset(on_the_right)
                             )
                             if ratio >= 90:
                                 pass
@@ -440,45 +544,36 @@ class Company(models.Model):
             snapshot.has_same_person_as_head_and_founder = True
 
         snapshot.all_similar_founders_and_bos = []
-        try:
-            found_something = self.compare_two_list_of_names(
-                all_founder_persons, all_owner_persons
-            )
-            if found_something:
-                snapshot.all_similar_founders_and_bos = found_something
-                snapshot.has_very_similar_person_as_bo_and_founder = True
-        except TooManyVariantsError:
-            print("Too many persons to compare for company {}".format(self.pk))
+        found_something = self.compare_two_list_of_names(
+            all_founder_persons, all_owner_persons
+        )
+        if found_something:
+            snapshot.all_similar_founders_and_bos = found_something
+            snapshot.has_very_similar_person_as_bo_and_founder = True
 
         snapshot.all_similar_heads_and_bos = []
-        try:
-            found_something = self.compare_two_list_of_names(
-                all_head_persons, all_owner_persons
-            )
-            if found_something:
-                snapshot.all_similar_heads_and_bos = found_something
-                snapshot.has_very_similar_person_as_bo_and_head = True
-        except TooManyVariantsError:
-            print("Too many persons to compare for company {}".format(self.pk))
+        found_something = self.compare_two_list_of_names(
+            all_head_persons, all_owner_persons
+        )
+        if found_something:
+            snapshot.all_similar_heads_and_bos = found_something
+            snapshot.has_very_similar_person_as_bo_and_head = True
 
         snapshot.all_similar_heads_and_founders = []
-        try:
-            found_something = self.compare_two_list_of_names(
-                all_head_persons, all_founder_persons
-            )
-            if found_something:
-                snapshot.all_similar_heads_and_founders = found_something
-                snapshot.has_very_similar_person_as_head_and_founder = True
-        except TooManyVariantsError:
-            print("Too many persons to compare for company {}".format(self.pk))
-
-        if self.peps.filter(
-            years__contains=[2018], from_declaration=True, person_type="owner"
-        ).exists():
+        found_something = self.compare_two_list_of_names(
+            all_head_persons, all_founder_persons
+        )
+        if found_something:
+            snapshot.all_similar_heads_and_founders = found_something
+            snapshot.has_very_similar_person_as_head_and_founder = True
+
+        declared_peps = [pep for pep in peps if pep.from_declaration]
+        current_peps = [pep for pep in declared_peps if 2018 in pep.years]
+        past_peps = [pep for pep in declared_peps if 2018 not in pep.years]
+
+        if any(pep.person_type == "owner" for pep in current_peps):
             snapshot.has_pep_owner = True
-            pep_bo = self.peps.filter(
-                years__contains=[2018], from_declaration=True
-            ).first()
+            pep_bo = current_peps[0]
 
             for person in all_owner_persons:
                 if self.compare_two_names(person, pep_bo.person) > 0.93:
@@ -486,32 +581,24 @@ class Company(models.Model):
             else:
                 snapshot.has_discrepancy_with_declarations = True
 
-        if (
-            self.peps.filter(from_declaration=True, person_type="owner")
-            .exclude(years__contains=[2018])
-            .exists()
-        ):
+        if any(pep.person_type == "owner" for pep in past_peps):
             snapshot.had_pep_owner_in_the_past = True
 
-        if self.peps.filter(
-            years__contains=[2018], from_declaration=True, person_type="founder"
-        ).exists():
+        if any(pep.person_type == "founder" for pep in current_peps):
             snapshot.has_pep_founder = True
 
-        if (
-            self.peps.filter(from_declaration=True, person_type="founder")
-            .exclude(years__contains=[2018])
-            .exists()
-        ):
+        if any(pep.person_type == "founder" for pep in past_peps):
             snapshot.had_pep_founder_in_the_past = True
 
-        if self.peps.filter(from_declaration=False, person_type="owner").exists():
+        if any(
+            not pep.from_declaration and pep.person_type == "owner" for pep in peps
+        ):
             snapshot.has_undeclared_pep_owner = True
 
-        if self.self_owned.filter(level=1).exists():
+        if 1 in self_owned_levels:
             snapshot.self_owned = True
 
-        if self.self_owned.filter(level__gt=1).exists():
+        if any(level > 1 for level in self_owned_levels):
             snapshot.indirectly_self_owned = True
 
         snapshot.all_owner_persons = list(all_owner_persons)
@@ -544,11 +631,222 @@ class Company(models.Model):
         if "росія" in snapshot.all_founder_countries:
             snapshot.has_russian_founders = True
 
+    def take_snapshot_of_flags(
+        self, revision=None, force=False, mass_registration=None
+    ):
+        """
+        :returns: True if the snapshot was calculated, False if the existing
+            one was kept
+        :rtype: bool
+        """
+        if revision is None:
+            revision = revision_registry.latest()
+        elif not isinstance(revision, Revision):
+            revision = revision_registry.get(revision)
+
+        if mass_registration is None:
+            mass_registration = CompanyRecord.objects.mass_registration_addresses(
+                revision=revision.pk
+            )
+
+        # Let the rampage begin
+        existing_snapshot = CompanySnapshotFlags.objects.filter(
+            company=self, revision=revision
+        )
+        if existing_snapshot:
+            if force:
+                snapshot = existing_snapshot.first()
+                self.reset_snapshot_of_flags(snapshot)
+            else:
+                return False
+        else:
+            snapshot = CompanySnapshotFlags(company=self, revision=revision)
+
+        self.calculate_flags(
+            snapshot,
+            mass_registration,
+            latest_record=CompanyRecord.objects.present_in(revision)
+            .filter(company=self)
+            .first(),
+            persons=Person.objects.present_in(revision).filter(company=self),
+            get_grouped_persons_records=lambda: self.get_grouped_records(
+                [self], persons_filter_clause=models.Q(person_type__in=["owner", "founder"])
+            )[self.pk]["grouped_persons_records"],
+            peps=list(self.peps.order_by("pk")),
+            self_owned_levels=list(self.self_owned.values_list("level", flat=True)),
+            has_owned_by_company=OwnedByCompany.objects.filter(company=self).exists(),
+        )
+
         snapshot.save()
+        return True
+
+    @classmethod
+    def take_snapshots_of_flags(
+        cls, company_ids, revision, force=False, mass_registration=None, global_revisions=None
+    ):
+        """
+        Batch version of take_snapshot_of_flags for the chunk of companies:
+        all the data is retrieved with a fixed number of queries, flags are
+        calculated in memory and snapshots are written at once
+
+        :param company_ids: ids of companies to process
+        :type company_ids: list
+        :param revision: revision to take snapshots for
+        :type revision: Revision
+        :returns: ids of companies which snapshots were calculated (existing
+            snapshots are kept unless force is set)
+        :rtype: list
+        """
+        if mass_registration is None:
+            mass_registration = CompanyRecord.objects.mass_registration_addresses(
+                revision=revision.pk
+            )
+
+        if global_revisions is None:
+            global_revisions = cls.get_global_revisions()
+
+        companies = list(cls.objects.filter(pk__in=company_ids).order_by("pk").nocache())
+        ids = [company.pk for company in companies]
+
+        existing_snapshots = {}
+        for snapshot in CompanySnapshotFlags.objects.filter(
+            company_id__in=ids, revision=revision
+        ).order_by("-pk").nocache():
+            # The one with the lowest id wins, as in .first()
+            existing_snapshots[snapshot.company_id] = snapshot
+
+        # .first() on the unordered queryset takes the record with lowest pk
+        latest_records = {}
+        for rec in CompanyRecord.objects.present_in(revision).filter(
+            company_id__in=ids
+        ).order_by("-pk").nocache():
+            latest_records[rec.company_id] = rec
+
+        persons = defaultdict(list)
+        for p in Person.objects.filter(company_id__in=ids).order_by("pk").nocache():
+            persons[p.company_id].append(p)
+
+        peps = defaultdict(list)
+        for pep in PEPOwner.objects.filter(company_id__in=ids).order_by("pk").nocache():
+            peps[pep.company_id].append(pep)
+
+        self_owned_levels = defaultdict(list)
+        for company_id, level in SelfOwned.objects.filter(
+            company_id__in=ids
+        ).values_list("company_id", "level").nocache():
+            self_owned_levels[company_id].append(level)
+
+        owned_by_company = set(
+            OwnedByCompany.objects.filter(company_id__in=ids).values_list(
+                "company_id", flat=True
+            ).nocache()
+        )
+
+        to_write = []
+        for company in companies:
+            snapshot = existing_snapshots.get(company.pk)
+            if snapshot is not None:
+                if not force:
+                    continue
+
+                cls.reset_snapshot_of_flags(snapshot)
+            else:
+                snapshot = CompanySnapshotFlags(company=company, revision=revision)
+
+            company_persons = persons[company.pk]
+
+            company.calculate_flags(
+                snapshot,
+                mass_registration,
+                latest_record=latest_records.get(company.pk),
+                persons=[p for p in company_persons if revision.pk in p.revisions],
+                get_grouped_persons_records=lambda: company.get_grouped_persons_history(
+                    global_revisions,
+                    [p for p in company_persons if p.person_type in ["owner", "founder"]],
+                ),
+                peps=peps[company.pk],
+                self_owned_levels=self_owned_levels[company.pk],
+                has_owned_by_company=company.pk in owned_by_company,
+            )
+
+            to_write.append(snapshot)
+
+        # Recalculated snapshots are replaced (keeping their ids)
+        with transaction.atomic():
+            CompanySnapshotFlags.objects.filter(
+                pk__in=[snapshot.pk for snapshot in to_write if snapshot.pk is not None]
+            ).delete()
+            CompanySnapshotFlags.objects.bulk_create(to_write, batch_size=1000)
+
+        return [snapshot.company_id for snapshot in to_write]
+
+    # Fields that aren't needed to build the document for elasticsearch
+    DOCUMENT_DEFERRED_RECORD_FIELDS = ["company_hash", "location_parsing_quality"]
+    DOCUMENT_DEFERRED_PERSON_FIELDS = ["tokenized_record", "share", "revisions"]
 
     def to_dict(self):
+        return self.build_document(
+            self.records.all().defer(*self.DOCUMENT_DEFERRED_RECORD_FIELDS).nocache(),
+            self.persons.all().defer(*self.DOCUMENT_DEFERRED_PERSON_FIELDS).nocache(),
+            self.snapshot_stats.order_by("-revision_id").first(),
+        )
+
+    @classmethod
+    def to_dicts(cls, companies):
+        """
+        Batch version of to_dict: records, persons and latest snapshots of
+        flags for all the companies are retrieved with three queries
+
+        :param companies: companies to build documents for
+        :type companies: list
+        :returns: documents in the same order as companies
+        :rtype: list
+        """
+        ids = [company.pk for company in companies]
+
+        records = defaultdict(list)
+        for rec in (
+            CompanyRecord.objects.filter(company_id__in=ids)
+            .defer(*cls.DOCUMENT_DEFERRED_RECORD_FIELDS)
+            .nocache()
+            .iterator()
+        ):
+            records[rec.company_id].append(rec)
+
+        persons = defaultdict(list)
+        for p in (
+            Person.objects.filter(company_id__in=ids)
+            .defer(*cls.DOCUMENT_DEFERRED_PERSON_FIELDS)
+            .nocache()
+            .iterator()
+        ):
+            persons[p.company_id].append(p)
+
+        snapshots = {
+            snapshot.company_id: snapshot
+            for snapshot in CompanySnapshotFlags.objects.filter(company_id__in=ids)
+            .order_by("company_id", "-revision_id")
+            .distinct("company_id")
+            .nocache()
+        }
+
+        return [
+            company.build_document(
+                records[company.pk], persons[company.pk], snapshots.get(company.pk)
+            )
+            for company in companies
+        ]
+
+    def build_document(self, records, persons, snapshot):
+        """
+        Document of the company for elasticsearch
+
+        :param records: records of the company
+        :param persons: persons of the company
+        :param snapshot: latest snapshot of flags or None
+        :rtype: dict
+        """
         addresses = set()
-        persons = set()
         all_persons = set()
         names_autocomplete = set()
         companies = set()
@@ -560,11 +858,7 @@ class Company(models.Model):
 
         latest_record = None
         latest_revision = 0
-        for company_record in (
-            self.records.all()
-            .defer("company_hash", "location_parsing_quality")
-            .nocache()
-        ):
+        for company_record in records:
             addresses.add(company_record.location)
             addresses.add(company_record.parsed_location)
             addresses.add(company_record.validated_location)
@@ -593,11 +887,10 @@ class Company(models.Model):
                     "Cannot find revisions for the CompanyRecord {}".format(self.pk)
                 )
 
-        for person in (
-            self.persons.all().defer("tokenized_record", "share", "revisions").nocache()
-        ):
+        raw_persons = set()
+        for person in persons:
             for name in person.name:
-                persons.add((name, person.get_person_type_display()))
+                raw_persons.add((name, person.get_person_type_display()))
 
                 for addr in person.address:
                     addresses.add(addr)
@@ -607,19 +900,18 @@ class Company(models.Model):
 
             raw_records.add(person.raw_record)
 
-        snapshot = self.snapshot_stats.order_by("-revision_id").first()
         flags = None
         if snapshot:
             flags = snapshot.to_dict()
 
-        for name, position in persons:
-            all_persons |= parse_and_generate(name, position)
-            names_autocomplete |= autocomplete_suggestions(name)
+        for name, position in raw_persons:
+            all_persons |= cached_parse_and_generate(name, position)
+            names_autocomplete |= cached_autocomplete_suggestions(name)
 
         return {
             "full_edrpou": self.full_edrpou,
             "addresses": list(filter(None, addresses)),
-            "raw_persons": list(filter(None, persons)),
+            "raw_persons": list(filter(None, raw_persons)),
             "persons": list(filter(None, all_persons)),
             "companies": list(filter(None, companies)),
             "company_profiles": list(filter(None, company_profiles)),
@@ -630,6 +922,9 @@ class Company(models.Model):
         }
 
     def group_revisions(self, revisions, records, hash_field_getter):
+        # Reference implementation, that hashes records of every revision
+        # of the timeline. tools.intervals.group_by_intervals returns the
+        # same groups
         periods = []
         current_record = None
 
@@ -685,7 +980,132 @@ class Company(models.Model):
         except ValueError:
             return -len(self.status_order)
 
+    @staticmethod
+    def get_global_revisions():
+        return revision_registry.ordered()
+
     def get_grouped_record(self, persons_filter_clause=models.Q(bo_is_absent=False)):
+        return self.group_records(
+            self.get_global_revisions(),
+            self.records.iterator(),
+            self.persons.filter(persons_filter_clause).iterator(),
+        )
+
+    @classmethod
+    def get_grouped_records(
+        cls,
+        companies,
+        persons_filter_clause=models.Q(bo_is_absent=False),
+        global_revisions=None,
+    ):
+        """
+        Bulk version of get_grouped_record: revisions, records and persons of
+        all the companies are retrieved at once
+
+        :param companies: companies to group records for
+        :type companies: list
+        :returns: results of get_grouped_record by company id
+        :rtype: dict
+        """
+        if global_revisions is None:
+            global_revisions = cls.get_global_revisions()
+
+        ids = [company.pk for company in companies]
+
+        records = defaultdict(list)
+        for rec in CompanyRecord.objects.filter(company_id__in=ids).nocache().iterator():
+            records[rec.company_id].append(rec)
+
+        persons = defaultdict(list)
+        for p in (
+            Person.objects.filter(company_id__in=ids)
+            .filter(persons_filter_clause)
+            .nocache()
+            .iterator()
+        ):
+            persons[p.company_id].append(p)
+
+        return {
+            company.pk: company.group_records(
+                global_revisions, records[company.pk], persons[company.pk]
+            )
+            for company in companies
+        }
+
+    @staticmethod
+    def get_changed_between(revision, previous):
+        """
+        Companies that have records or persons present in only one of two
+        revisions
+        """
+        changed = set()
+        for model in [CompanyRecord, Person]:
+            for a, b in [(revision, previous), (previous, revision)]:
+                changed.update(
+                    model.objects.present_in(a)
+                    .not_present_in(b)
+                    .values_list("company_id", flat=True)
+                    .nocache()
+                    .iterator()
+                )
+
+        return changed
+
+    @classmethod
+    def rebuild_history(cls, company_ids, global_revisions=None):
+        """
+        Recalculates cached history (see CompanyHistory) for the chunk of
+        companies
+
+        :returns: number of written histories
+        :rtype: int
+        """
+        companies = list(cls.objects.filter(pk__in=company_ids).order_by("pk").nocache())
+        grouped = cls.get_grouped_records(companies, global_revisions=global_revisions)
+
+        with transaction.atomic():
+            CompanyHistory.objects.filter(
+                company_id__in=[company.pk for company in companies]
+            ).delete()
+            CompanyHistory.objects.bulk_create(
+                [
+                    CompanyHistory(
+                        company=company,
+                        data=CompanyHistory.pack(grouped[company.pk]),
+                        timeline_fingerprint=CompanyHistory.fingerprint(
+                            list(grouped[company.pk]["global_revisions"].keys())
+                        ),
+                    )
+                    for company in companies
+                ],
+                batch_size=100,
+            )
+
+        return len(companies)
+
+    @classmethod
+    def mark_dirty(cls, company_ids, chunk_size=1000):
+        """
+        Marks companies which data was changed by loaders: is_dirty makes the
+        next reindex rebuild their documents and cached history, flags_dirty
+        makes the next incremental snapshot recalculate their flags (it's
+        a separate mark, as reindex clears is_dirty on its own schedule)
+
+        :param company_ids: ids of changed companies
+        :type company_ids: collections.Iterable[int]
+        """
+        company_ids = list(company_ids)
+
+        for i in range(0, len(company_ids), chunk_size):
+            cls.objects.filter(pk__in=company_ids[i:i + chunk_size]).update(
+                is_dirty=True, flags_dirty=True, last_modified=timezone.now()
+            )
+
+    def group_records(self, global_revisions, records, persons):
+        """
+        Groups records and persons of the company by periods of revisions
+        they were unchanged in (see get_grouped_record)
+        """
         used_revisions = set()
         latest_record = None
         latest_record_revision = 0
@@ -693,14 +1113,6 @@ class Company(models.Model):
 
         latest_persons = []
         latest_persons_revision = 0
-        global_revisions = OrderedDict(
-            [
-                (r.pk, r)
-                for r in Revision.objects.filter(imported=True, ignore=False).order_by(
-                    "created"
-                )
-            ]
-        )
 
         extra_details = {
             "charter_capital": None,
@@ -712,7 +1124,9 @@ class Company(models.Model):
             "fax": None,
         }
 
-        for rec in self.records.iterator():
+        records_members = []
+        for rec in records:
+            records_members.append(rec.revisions)
             for r in rec.revisions:
                 if r in records_revisions:
                     records_revisions[r].append(rec)
@@ -737,7 +1151,9 @@ class Company(models.Model):
             )
 
         persons_revisions = defaultdict(set)
-        for p in self.persons.filter(persons_filter_clause).iterator():
+        persons_members = []
+        for p in persons:
+            persons_members.append(p.revisions)
             max_revision = max(p.revisions)
             for r in p.revisions:
                 persons_revisions[r].add(p)
@@ -750,29 +1166,22 @@ class Company(models.Model):
 
             used_revisions |= set(p.revisions)
 
-        def hash_for_persons(records):
-            return tuple(sorted(r.person_hash for r in records))
-
-        def hash_for_companies(records):
-            return tuple(sorted(r.company_hash for r in records))
-
         return {
             "global_revisions": global_revisions,
             "used_revisions": sorted(used_revisions),
             "extra_details": extra_details,
             "latest_record": latest_record,
             "latest_record_revision": latest_record_revision,
-            "grouped_company_records": self.group_revisions(
-                global_revisions,
-                records_revisions,
-                hash_field_getter=hash_for_companies,
+            "grouped_company_records": group_by_intervals(
+                global_revisions, records_revisions, records_members
             ),
-            "grouped_persons_records": self.group_revisions(
-                global_revisions, persons_revisions, hash_field_getter=hash_for_persons
+            "grouped_persons_records": group_by_intervals(
+                global_revisions, persons_revisions, persons_members
             ),
             "latest_persons": latest_persons,
             "latest_persons_revision": latest_persons_revision,
             "records_revisions": records_revisions,
+            "persons_revisions": persons_revisions,
         }
 
     class Meta:
@@ -780,12 +1189,64 @@ class Company(models.Model):
         verbose_name_plural = "Companies"
 
 
-class CompanyRecordManager(models.Manager):
+class RevisionsQuerySet(models.QuerySet):
+    """
+    Queryset of the records which keep the list of revisions they are
+    present in. Revisions arrays are covered by GIN index, so
+    lookups by revision are served by it
+    """
+
+    def present_in(self, revision):
+        """
+        :param revision: revision or it's id
+        """
+        return self.filter(revisions__contains=[getattr(revision, "pk", revision)])
+
+    def not_present_in(self, revision):
+        """
+        :param revision: revision or it's id
+        """
+        return self.exclude(revisions__contains=[getattr(revision, "pk", revision)])
+
+
+class CompanyRecordManager(models.Manager.from_queryset(RevisionsQuerySet)):
     def mass_registration_addresses(self, revision=None, cutoff=100):
+        """
+        Addresses of mass registration for the revision and number of
+        records with them, most popular first. Served from the materialised
+        MassRegistrationAddress table, which is calculated on the first
+        request if it's missing or outdated
+
+        :param revision: revision or it's id (latest revision by default)
+        """
         if revision is None:
-            revision = Revision.objects.order_by("-created").first().pk
+            revision = revision_registry.latest().pk
 
-        qs = self.filter(revisions__contains=[revision])
+        revision_id = getattr(revision, "pk", revision)
+
+        if cutoff < MassRegistrationAddress.MIN_COUNT:
+            return self.group_mass_registration_addresses(revision_id, cutoff)
+
+        if not Revision.objects.filter(
+            pk=revision_id, mass_registration_calculated=True
+        ).nocache().exists():
+            MassRegistrationAddress.materialize(revision_id)
+
+        return OrderedDict(
+            MassRegistrationAddress.objects.filter(
+                revision_id=revision_id, company_count__gte=cutoff
+            )
+            .order_by("-company_count")
+            .values_list("address", "company_count")
+            .nocache()
+        )
+
+    def group_mass_registration_addresses(self, revision, cutoff=100):
+        """
+        Same as mass_registration_addresses, but calculated on the fly over
+        all the records of the revision
+        """
+        qs = self.present_in(revision)
 
         return OrderedDict(
             (rec["shortened_validated_location"], rec["addr_count"])
@@ -943,6 +1404,7 @@ class CompanyRecord(models.Model):
 
     class Meta:
         index_together = ("company", "company_hash")
+        indexes = [GinIndex(fields=["revisions"], name="companies_rec_revisions_gin")]
 
 
 class Person(models.Model):
@@ -975,6 +1437,11 @@ class Person(models.Model):
         verbose_name="В реєстрі було прямо вказано, що бенефіціар відсутній",
     )
 
+    objects = RevisionsQuerySet.as_manager()
+
+    class Meta:
+        indexes = [GinIndex(fields=["revisions"], name="companies_per_revisions_gin")]
+
 
 class CompanySnapshotFlags(models.Model):
     company = models.ForeignKey(
@@ -1130,6 +1597,231 @@ class CompanySnapshotFlags(models.Model):
         return dct
 
 
+class CompanyHistory(models.Model):
+    """
+    Grouped history of the company (result of get_grouped_record) packed
+    into JSON, so CompanyDetail doesn't need to retrieve and group all the
+    records and persons of the company.
+
+    It's rebuilt by reindex for companies that were changed. When
+    revisions are appended to the timeline and the history of the company
+    wasn't changed by them, the packed history is simply extended to the
+    latest revision. Any other change of the timeline (e.g. revision in
+    the middle of it was ignored or deleted) is detected by the fingerprint
+    of the timeline the history was packed for, and all the histories are
+    rebuilt then
+    """
+
+    VERSION = 1
+
+    # Fields of records and persons that CompanyDetail shows
+    RECORD_FIELDS = [
+        "company_hash",
+        "name",
+        "short_name",
+        "location",
+        "company_profile",
+        "status",
+    ]
+    PERSON_FIELDS = [
+        "person_hash",
+        "name",
+        "person_type",
+        "address",
+        "country",
+        "raw_record",
+    ]
+
+    company = models.OneToOneField(
+        Company,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        verbose_name="Компанія",
+        related_name="history",
+    )
+    data = JSONField(encoder=DjangoJSONEncoder, verbose_name="Історія змін")
+    timeline_fingerprint = models.CharField(
+        "Відбиток ревізій історії", max_length=40, db_index=True, default=""
+    )
+
+    @staticmethod
+    def prefix_fingerprints(timeline):
+        """
+        Fingerprints of all the prefixes of the timeline (from the empty one
+        to the whole timeline). Fingerprint is the chain of sha1 over ids of
+        revisions, so all of them are calculated in one pass
+
+        :param timeline: ids of revisions, oldest first
+        :type timeline: list
+        :rtype: list
+        """
+        fingerprints = [sha1(b"timeline").hexdigest()]
+
+        for revision_id in timeline:
+            fingerprints.append(
+                sha1("{}:{}".format(fingerprints[-1], revision_id).encode()).hexdigest()
+            )
+
+        return fingerprints
+
+    @classmethod
+    def fingerprint(cls, timeline):
+        return cls.prefix_fingerprints(timeline)[-1]
+
+    @classmethod
+    def pack(cls, grouped):
+        """
+        :param grouped: result of get_grouped_record
+        :type grouped: dict
+        :rtype: dict
+        """
+        objects = {"records": {}, "persons": {}}
+
+        def pack_object(kind, fields, obj):
+            if obj.pk not in objects[kind]:
+                objects[kind][obj.pk] = {f: getattr(obj, f) for f in fields}
+            return obj.pk
+
+        def pack_groups(kind, fields, groups):
+            return [
+                [
+                    group["start_revision"].pk,
+                    group["finish_revision"].pk,
+                    [pack_object(kind, fields, obj) for obj in group["record"]],
+                ]
+                for group in groups
+            ]
+
+        timeline = list(grouped["global_revisions"].keys())
+        last = timeline[-1] if timeline else None
+
+        return {
+            "version": cls.VERSION,
+            "timeline": timeline,
+            "grouped_company_records": pack_groups(
+                "records", cls.RECORD_FIELDS, grouped["grouped_company_records"]
+            ),
+            "grouped_persons_records": pack_groups(
+                "persons", cls.PERSON_FIELDS, grouped["grouped_persons_records"]
+            ),
+            "latest_record": pack_object("records", cls.RECORD_FIELDS, grouped["latest_record"])
+            if grouped["latest_record"] is not None
+            else None,
+            "latest_record_revision": grouped["latest_record_revision"],
+            "latest_persons": [
+                pack_object("persons", cls.PERSON_FIELDS, p) for p in grouped["latest_persons"]
+            ],
+            "latest_persons_revision": grouped["latest_persons_revision"],
+            "used_revisions": grouped["used_revisions"],
+            "extra_details": grouped["extra_details"],
+            "records_present": last in grouped["records_revisions"],
+            "persons_present": last in grouped["persons_revisions"],
+            "records": objects["records"],
+            "persons": objects["persons"],
+        }
+
+    def unpack(self):
+        """
+        Restores the result of get_grouped_record (without records_revisions
+        and persons_revisions) for the current timeline of revisions
+
+        :returns: grouped history or None if it's outdated
+        :rtype: dict
+        """
+        data = self.data
+        if data.get("version") != self.VERSION:
+            return None
+
+        global_revisions = revision_registry.ordered()
+        timeline = list(global_revisions.keys())
+        packed_timeline = data["timeline"]
+
+        # Only new revisions might be added to the timeline since the history
+        # was packed, and all of them should be processed by rebuild
+        if timeline[: len(packed_timeline)] != packed_timeline:
+            return None
+
+        appended = timeline[len(packed_timeline):]
+        if not all(global_revisions[pk].history_calculated for pk in appended):
+            return None
+
+        def restore(model, values):
+            obj = model(
+                **{
+                    name: model._meta.get_field(name).to_python(value)
+                    for name, value in values.items()
+                }
+            )
+            obj.company = self.company
+            return obj
+
+        records = {
+            pk: restore(CompanyRecord, values) for pk, values in data["records"].items()
+        }
+        persons = {pk: restore(Person, values) for pk, values in data["persons"].items()}
+
+        def unpack_groups(groups, objects, container):
+            return [
+                {
+                    "start_revision": global_revisions[start],
+                    "finish_revision": global_revisions[finish],
+                    "record": container(objects[pk] for pk in pks),
+                }
+                for start, finish, pks in groups
+            ]
+
+        grouped = {
+            "global_revisions": global_revisions,
+            "used_revisions": data["used_revisions"],
+            "extra_details": {
+                k: CompanyRecord._meta.get_field(k).to_python(v)
+                for k, v in data["extra_details"].items()
+            },
+            "latest_record": records[data["latest_record"]]
+            if data["latest_record"] is not None
+            else None,
+            "latest_record_revision": data["latest_record_revision"],
+            "grouped_company_records": unpack_groups(
+                data["grouped_company_records"], records, list
+            ),
+            "grouped_persons_records": unpack_groups(
+                data["grouped_persons_records"], persons, set
+            ),
+            "latest_persons": [persons[pk] for pk in data["latest_persons"]],
+            "latest_persons_revision": data["latest_persons_revision"],
+        }
+
+        if appended and packed_timeline:
+            # Records and persons of the company are the same in all the
+            # appended revisions as in the last packed one
+            last, new_last = packed_timeline[-1], appended[-1]
+
+            for key, present in [
+                ("grouped_company_records", data["records_present"]),
+                ("grouped_persons_records", data["persons_present"]),
+            ]:
+                groups = grouped[key]
+                if not groups:
+                    continue
+
+                if present:
+                    groups[-1]["finish_revision"] = global_revisions[new_last]
+                else:
+                    # That's the extra group group_revisions adds in the end
+                    # for the record that disappeared
+                    groups[-1]["start_revision"] = global_revisions[new_last]
+                    groups[-1]["finish_revision"] = global_revisions[new_last]
+
+            for key in ["latest_record_revision", "latest_persons_revision"]:
+                if grouped[key] == last:
+                    grouped[key] = new_last
+
+            if data["records_present"] or data["persons_present"]:
+                grouped["used_revisions"] = sorted(set(grouped["used_revisions"]) | set(appended))
+
+        return grouped
+
+
 class PEPOwner(models.Model):
     years = ArrayField(
         models.IntegerField(),
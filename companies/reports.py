@@ -33,6 +33,7 @@ class GlobalStats:
         owner_format = outfile.add_format({"color": "green"})
         founder_format = outfile.add_format({"color": "blue"})
         rev = GlobalStats.latest_revision()
+        global_revisions = Company.get_global_revisions()
         curr_line += 1
 
         if not isinstance(ids, dict):
@@ -46,24 +47,47 @@ class GlobalStats:
                     )
                     curr_line += 1
 
-                for company_edrpou in values:
-                    pbar.update(1)
-                    try:
-                        curr_line += 1
+                values = list(values)
+                for i in range(0, len(values), 500):
+                    batch = []
+                    for company_edrpou in values[i:i + 500]:
                         if isinstance(company_edrpou, Company):
-                            company = company_edrpou
-                            company_edrpou = company.pk
+                            batch.append((company_edrpou.pk, company_edrpou))
                         else:
-                            company_edrpou = int(company_edrpou.strip().lstrip("0"))
-                            company = Company.objects.get(pk=company_edrpou)
+                            batch.append((int(company_edrpou.strip().lstrip("0")), None))
 
-                        latest_company_rec = CompanyRecord.objects.filter(
-                            company_id=int(company_edrpou), revisions__contains=[rev.pk]
+                    found = Company.objects.in_bulk(
+                        [company_edrpou for company_edrpou, company in batch if company is None]
+                    )
+                    batch = [
+                        (company_edrpou, company or found.get(company_edrpou))
+                        for company_edrpou, company in batch
+                    ]
+
+                    # Owners and founders of the whole batch are retrieved at once
+                    grouped = Company.get_grouped_records(
+                        [company for _, company in batch if company is not None],
+                        persons_filter_clause=models.Q(
+                            person_type__in=["owner", "founder"]
+                        ),
+                        global_revisions=global_revisions,
+                    )
+
+                    for company_edrpou, company in batch:
+                        pbar.update(1)
+                        curr_line += 1
+
+                        if company is None:
+                            worksheet.write(curr_line, 0, company_edrpou)
+                            worksheet.write(curr_line, 1, "Компанію не знайдено")
+                            continue
+
+                        latest_company_rec = CompanyRecord.objects.present_in(rev).filter(
+                            company_id=int(company_edrpou)
                         ).first()
 
-                        latest_founder_recs = Person.objects.filter(
+                        latest_founder_recs = Person.objects.present_in(rev).filter(
                             company_id=int(company_edrpou),
-                            revisions__contains=[rev.pk],
                             person_type="founder",
                         ).values_list("name", flat=True)
 
@@ -80,11 +104,7 @@ class GlobalStats:
                             string=str(company_edrpou).rjust(8, "0"),
                         )
 
-                        grouped_records = company.get_grouped_record(
-                            persons_filter_clause=models.Q(
-                                person_type__in=["owner", "founder"]
-                            )
-                        )["grouped_persons_records"]
+                        grouped_records = grouped[company.pk]["grouped_persons_records"]
 
                         if latest_company_rec is not None:
                             worksheet.write(
@@ -153,15 +173,11 @@ class GlobalStats:
 
                             curr_line -= 1
 
-                    except Company.DoesNotExist:
-                        worksheet.write(curr_line, 0, company_edrpou)
-                        worksheet.write(curr_line, 1, "Компанію не знайдено")
-
         outfile.close()
 
     @staticmethod
     def latest_revision():
-        return Revision.objects.order_by("-created").first()
+        return revision_registry.latest()
 
     def pick_sample(self, ids, number_of_samples=1000):
         sample = list(ids)
@@ -193,9 +209,8 @@ class GlobalStats:
 
     def all_companies_with_founder_persons(self):
         return set(
-            Person.objects.filter(
+            Person.objects.present_in(self.latest_revision()).filter(
                 person_type="founder",
-                revisions__contains=[self.latest_revision().pk],
                 name__len__gt=0,
             )
             .values_list("company", flat=True)
@@ -204,9 +219,8 @@ class GlobalStats:
 
     def all_companies_with_founder_company(self):
         return set(
-            Person.objects.filter(
+            Person.objects.present_in(self.latest_revision()).filter(
                 person_type="founder",
-                revisions__contains=[self.latest_revision().pk],
                 name__len=0,
             )
             .values_list("company", flat=True)
@@ -300,8 +314,8 @@ class GlobalStats:
 
     def all_companies_with_same_bo(self):
         return set(
-            Person.objects.filter(
-                person_type="owner", revisions__contains=[self.latest_revision()]
+            Person.objects.present_in(self.latest_revision()).filter(
+                person_type="owner"
             )
             .values("name")
             .annotate(cnt=Count("name"))
@@ -321,8 +335,8 @@ class GlobalStats:
 
     def all_companies_with_british_founders(self):
         return set(
-            Person.objects.filter(
-                person_type="founder", revisions__contains=[self.latest_revision().pk]
+            Person.objects.present_in(self.latest_revision()).filter(
+                person_type="founder"
             )
             .filter(
                 Q(raw_record__icontains="СПОЛУЧЕНЕ КОРОЛІВСТВО")
@@ -338,8 +352,8 @@ class GlobalStats:
 
     def all_companies_with_british_bo(self):
         return set(
-            Person.objects.filter(
-                person_type="owner", revisions__contains=[self.latest_revision().pk]
+            Person.objects.present_in(self.latest_revision()).filter(
+                person_type="owner"
             )
             .filter(
                 Q(raw_record__icontains="СПОЛУЧЕНЕ КОРОЛІВСТВО")
@@ -612,8 +626,8 @@ class GlobalStats:
         rev = self.latest_revision()
 
         for p in (
-            Person.objects.filter(
-                person_type="owner", revisions__contains=[rev.pk], name__len__gt=0
+            Person.objects.present_in(rev).filter(
+                person_type="owner", name__len__gt=0
             )
             .values("name")
             .annotate(cnt=Count("name"))
@@ -641,8 +655,8 @@ class GlobalStats:
         rev = self.latest_revision()
 
         for p in (
-            Person.objects.filter(
-                person_type="owner", revisions__contains=[rev.pk], name__len__gt=0
+            Person.objects.present_in(rev).filter(
+                person_type="owner", name__len__gt=0
             )
             .filter(
                 Q(country__contains=["кіпр"]) | Q(country__contains=["республіка кіпр"]) | Q(raw_record__icontains="кіпр")
@@ -702,8 +716,8 @@ class GlobalStats:
 
         for addr in mra:
             ids = set(
-                CompanyRecord.objects.filter(
-                    revisions__contains=[rev.pk], shortened_validated_location=addr
+                CompanyRecord.objects.present_in(rev).filter(
+                    shortened_validated_location=addr
                 ).values_list("company_id", flat=True)
             )
 
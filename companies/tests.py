@@ -1,3 +1,767 @@
-from django.test import TestCase
+import os
+import time
+import random
+import tempfile
+from io import BytesIO
+from zipfile import ZipFile
+from types import SimpleNamespace
+from xml.sax.saxutils import escape
+from copy import deepcopy
+from datetime import datetime
+from unittest.mock import patch
 
-# Create your tests here.
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.utils import timezone
+
+from companies.models import (
+    Revision,
+    Company,
+    CompanyRecord,
+    Person,
+    MassRegistrationAddress,
+    CompanySnapshotFlags,
+    PEPOwner,
+    SelfOwned,
+    OwnedByCompany,
+    CompanyHistory,
+)
+from companies.tools.keys import make_company_key, make_company_keys, make_person_key, make_person_keys
+from companies.management.commands import load_companies, load_companies_from_api
+
+
+class ImportCrashed(Exception):
+    pass
+
+
+class LoadCompaniesResumeTests(TestCase):
+    """
+    Import of the revision which is interrupted at random points and resumed
+    from the last checkpoint must end up with exactly the same data as the
+    uninterrupted one
+    """
+
+    GUID = "73cfe78e-89ef-4f06-b3ab-eb5f16aea237"
+    NUM_LINES = 80
+    NUM_TRIALS = 5
+
+    def make_lines(self, revision_id):
+        """
+        Synthetic parsed lines of the dump: some companies have more than one
+        line, some lines are broken and some records are changed in the
+        second revision
+        """
+        lines = []
+        for position in range(1, self.NUM_LINES + 1):
+            edrpou = 1000 + position % 30
+
+            if position % 17 == 0:
+                edrpou = 0
+
+            name = "ТОВ Компанія {}".format(edrpou)
+            if revision_id > 1 and position % 5 == 0:
+                name += " нова"
+
+            company_line = {
+                "edrpou": edrpou,
+                "name": name,
+                "short_name": "ТОВ {}".format(edrpou),
+                "location": "м. Київ, вул. Хрещатик, {}".format(position % 7),
+                "company_profile": "",
+                "status": "зареєстровано",
+                "head": "Директор {}".format(position % 11) if position % 3 else "",
+            }
+
+            founders = [
+                {
+                    "raw_record": "Засновник {} {}".format(edrpou, i),
+                    "Is beneficial owner": i == 0,
+                    "Name": ["Засновник {}".format(i)],
+                    "Address of residence": ["Україна"],
+                    "Country of residence": ["Україна"],
+                    "BO is absent": False,
+                }
+                for i in range(position % 4)
+            ]
+
+            lines.append((position, company_line, founders))
+
+        return lines
+
+    def make_command(self, lines, crash_at=None):
+        command = load_companies.Command()
+        command.checkpoint_every = 7
+        command.batch_size = 5
+        command.resume = True
+        command.delta = False
+        command.parser_profile = "test.yaml"
+        command.num_workers = 1
+        command.founder_parser = None
+
+        def iter_parsed_lines(reader, skip=0, known=None, chunk_size=100):
+            command.cache_hits = command.cache_misses = 0
+
+            for position, company_line, founders in lines[skip:]:
+                if position == crash_at:
+                    raise ImportCrashed()
+
+                yield position, deepcopy(company_line), deepcopy(founders), None
+
+        command.iter_parsed_lines = iter_parsed_lines
+        return command
+
+    def load_revision(self, revision_id, crash_at=None, crash_on_write=None):
+        command = self.make_command(self.make_lines(revision_id), crash_at)
+        writes = []
+
+        def copy_insert(model, objs):
+            writes.append(model)
+            if len(writes) == crash_on_write:
+                raise ImportCrashed()
+
+            return real_copy_insert(model, objs)
+
+        real_copy_insert = load_companies.copy_insert
+        with patch.object(load_companies, "copy_insert", copy_insert):
+            command.load_file(
+                BytesIO(),
+                self.GUID,
+                revision_id,
+                timezone.make_aware(datetime(2020, 1, revision_id)),
+                False,
+                ext="xml",
+            )
+
+    def load_revision_with_crashes(self, revision_id, rnd):
+        for _ in range(20):
+            crash_at = rnd.randint(1, self.NUM_LINES + 1)
+            crash_on_write = rnd.choice([None, rnd.randint(1, 30)])
+
+            try:
+                self.load_revision(revision_id, crash_at, crash_on_write)
+            except ImportCrashed:
+                continue
+
+            break
+        else:
+            self.load_revision(revision_id)
+
+    def snapshot(self):
+        return (
+            sorted(Company.objects.nocache().values_list("pk", "is_dirty")),
+            sorted(
+                (r.company_hash, r.company_id, r.name, r.location, sorted(r.revisions))
+                for r in CompanyRecord.objects.nocache()
+            ),
+            sorted(
+                (p.person_hash, p.company_id, p.person_type, sorted(p.name), sorted(p.revisions))
+                for p in Person.objects.nocache()
+            ),
+        )
+
+    def wipe(self):
+        Person.objects.all().delete()
+        CompanyRecord.objects.all().delete()
+        Company.objects.all().delete()
+        MassRegistrationAddress.objects.all().delete()
+        Revision.objects.all().delete()
+
+    def test_resumed_import_is_the_same_as_uninterrupted(self):
+        self.load_revision(1)
+        self.load_revision(2)
+        expected = self.snapshot()
+
+        for seed in range(self.NUM_TRIALS):
+            rnd = random.Random(seed)
+            self.wipe()
+
+            self.load_revision_with_crashes(1, rnd)
+            self.load_revision_with_crashes(2, rnd)
+
+            self.assertEqual(self.snapshot(), expected, "trial with seed {}".format(seed))
+
+    def test_checkpoint_is_reset_after_import(self):
+        with self.assertRaises(ImportCrashed):
+            self.load_revision(1, crash_at=self.NUM_LINES // 2)
+
+        self.assertGreater(Revision.objects.get(pk=1).checkpoint, 0)
+        self.assertFalse(Revision.objects.get(pk=1).imported)
+
+        self.load_revision(1)
+
+        revision = Revision.objects.get(pk=1)
+        self.assertTrue(revision.imported)
+        self.assertEqual(revision.checkpoint, 0)
+
+
+class StubFounderParser(object):
+    """
+    Stands for the pipeline: every founder record of the line is taken as
+    the founder with the same name
+    """
+
+    def __init__(self):
+        self.cache = SimpleNamespace(hits=0, misses=0)
+
+    def parse_many(self, company_lines):
+        return [
+            [
+                {
+                    "raw_record": founder,
+                    "Is beneficial owner": False,
+                    "Name": [founder],
+                    "Address of residence": [],
+                    "Country of residence": [],
+                    "BO is absent": False,
+                }
+                for founder in company_line["founders"]
+            ]
+            for company_line in company_lines
+        ]
+
+
+class EDRReaderResumeTests(TestCase):
+    """
+    Import of the real XML dump with broken records, which is interrupted
+    and resumed through EDR_Reader.iter_docs_with_positions(skip=...)
+    """
+
+    NUM_RECORDS = 60
+    # Records which are cut in the middle and can't be parsed
+    BROKEN = {7, 23, 24, 41}
+
+    def make_records(self, offset=0):
+        records = []
+        for i in range(offset, offset + self.NUM_RECORDS):
+            if i in self.BROKEN:
+                records.append("<RECORD><NAME>Обрізаний запис {}<EDRPOU></RECORD>".format(i))
+                continue
+
+            records.append(
+                "<RECORD><NAME>{name}</NAME><SHORT_NAME>{short_name}</SHORT_NAME>"
+                "<EDRPOU>{edrpou}</EDRPOU><ADDRESS>{address}</ADDRESS><BOSS>{head}</BOSS>"
+                "<KVED></KVED><STAN>зареєстровано</STAN>"
+                "<FOUNDERS>{founders}</FOUNDERS></RECORD>".format(
+                    name=escape("ТОВ \"Компанія {}\"".format(i)),
+                    short_name="ТОВ {}".format(i),
+                    edrpou=str(2000 + i).rjust(8, "0"),
+                    address="м. Київ, вул. Хрещатик, {}".format(i % 5),
+                    head="Директор {}".format(i % 9),
+                    founders="".join(
+                        "<FOUNDER>Засновник {} {}</FOUNDER>".format(i, j) for j in range(i % 3)
+                    ),
+                )
+            )
+
+        return records
+
+    def make_xml(self, records):
+        return (
+            '<?xml version="1.0" encoding="windows-1251"?><DATA>{}</DATA>'.format(
+                "\n".join(records)
+            ).encode("cp1251")
+        )
+
+    def make_zip(self, *members):
+        buf = BytesIO()
+        with ZipFile(buf, "w") as zip_arch:
+            for i, records in enumerate(members):
+                zip_arch.writestr("{}_uo.xml".format(i), self.make_xml(records))
+
+        return buf.getvalue()
+
+    def read(self, dump, file_type, skip=0):
+        reader = load_companies.EDR_Reader(BytesIO(dump), None, None, file_type)
+        return [
+            (position, company["edrpou"], company["name"], company["founders"])
+            for position, company in reader.iter_docs_with_positions(skip)
+        ]
+
+    def test_positions_count_broken_records(self):
+        docs = self.read(self.make_xml(self.make_records()), "xml")
+
+        self.assertEqual(len(docs), self.NUM_RECORDS - len(self.BROKEN))
+        self.assertEqual(
+            [position for position, _, _, _ in docs],
+            [i + 1 for i in range(self.NUM_RECORDS) if i not in self.BROKEN],
+        )
+
+    def test_resumed_reading_has_no_duplicates_or_gaps(self):
+        dumps = [
+            (self.make_xml(self.make_records()), "xml"),
+            # Skip crosses the boundary between two members of the archive
+            (self.make_zip(self.make_records(), self.make_records(self.NUM_RECORDS)), "zip"),
+        ]
+
+        for dump, file_type in dumps:
+            full = self.read(dump, file_type)
+
+            for skip in range(0, 2 * self.NUM_RECORDS + 2):
+                # Positions are the same as in the full read, so the
+                # checkpoint taken in the resumed run is still valid
+                self.assertEqual(
+                    self.read(dump, file_type, skip),
+                    [doc for doc in full if doc[0] > skip],
+                    "{} skip {}".format(file_type, skip),
+                )
+
+    def load(self, dump, crash_on_line=None):
+        command = load_companies.Command()
+        command.checkpoint_every = 7
+        command.batch_size = 5
+        command.resume = True
+        command.delta = False
+        command.parser_profile = "test.yaml"
+        command.num_workers = 1
+        command.founder_parser = StubFounderParser()
+
+        lines = []
+
+        def make_key_for_company(company):
+            lines.append(company["edrpou"])
+            if len(lines) == crash_on_line:
+                raise ImportCrashed()
+
+            return load_companies.make_company_key(company)
+
+        command.make_key_for_company = make_key_for_company
+
+        command.load_file(
+            BytesIO(dump),
+            LoadCompaniesResumeTests.GUID,
+            1,
+            timezone.make_aware(datetime(2020, 1, 1)),
+            False,
+            ext="xml",
+        )
+
+        return lines
+
+    def snapshot(self):
+        return (
+            sorted(
+                (r.company_id, r.name, sorted(r.revisions))
+                for r in CompanyRecord.objects.nocache()
+            ),
+            sorted(
+                (p.company_id, p.person_type, p.raw_record, sorted(p.revisions))
+                for p in Person.objects.nocache()
+            ),
+        )
+
+    def test_import_resumed_from_the_middle_of_file(self):
+        dump = self.make_xml(self.make_records())
+        num_valid = self.NUM_RECORDS - len(self.BROKEN)
+
+        self.assertEqual(len(self.load(dump)), num_valid)
+        expected = self.snapshot()
+        self.assertEqual(len(expected[0]), num_valid)
+
+        rnd = random.Random(1337)
+        for _ in range(5):
+            Company.objects.all().delete()
+            Revision.objects.all().delete()
+
+            crash_on_line = rnd.randint(1, num_valid)
+            with self.assertRaises(ImportCrashed):
+                self.load(dump, crash_on_line)
+
+            checkpoint = Revision.objects.get(pk=1).checkpoint
+            resumed = self.load(dump)
+
+            # Only lines after the checkpoint are read again
+            self.assertEqual(
+                len(resumed),
+                len([i for i in range(checkpoint, self.NUM_RECORDS) if i not in self.BROKEN]),
+            )
+            self.assertEqual(self.snapshot(), expected, "crash on line {}".format(crash_on_line))
+
+
+class StubbedDump(object):
+    """
+    Response of requests.get(..., stream=True) which slowly streams the dump
+    """
+
+    def __init__(self, num_chunks=5, delay=0.02):
+        self.chunks = [b"x" * 1024] * num_chunks
+        self.delay = delay
+
+    @property
+    def raw(self):
+        return self
+
+    def read(self, size=-1):
+        time.sleep(self.delay)
+        return self.chunks.pop() if self.chunks else b""
+
+
+class BackfillTests(SimpleTestCase):
+    """
+    Backfill with downloads stubbed by slow local streams
+    """
+
+    NUM_REVISIONS = 8
+
+    def setUp(self):
+        self.storage = tempfile.TemporaryDirectory()
+        self.addCleanup(self.storage.cleanup)
+
+        settings_override = override_settings(DATA_STORAGE_PATH=self.storage.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.downloads = []
+
+        def get(url, stream=False):
+            self.downloads.append(url)
+            return StubbedDump()
+
+        requests_patch = patch.object(load_companies_from_api.requests, "get", get)
+        requests_patch.start()
+        self.addCleanup(requests_patch.stop)
+
+        self.jobs = [
+            (datetime(2020, 1, i + 1), "https://data.gov.ua/dump{}.zip".format(i), "rev{}".format(i))
+            for i in range(self.NUM_REVISIONS)
+        ]
+
+    def make_command(self, fail_on=None):
+        command = load_companies_from_api.Command()
+        command.download_pause = 0
+        command.imported = []
+        command.max_on_disk = 0
+
+        def count_dumps():
+            command.max_on_disk = max(command.max_on_disk, len(os.listdir(self.storage.name)))
+
+        def import_revision(guid, timestamp, data_url, revision, full_path, ext, overwrite=False):
+            count_dumps()
+
+            if revision == fail_on:
+                raise ImportCrashed()
+
+            # Let the downloader run ahead
+            time.sleep(0.3)
+            count_dumps()
+            command.imported.append(revision)
+
+        command.import_revision = import_revision
+        return command
+
+    def test_revisions_are_imported_in_order(self):
+        command = self.make_command()
+        command.backfill(LoadCompaniesResumeTests.GUID, self.jobs, 3, cleanup=True)
+
+        self.assertEqual(command.imported, [revision for _, _, revision in self.jobs])
+        self.assertEqual(os.listdir(self.storage.name), [])
+
+    def test_number_of_dumps_on_disk_is_bounded(self):
+        for prefetch in [1, 2, 3]:
+            command = self.make_command()
+            command.backfill(LoadCompaniesResumeTests.GUID, self.jobs, prefetch, cleanup=True)
+
+            # Partially downloaded dumps are counted too
+            self.assertLessEqual(command.max_on_disk, prefetch)
+
+        # Following dumps are really downloaded while importing the current one
+        self.assertGreater(command.max_on_disk, 1)
+
+    def test_downloads_are_stopped_on_error(self):
+        command = self.make_command(fail_on="rev2")
+
+        started = time.monotonic()
+        with self.assertRaises(ImportCrashed):
+            command.backfill(LoadCompaniesResumeTests.GUID, self.jobs, 3, cleanup=True)
+
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(command.imported, ["rev0", "rev1"])
+        self.assertLessEqual(len(self.downloads), 5)
+
+        # Only the dump which failed to import is kept, prefetched and
+        # partially downloaded ones are removed
+        self.assertEqual(os.listdir(self.storage.name), ["03.01.2020 00:00__rev2.zip"])
+
+
+class KeysTests(SimpleTestCase):
+    """
+    Keys are stored in db, so they must stay exactly the same as ones built
+    by the regex based implementation which was used before (hashes below
+    were produced by it)
+    """
+
+    COMPANIES = [
+        (
+            {
+                "name": "ТОВАРИСТВО З ОБМЕЖЕНОЮ ВІДПОВІДАЛЬНІСТЮ \"РОМАШКА\"",
+                "short_name": "ТОВ \"РОМАШКА\"",
+                "location": "01001, м.Київ, Шевченківський район, вулиця Хрещатик, будинок 1",
+                "edrpou": 12345678,
+                "company_profile": "62.01 Комп'ютерне програмування",
+                "status": "зареєстровано",
+            },
+            "e0bbf1bf50e228d00c070e7571bf40dc5936c81f",
+        ),
+        (
+            {
+                "name": "Приватне підприємство «Ґедзь-Їжак»",
+                "short_name": "",
+                "location": "м. Львів, вул. Городоцька, 5/7 (офіс №3)",
+                "edrpou": 87654321,
+            },
+            "4e4c5f2b2d39795a70df2daf0a7e3f412007be1b",
+        ),
+        (
+            {
+                "name": "  ТОВ\t\"А.Б.В.\"  ",
+                "short_name": None,
+                "location": "",
+                "edrpou": 1,
+                "company_profile": None,
+                "status": "припинено",
+            },
+            "4579867259d43a83eac8d690a142a1f242250b32",
+        ),
+        (
+            {
+                "name": "Company #1 {test}=[x]_~`!$%^&*;:",
+                "short_name": "C-1",
+                "location": "Kyiv\u3000Ukraine \x1c\x1f",
+                "edrpou": 42,
+                "company_profile": "",
+                "status": "",
+            },
+            "dce495a2b65dd3b7f6c975aab1bdbe33e2c46d59",
+        ),
+        (
+            {
+                "name": "ФЕРМЕРСЬКЕ ГОСПОДАРСТВО 'ЗОРЯ' — І. І. ПЕТРЕНКО",
+                "short_name": "ФГ 'ЗОРЯ'",
+                "location": "Україна, Вінницька обл.",
+                "edrpou": "00032106",
+                "status": "в стані припинення",
+            },
+            "9b58cc2668cf160b7308a8ce14e6fa6d6e59d4e6",
+        ),
+    ]
+
+    PERSONS = [
+        ((12345678, "Іваненко Іван Іванович", "head"), "39bb793e40355af42807f103515bb6e0579c2178"),
+        (
+            (
+                12345678,
+                "ІВАНЕНКО ІВАН ІВАНОВИЧ, Україна, 01001, м.Київ, вул. Хрещатик, буд. 1, кв. 2, "
+                "розмір внеску до статутного фонду - 1000.00 грн.",
+                "owner",
+            ),
+            "144a187d9139aad09a3011a200131a54efc3f179",
+        ),
+        (
+            (
+                87654321,
+                "Кінцевий бенефіціарний власник (контролер) - Петренко Петро Петрович, Україна",
+                "owner",
+            ),
+            "7b88af90176aa5c8865d271ab634c588be1803c5",
+        ),
+        ((1, "  John\tSmith (UK) #7  ", "founder"), "ae36100e6ad622be0d8e608ca6b9deb8c6d336d1"),
+        ((42, "", "head"), "4591c2ac0bb12878881c66294d03c3b352d6ffe3"),
+    ]
+
+    def test_company_keys(self):
+        for company, key in self.COMPANIES:
+            self.assertEqual(make_company_key(company), key, company["name"])
+
+        self.assertEqual(
+            make_company_keys([company for company, _ in self.COMPANIES]),
+            [key for _, key in self.COMPANIES],
+        )
+
+    def test_person_keys(self):
+        for person, key in self.PERSONS:
+            self.assertEqual(make_person_key(*person), key, person[1])
+
+        self.assertEqual(
+            make_person_keys([person for person, _ in self.PERSONS]),
+            [key for _, key in self.PERSONS],
+        )
+
+
+class SnapshotsOfFlagsTests(TestCase):
+    """
+    Flags calculated in bulk must be the same as ones calculated company by
+    company
+    """
+
+    NUM_COMPANIES = 40
+    NAMES = [
+        "Іваненко Іван Іванович",
+        "Іваненко Іван Іваноич",
+        "Петренко Петро Петрович",
+        "Петро Петрович Петренко",
+        "Шевченко Тарас Григорович",
+        "Коваленко Олена Миколаївна",
+    ]
+    ADDRESSES = [
+        "Україна, 01001, м.Київ, вул. Хрещатик, буд. 1",
+        "Україна, Автономна Республіка Крим, м. Сімферополь, вул. Леніна, 5",
+        "Україна, Луганська обл., м. Луганськ, вул. Шевченка, 2",
+        "Російська Федерація, м. Москва, вул. Тверська, 7",
+    ]
+    COUNTRIES = [["україна"], ["україна"], ["росія"], ["кіпр"], []]
+
+    def setUp(self):
+        rnd = random.Random(1337)
+
+        self.revisions = [
+            Revision.objects.create(
+                revision_id=revision_id,
+                dataset_id=LoadCompaniesResumeTests.GUID,
+                created=timezone.make_aware(datetime(2020, revision_id, 1)),
+                imported=True,
+                url="https://data.gov.ua/dump{}.zip".format(revision_id),
+            )
+            for revision_id in range(1, 4)
+        ]
+        all_revisions = [revision.pk for revision in self.revisions]
+
+        for edrpou in range(1, self.NUM_COMPANIES + 1):
+            company = Company.objects.create(edrpou=edrpou)
+
+            for i in range(rnd.randint(1, 3)):
+                CompanyRecord.objects.create(
+                    company=company,
+                    company_hash="{}-{}".format(edrpou, i),
+                    name="ТОВ Компанія {} {}".format(edrpou, i),
+                    shortened_validated_location=rnd.choice(["Київ, Хрещатик, 1", "Львів, Городоцька, 5"]),
+                    status=rnd.choice([1, 1, 2]),
+                    charter_capital=rnd.choice([None, 1000, 50000]),
+                    revisions=sorted(rnd.sample(all_revisions, rnd.randint(1, 3))),
+                )
+
+            for i in range(rnd.randint(0, 8)):
+                person_type = rnd.choice(["head", "founder", "owner", "owner"])
+                Person.objects.create(
+                    company=company,
+                    person_hash="{}-{}".format(edrpou, i),
+                    person_type=person_type,
+                    name=rnd.sample(self.NAMES, rnd.choice([0, 1, 1, 2])),
+                    address=rnd.sample(self.ADDRESSES, rnd.randint(0, 2)),
+                    country=rnd.choice(self.COUNTRIES),
+                    raw_record=rnd.choice(self.NAMES + self.ADDRESSES),
+                    was_dereferenced=person_type == "owner" and rnd.random() < 0.2,
+                    bo_is_absent=person_type == "owner" and rnd.random() < 0.2,
+                    revisions=sorted(rnd.sample(all_revisions, rnd.randint(1, 3))),
+                )
+
+            for _ in range(rnd.choice([0, 0, 1, 2])):
+                PEPOwner.objects.create(
+                    company=company,
+                    person=rnd.choice(self.NAMES),
+                    person_url="https://pep.org.ua/uk/person/{}".format(edrpou),
+                    from_declaration=rnd.random() < 0.7,
+                    person_type=rnd.choice(["owner", "founder"]),
+                    years=rnd.choice([[2017], [2017, 2018], [2018]]),
+                )
+
+            for _ in range(rnd.choice([0, 0, 0, 1])):
+                SelfOwned.objects.create(company=company, level=rnd.randint(1, 3))
+
+            if rnd.random() < 0.2:
+                OwnedByCompany.objects.create(company=company, owner=str(edrpou + 1))
+
+    def snapshot_rows(self, revision):
+        rows = {}
+        for snapshot in CompanySnapshotFlags.objects.filter(revision=revision).nocache():
+            row = {}
+            for field in CompanySnapshotFlags._meta.concrete_fields:
+                if field.name == "id":
+                    continue
+
+                value = getattr(snapshot, field.attname)
+                # Lists which are built out of sets have no stable order
+                if isinstance(value, list):
+                    value = sorted(value, key=repr)
+                row[field.attname] = value
+
+            rows[snapshot.company_id] = row
+
+        return rows
+
+    def test_bulk_flags_are_the_same_as_per_company(self):
+        company_ids = list(Company.objects.order_by("pk").values_list("pk", flat=True))
+
+        for revision in self.revisions:
+            mass_registration = ["Київ, Хрещатик, 1"]
+
+            for company in Company.objects.filter(pk__in=company_ids).nocache():
+                company.take_snapshot_of_flags(revision, False, mass_registration)
+            per_company = self.snapshot_rows(revision)
+
+            CompanySnapshotFlags.objects.filter(revision=revision).delete()
+
+            for i in range(0, len(company_ids), 7):
+                Company.take_snapshots_of_flags(
+                    company_ids[i:i + 7], revision, False, mass_registration
+                )
+            bulk = self.snapshot_rows(revision)
+
+            self.assertEqual(len(bulk), len(company_ids))
+            for company_id in company_ids:
+                self.assertEqual(
+                    bulk[company_id],
+                    per_company[company_id],
+                    "company {}, revision {}".format(company_id, revision.pk),
+                )
+
+    def test_forced_recalculation_is_the_same(self):
+        revision = self.revisions[-1]
+
+        for company in Company.objects.nocache():
+            company.take_snapshot_of_flags(revision, False, [])
+        expected = self.snapshot_rows(revision)
+
+        Company.take_snapshots_of_flags(
+            list(Company.objects.values_list("pk", flat=True)), revision, True, []
+        )
+
+        self.assertEqual(self.snapshot_rows(revision), expected)
+
+    def test_only_recalculated_companies_are_returned(self):
+        revision = self.revisions[-1]
+        company_ids = list(Company.objects.order_by("pk").values_list("pk", flat=True))
+        kept = company_ids[::3]
+
+        for company in Company.objects.filter(pk__in=kept).nocache():
+            self.assertTrue(company.take_snapshot_of_flags(revision, False, []))
+            self.assertFalse(company.take_snapshot_of_flags(revision, False, []))
+
+        self.assertEqual(
+            sorted(Company.take_snapshots_of_flags(company_ids, revision, False, [])),
+            sorted(set(company_ids) - set(kept)),
+        )
+        self.assertEqual(
+            sorted(Company.take_snapshots_of_flags(company_ids, revision, True, [])),
+            company_ids,
+        )
+
+
+class TimelineFingerprintTests(SimpleTestCase):
+    def test_prefixes_of_timeline(self):
+        timeline = [3, 5, 8, 13]
+        prefixes = CompanyHistory.prefix_fingerprints(timeline)
+
+        self.assertEqual(len(prefixes), len(timeline) + 1)
+        for i in range(len(timeline) + 1):
+            self.assertEqual(CompanyHistory.fingerprint(timeline[:i]), prefixes[i])
+
+        # Histories of the extended timeline are still valid
+        self.assertTrue(set(prefixes) <= set(CompanyHistory.prefix_fingerprints(timeline + [21])))
+
+    def test_changes_in_the_middle_of_timeline(self):
+        timeline = [3, 5, 8, 13]
+        valid = set(CompanyHistory.prefix_fingerprints(timeline))
+
+        for changed in ([3, 8, 13], [3, 5, 6, 8, 13], [5, 3, 8, 13]):
+            self.assertNotIn(CompanyHistory.fingerprint(changed), valid)
+
+        # Histories packed before the fingerprints were introduced
+        self.assertNotIn("", valid)
@@ -0,0 +1,183 @@
+import sys
+from array import array
+
+
+class CompactHashSet(object):
+    """
+    Memory efficient set of sha1 hex digests (like company_hash or
+    person_hash). Digests are kept as sorted blobs of 20-byte binary values
+    bucketed by the first two bytes, so lookup is a short binary search
+    inside of the bucket. It takes ~20 bytes per hash instead of ~150 bytes
+    for a str in python set.
+    Hashes added after the initial load (there might be millions of them,
+    e.g. all the records stamped with the revision) are collected as binary
+    digests and packed into the new sorted level every MERGE_EVERY hashes.
+    Levels of similar size are merged, so there are only a few of them
+    """
+
+    DIGEST_SIZE = 20
+    BUCKETS = 1 << 16
+    MERGE_EVERY = 1 << 16
+
+    def __init__(self, hex_digests=()):
+        """
+        :param hex_digests: iterable of hex digests to preload
+        :type hex_digests: collections.Iterable[str]
+        """
+        # Hashes that cannot be packed into binary form, just in case
+        self.unpackable = set()
+        # Binary digests added since the last merge
+        self.pending = set()
+        # Sorted blobs of digests and offsets (in digests) of their buckets,
+        # from the largest to the smallest one
+        self.levels = []
+
+        def digests():
+            for hex_digest in hex_digests:
+                digest = self._to_digest(hex_digest)
+
+                if digest is None:
+                    self.unpackable.add(hex_digest)
+                else:
+                    yield digest
+
+        self._push_level(self._pack(digests()))
+
+    @classmethod
+    def _to_digest(cls, hex_digest):
+        try:
+            digest = bytes.fromhex(hex_digest)
+        except ValueError:
+            return None
+
+        if len(digest) != cls.DIGEST_SIZE:
+            return None
+
+        return digest
+
+    @classmethod
+    def _pack(cls, digests):
+        """
+        Builds sorted level out of iterable of binary digests
+        (duplicates are removed)
+        """
+        buckets = [bytearray() for _ in range(cls.BUCKETS)]
+
+        for digest in digests:
+            buckets[digest[0] << 8 | digest[1]] += digest
+
+        data = bytearray()
+        offsets = array("Q", [0])
+
+        size = cls.DIGEST_SIZE
+        for i in range(cls.BUCKETS):
+            bucket = bytes(buckets[i])
+            sorted_digests = sorted(
+                set(bucket[j:j + size] for j in range(0, len(bucket), size))
+            )
+            buckets[i] = None
+
+            data += b"".join(sorted_digests)
+            offsets.append(offsets[-1] + len(sorted_digests))
+
+        return data, offsets
+
+    @classmethod
+    def _iter_level(cls, level):
+        data, _ = level
+        size = cls.DIGEST_SIZE
+
+        for i in range(0, len(data), size):
+            yield bytes(data[i:i + size])
+
+    def _push_level(self, level):
+        self.levels.append(level)
+
+        # Level is merged with the previous one unless it's twice as small,
+        # so every digest is merged only a logarithmic number of times
+        while len(self.levels) > 1 and (
+            self.levels[-2][1][-1] <= 2 * self.levels[-1][1][-1]
+        ):
+            smaller = self.levels.pop()
+            larger = self.levels.pop()
+
+            self.levels.append(
+                self._pack(
+                    digest
+                    for level in (larger, smaller)
+                    for digest in self._iter_level(level)
+                )
+            )
+
+    def _level_contains(self, level, digest):
+        size = self.DIGEST_SIZE
+        data, offsets = level
+        bucket = digest[0] << 8 | digest[1]
+        lo, hi = offsets[bucket], offsets[bucket + 1]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = data[mid * size:(mid + 1) * size]
+
+            if current == digest:
+                return True
+
+            if current < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return False
+
+    def _packed_contains(self, digest):
+        if digest in self.pending:
+            return True
+
+        return any(self._level_contains(level, digest) for level in self.levels)
+
+    def __contains__(self, hex_digest):
+        digest = self._to_digest(hex_digest)
+
+        if digest is None:
+            return hex_digest in self.unpackable
+
+        return self._packed_contains(digest)
+
+    def add(self, hex_digest):
+        digest = self._to_digest(hex_digest)
+
+        if digest is None:
+            self.unpackable.add(hex_digest)
+            return
+
+        if self._packed_contains(digest):
+            return
+
+        self.pending.add(digest)
+
+        if len(self.pending) >= self.MERGE_EVERY:
+            pending, self.pending = self.pending, set()
+            self._push_level(self._pack(pending))
+
+    def __len__(self):
+        return (
+            sum(offsets[-1] for _, offsets in self.levels)
+            + len(self.pending)
+            + len(self.unpackable)
+        )
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory used by the set, in bytes
+        """
+        return (
+            sum(
+                len(data) + offsets.itemsize * len(offsets)
+                for data, offsets in self.levels
+            )
+            + sys.getsizeof(self.pending)
+            + sum(map(sys.getsizeof, self.pending))
+            + sys.getsizeof(self.unpackable)
+            + sum(map(sys.getsizeof, self.unpackable))
+        )
@@ -0,0 +1,115 @@
+from collections import defaultdict
+
+
+def member_runs(index, revisions):
+    """
+    Splits revisions of one record into runs of consecutive revisions of
+    the timeline
+
+    :param index: position of every revision id in the timeline
+    :type index: dict
+    :param revisions: ids of revisions the record is present in (ones that
+        are missing from the timeline are ignored)
+    :type revisions: list
+    :returns: first and last position of every run
+    :rtype: list
+    """
+    positions = set(map(index.get, revisions))
+    positions.discard(None)
+    positions = sorted(positions)
+
+    runs = []
+
+    def split(lo, hi):
+        # Positions are unique, so the slice is a run when it has no gaps,
+        # i.e. exactly as long as the distance between it's ends
+        if positions[hi] - positions[lo] == hi - lo:
+            if runs and runs[-1][1] == positions[lo] - 1:
+                runs[-1][1] = positions[hi]
+            else:
+                runs.append([positions[lo], positions[hi]])
+        else:
+            mid = (lo + hi) // 2
+            split(lo, mid)
+            split(mid + 1, hi)
+
+    if positions:
+        split(0, len(positions) - 1)
+
+    return runs
+
+
+def group_by_intervals(revisions, records, members_revisions):
+    """
+    Groups the history of the company into periods during which the set of
+    its records (or persons) didn't change. Returns exactly the same groups
+    as Company.group_revisions, but instead of hashing the records of every
+    revision it merges intervals of revisions of every record: the set of
+    records only changes where some of them appears or disappears.
+
+    :param revisions: timeline of revisions, revision by id, oldest first
+    :type revisions: OrderedDict
+    :param records: records (collections of them) by revision id, the
+        record of the first revision of the group is put into the group
+    :type records: dict
+    :param members_revisions: revisions of every distinct member of the
+        records (i.e rec.revisions for each company record/person). Members
+        must be different by the hash field used to compare records
+    :type members_revisions: collections.Iterable[list]
+    :returns: list of dicts with start_revision, finish_revision and record
+    :rtype: list
+    """
+    timeline = list(revisions.values())
+    ids = list(revisions.keys())
+    index = {r: pos for pos, r in enumerate(ids)}
+
+    # Number of members which appear (positive) or disappear (negative)
+    # at the position
+    events = defaultdict(int)
+    for member in members_revisions:
+        for first, last in member_runs(index, member):
+            events[first] += 1
+            events[last + 1] -= 1
+
+    # Set of members is constant between two consecutive events, so
+    # every segment with members is a period of unchanged records
+    segments = []
+    present = 0
+    boundaries = sorted(events)
+    for pos, next_pos in zip(boundaries, boundaries[1:]):
+        present += events[pos]
+        if present:
+            segments.append((pos, next_pos - 1))
+
+    periods = []
+
+    def add_group(start, finish, record):
+        periods.append(
+            {"start_revision": start, "finish_revision": finish, "record": record}
+        )
+
+    current_record = None
+    start_revision = finish_revision = None
+    previous_last = None
+    for first, last in segments:
+        if previous_last is not None:
+            add_group(start_revision, finish_revision, current_record)
+
+            if first > previous_last + 1:
+                # group_revisions keeps the record that disappeared and adds
+                # it once again, for the last revision before it's replaced
+                add_group(timeline[first - 1], timeline[first - 1], current_record)
+
+        current_record = records[ids[first]]
+        start_revision = timeline[first]
+        finish_revision = timeline[last]
+        previous_last = last
+
+    if previous_last is not None:
+        add_group(start_revision, finish_revision, current_record)
+
+        # The same happens when the record disappeared in the end
+        if previous_last < len(timeline) - 1:
+            add_group(timeline[-1], timeline[-1], current_record)
+
+    return periods
@@ -0,0 +1,86 @@
+from hashlib import sha1
+
+
+# Punctuation that is dropped from the normalized line before hashing (along
+# with all the unicode whitespace). Keys are stored in db, so that set must
+# never change. It's all ascii, so it can be safely removed from utf8 bytes,
+# as ascii bytes never appear inside of multibyte sequences
+KEY_JUNK_CHARS = b".,/#!$%^&*;:{}=-_`~()"
+
+
+def _normalize(values):
+    # That's what re.sub("[.,\/#!$%\^&\*;:{}=\-_`~()\s]", "", ...) did, but
+    # twice as fast: str.split() removes exactly the same whitespace as \s
+    # and bytes.translate removes the punctuation
+    return (
+        "".join("|".join(map(str, values)).lower().split())
+        .encode("utf8")
+        .translate(None, KEY_JUNK_CHARS)
+    )
+
+
+def make_key(values):
+    """
+    sha1 key for the list of values: values are joined with |, lowercased
+    and cleaned from spaces and punctuation
+
+    :param values: values to build the key from (None becomes "none")
+    :type values: list
+    :returns: hex digest
+    :rtype: str
+    """
+    return sha1(_normalize(values)).hexdigest()
+
+
+def make_keys(rows):
+    """
+    Same as make_key for many rows at once
+
+    :param rows: lists of values
+    :type rows: collections.Iterable[list]
+    :returns: list of hex digests
+    :rtype: list
+    """
+    return [sha1(_normalize(values)).hexdigest() for values in rows]
+
+
+def company_key_values(company):
+    return [
+        company["name"],
+        company["short_name"],
+        company["location"],
+        company["edrpou"],
+        company.get("company_profile"),
+        company.get("status"),
+    ]
+
+
+def make_company_key(company):
+    """
+    sha1 key for company record built out of company name/shortname,
+    location, edrpou and other fields
+    """
+    return make_key(company_key_values(company))
+
+
+def make_company_keys(companies):
+    return make_keys(map(company_key_values, companies))
+
+
+def make_person_key(edrpou, raw_description, position):
+    """
+    sha1 key for person record built out of company edrpou and some raw
+    text and position
+    """
+    return make_key([raw_description, edrpou, position])
+
+
+def make_person_keys(persons):
+    """
+    :param persons: triples of edrpou, raw description and position
+    :type persons: collections.Iterable[tuple]
+    """
+    return make_keys(
+        [raw_description, edrpou, position]
+        for edrpou, raw_description, position in persons
+    )
@@ -0,0 +1,125 @@
+import os
+import json
+import struct
+from hashlib import sha1
+
+
+class RevisionManifest(object):
+    """
+    Compact on-disk summary of the imported revision: for every company line
+    of the dump (identified by the digest of the line) it keeps hashes of the
+    company record and persons that were built out of it.
+    Consecutive revisions are almost identical, so lines that are found in
+    the manifest of the previous revision don't need to be parsed again.
+
+    Digests are kept in binary form: 20 bytes for the line and 20 bytes
+    for every hash
+    """
+
+    MAGIC = b"EDRMANIFEST1"
+    DIGEST_SIZE = 20
+    ENTRY_HEADER = struct.Struct("<20sH")
+
+    def __init__(self, parser_profile=""):
+        """
+        :param parser_profile: profile of the founders parser, used to build
+            the revision. Hashes of persons depend on it, so manifests built
+            with other profiles aren't reused
+        :type parser_profile: str
+        """
+        self.parser_profile = parser_profile
+        self.entries = {}
+
+    @staticmethod
+    def line_digest(company_line):
+        """
+        Binary digest of everything in the company line which affects the
+        hashes (i.e everything except of the revision metadata)
+        """
+        return sha1(
+            json.dumps(
+                {
+                    k: v
+                    for k, v in company_line.items()
+                    if k not in ("last_update", "file_revision")
+                },
+                sort_keys=True,
+                ensure_ascii=False,
+                default=str,
+            ).encode("utf8")
+        ).digest()
+
+    def add(self, line_digest, company_hash, person_hashes):
+        self.entries[line_digest] = b"".join(
+            bytes.fromhex(h) for h in [company_hash] + list(person_hashes)
+        )
+
+    def get(self, line_digest):
+        """
+        :returns: company hash and list of person hashes or None if the line
+            is unknown
+        :rtype: tuple
+        """
+        packed = self.entries.get(line_digest)
+        if packed is None:
+            return None
+
+        size = self.DIGEST_SIZE
+        hashes = [packed[i:i + size].hex() for i in range(0, len(packed), size)]
+
+        return hashes[0], hashes[1:]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def save(self, path):
+        # Written under temporary name, so incomplete manifest is never used
+        with open(path + ".part", "wb") as fp:
+            fp.write(self.MAGIC)
+            profile = self.parser_profile.encode("utf8")
+            fp.write(struct.pack("<H", len(profile)))
+            fp.write(profile)
+
+            for line_digest, packed in self.entries.items():
+                fp.write(
+                    self.ENTRY_HEADER.pack(line_digest, len(packed) // self.DIGEST_SIZE)
+                )
+                fp.write(packed)
+
+        os.rename(path + ".part", path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :returns: manifest or None if the file is missing or damaged
+        :rtype: RevisionManifest
+        """
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "rb") as fp:
+            data = fp.read()
+
+        if not data.startswith(cls.MAGIC):
+            return None
+
+        pos = len(cls.MAGIC)
+        (profile_size,) = struct.unpack_from("<H", data, pos)
+        pos += 2
+        manifest = cls(data[pos:pos + profile_size].decode("utf8"))
+        pos += profile_size
+
+        header_size = cls.ENTRY_HEADER.size
+        while pos < len(data):
+            if pos + header_size > len(data):
+                return None
+
+            line_digest, count = cls.ENTRY_HEADER.unpack_from(data, pos)
+            pos += header_size
+            manifest.entries[line_digest] = data[pos:pos + count * cls.DIGEST_SIZE]
+            pos += count * cls.DIGEST_SIZE
+
+        if pos != len(data):
+            return None
+
+        return manifest
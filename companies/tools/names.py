@@ -1,15 +1,236 @@
+import os
 import re
 import sys
 import json
+import pickle
 import argparse
 from tqdm import tqdm
-from functools import reduce
-from itertools import permutations, product, islice, zip_longest
-from operator import mul
+from collections import OrderedDict
+from functools import wraps
+from itertools import permutations, product, zip_longest
 from Levenshtein import jaro
 
 DEBUG = False
 
+# Names with that many tokens or less are compared over all the permutations
+# (it's no more than 24 of them), longer ones by the assignment of tokens
+EXACT_PERMUTATIONS_LIMIT = 4
+# Optimal assignment of tokens is found by DP over subsets of tokens, which
+# is exponential, so longer names are assigned greedily
+OPTIMAL_ASSIGNMENT_LIMIT = 12
+
+# Default number of entries in every cache of names, see memoize
+NAME_CACHE_SIZE = 200000
+# Bump it when results of the memoized functions change, so caches persisted
+# by the previous version are ignored
+NAME_CACHE_VERSION = 2
+
+
+class NameCache(object):
+    """
+    Bounded LRU cache of results of names normalization/comparison.
+    The same persons are founders, heads and beneficiaries of many
+    companies, so the same names (and pairs of names) are processed again
+    and again
+    """
+
+    def __init__(self, maxsize=NAME_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, items):
+        for key, value in items:
+            self.data[key] = value
+            self.data.move_to_end(key)
+
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+
+# Caches of all the memoized functions, by name
+name_caches = {}
+
+
+def memoize(name, maxsize=NAME_CACHE_SIZE):
+    """
+    Decorator which keeps results of the function in the NameCache
+    registered under the given name. Arguments of the function must be
+    hashable and picklable
+    """
+    cache = name_caches.setdefault(name, NameCache(maxsize))
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            data = cache.data
+            try:
+                result = data[args]
+            except KeyError:
+                cache.misses += 1
+                result = data[args] = func(*args)
+                if len(data) > cache.maxsize:
+                    data.popitem(last=False)
+            else:
+                cache.hits += 1
+                data.move_to_end(args)
+
+            return result
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+def name_cache_stats():
+    """
+    :returns: lines with the size and hit rate of every cache
+    :rtype: list
+    """
+    return [
+        "{}: {} entries, {} hits, {} misses, hit rate {:.1%}".format(
+            name, len(cache), cache.hits, cache.misses, cache.hit_rate
+        )
+        for name, cache in sorted(name_caches.items())
+    ]
+
+
+def save_name_caches(path):
+    # Written under temporary name, so incomplete file is never used
+    with open(path + ".part", "wb") as fp:
+        pickle.dump(
+            {
+                "version": NAME_CACHE_VERSION,
+                "caches": {
+                    name: list(cache.data.items()) for name, cache in name_caches.items()
+                },
+            },
+            fp,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+
+    os.rename(path + ".part", path)
+
+
+def load_name_caches(path):
+    """
+    Fills caches with the entries saved by save_name_caches. Missing files
+    and files of other versions are ignored
+
+    :returns: number of loaded entries
+    :rtype: int
+    """
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, "rb") as fp:
+        try:
+            saved = pickle.load(fp)
+        except (pickle.UnpicklingError, EOFError):
+            return 0
+
+    if saved.get("version") != NAME_CACHE_VERSION:
+        return 0
+
+    loaded = 0
+    for name, items in saved["caches"].items():
+        # Caches of functions which weren't imported by the process are
+        # not needed
+        if name in name_caches:
+            name_caches[name].update(items)
+            loaded += len(items)
+
+    return loaded
+
+
+def _assign_tokens(tokens_a, tokens_b):
+    """
+    Orders tokens_b to maximize sum of jaro similarities between tokens
+    on the same positions in tokens_a and reordered tokens_b. Tokens that
+    have no pair in tokens_a are going last in the original order
+
+    :returns: reordered tokens_b
+    :rtype: list
+    """
+    n = len(tokens_b)
+    slots = min(len(tokens_a), n)
+    scores = [[jaro(a, b) for b in tokens_b] for a in tokens_a[:slots]]
+
+    if n > OPTIMAL_ASSIGNMENT_LIMIT:
+        order = []
+        used = set()
+        for row in scores:
+            best = max((j for j in range(n) if j not in used), key=row.__getitem__)
+            order.append(best)
+            used.add(best)
+    else:
+        # best[mask] is the best sum when tokens from the mask occupy
+        # first popcount(mask) positions, choice[mask] is the last of them
+        best = {0: 0.0}
+        choice = {}
+        for mask in range(1 << n):
+            if mask not in best:
+                continue
+
+            pos = bin(mask).count("1")
+            if pos == slots:
+                continue
+
+            for j in range(n):
+                if not mask & (1 << j):
+                    new_mask = mask | (1 << j)
+                    score = best[mask] + scores[pos][j]
+                    if new_mask not in best or score > best[new_mask]:
+                        best[new_mask] = score
+                        choice[new_mask] = j
+
+        mask = max(
+            (m for m in best if bin(m).count("1") == slots), key=best.__getitem__
+        )
+        order = []
+        while mask:
+            j = choice[mask]
+            order.append(j)
+            mask ^= 1 << j
+        order.reverse()
+
+    used = set(order)
+    return [tokens_b[j] for j in order] + [
+        t for j, t in enumerate(tokens_b) if j not in used
+    ]
+
+
+def token_order_jaro(name1, name2):
+    """
+    Jaro similarity between name1 and tokens of name2 joined in the best
+    order (i.e insensitive to the order of tokens). Short names are checked
+    over all the permutations of tokens, for longer ones tokens are matched
+    pairwise and only the best assignment of them (and the original
+    order) is checked, so there is no need to enumerate permutations
+
+    :returns: similarity from 0 to 1
+    :rtype: float
+    """
+    tokens = name2.split(" ")
+
+    if len(tokens) <= EXACT_PERMUTATIONS_LIMIT:
+        return max(jaro(name1, " ".join(opt)) for opt in permutations(tokens))
+
+    return max(
+        jaro(name1, name2),
+        jaro(name1, " ".join(_assign_tokens(name1.split(" "), tokens))),
+    )
+
 
 def _compare_two_names(
     name1, name2, max_splits=7, straight_limit=0.93, smart_limit=0.95
@@ -34,22 +255,22 @@ def _compare_two_names(
             if len(splits) > 1 and DEBUG:
                 tqdm.write("Check if it's match: {}\t{}".format(name1, name2))
 
-    limit = reduce(mul, range(1, max_splits + 1))
-
-    if len(splits) > max_splits and DEBUG:
-        tqdm.write("Too much permutations for {}".format(name2))
+    return token_order_jaro(name1, name2) > smart_limit
 
-    max_similarity = max(
-        jaro(name1, " ".join(opt)) for opt in islice(permutations(splits), limit)
-    )
 
-    return max_similarity > smart_limit
+@memoize("full_compare.normalize_name")
+def _full_compare_normalize_name(s):
+    return re.sub(r"\s+", " ", s.strip().replace("-", " "))
 
 
 def full_compare(name1, name2):
-    def normalize_name(s):
-        return re.sub(r"\s+", " ", s.strip().replace("-", " "))
+    return _full_compare_normalized(
+        _full_compare_normalize_name(name1), _full_compare_normalize_name(name2)
+    )
+
 
+@memoize("full_compare")
+def _full_compare_normalized(name1, name2):
     def slugify_name(s):
         s = (
             s.replace(" ", "")
@@ -69,8 +290,6 @@ def full_compare(name1, name2):
 
         return re.sub(r"\d+", "", s)
 
-    name1 = normalize_name(name1)
-    name2 = normalize_name(name2)
     slugified_name1 = slugify_name(name1)
     slugified_name2 = slugify_name(name2)
 
@@ -110,7 +329,12 @@ if __name__ == "__main__":
         pt = VeryPrettyTable([" ", "Positive", "Negative"])
 
         with open(sys.argv[1], "r") as fp:
-            r = csv.DictReader(fp)
+            # names_test.csv comes without the header
+            has_header = fp.readline().startswith("name1")
+            fp.seek(0)
+            r = csv.DictReader(
+                fp, fieldnames=None if has_header else ["name1", "name2", "ground truth"]
+            )
 
             res = {True: {True: 0, False: 0}, False: {True: 0, False: 0}}
 
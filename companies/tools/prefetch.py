@@ -0,0 +1,95 @@
+import io
+from queue import Queue, Full
+from threading import Thread, Event
+
+
+class PrefetchingReader(io.RawIOBase):
+    """
+    Read-only stream which reads (and thus decompresses, when the source is
+    a member of zip archive) the source file object in the background thread.
+    Chunks are kept in the bounded queue, so no more than
+    chunk_size * max_chunks bytes are buffered at any time.
+    zlib releases GIL while inflating, so decompression and parsing of the
+    data in the main thread are really overlapping.
+
+    Source file object should be closed only after the reader is closed
+    """
+
+    def __init__(self, fp, chunk_size=1 << 20, max_chunks=8):
+        """
+        :param fp: source file object, opened in binary mode
+        :param chunk_size: size of one read from the source, in bytes
+        :type chunk_size: int
+        :param max_chunks: how many chunks might be read ahead
+        :type max_chunks: int
+        """
+        super().__init__()
+
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.chunks = Queue(maxsize=max_chunks)
+        self.stopped = Event()
+        self.current = memoryview(b"")
+        self.eof = False
+
+        self.thread = Thread(target=self._prefetch, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=1)
+                return True
+            except Full:
+                pass
+
+        return False
+
+    def _prefetch(self):
+        # Empty chunk marks the end of the stream, exception is passed to
+        # the reader as is
+        try:
+            while True:
+                chunk = self.fp.read(self.chunk_size)
+                if not self._put(chunk) or not chunk:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.current and not self.eof:
+            chunk = self.chunks.get()
+
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            if chunk:
+                self.current = memoryview(chunk)
+            else:
+                self.eof = True
+
+        size = min(len(b), len(self.current))
+        b[:size] = self.current[:size]
+        self.current = self.current[size:]
+
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+
+        super().close()
+
+
+def prefetching(fp, chunk_size=1 << 20, max_chunks=8):
+    """
+    Wraps file object into buffered stream which is read in the background
+    (see PrefetchingReader)
+    """
+    return io.BufferedReader(
+        PrefetchingReader(fp, chunk_size, max_chunks), buffer_size=chunk_size
+    )
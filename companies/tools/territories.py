@@ -0,0 +1,133 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+
+CRIMEA_MARKERS = [r"\bАРК\b", r"\bКрим\b"]
+
+DONETSK_MARKERS_LEVEL1 = [r"\bДонецк", r"\bДонецьк"]
+
+DONETSK_MARKERS_LEVEL2 = [
+    r"\b{}\b".format(s)
+    for s in [
+        "Авдіївка",
+        "Адвеевка",
+        "Горлівка",
+        "Горловка",
+        "Донецьк",
+        "Донецк",
+        "Єнакієве",
+        "Енакиево",
+        "Жданівка",
+        "Ждановка",
+        "Макіївка",
+        "Макеевка",
+        "Сніжне",
+        "Снежное",
+        "Харцизьк",
+        "Харцызск",
+        "Хрестівка",
+        "Чистякове",
+        "Чистяково",
+        "Шахтарськ",
+        "Шахтерск",
+        "Ясинувата",
+        "Ясиноватая",
+        "Дебальцеве",
+        "Дебальцево",
+    ]
+]
+
+LUHANSK_MARKERS_LEVEL1 = [r"\bЛуганськ", r"\bЛуганск"]
+
+LUHANSK_MARKERS_LEVEL2 = [
+    r"\b{}\b".format(s)
+    for s in [
+        "Алчевськ",
+        "Алчевск",
+        "Антрацит",
+        "Брянка",
+        "Голубівка",
+        "Голубевка",
+        "Довжанськ",
+        "Должанск",
+        "Кадіївка",
+        "Кадиевка",
+        "Луганськ",
+        "Луганск",
+        "Первомайськ",
+        "Первомайск",
+        "Ровеньки",
+        "Сорокине",
+        "Сорокино",
+        "Хрустальний",
+        "Хрустальный",
+        "Золоте",
+        "Золотое",
+    ]
+]
+
+COUNTRY_MARKERS = {
+    "британія": ["сполучене королівство", "британія", "англія"],
+    "кіпр": ["кіпр"],
+    "росія": ["росія", "російська", "россія"],
+}
+
+
+AddressFlags = namedtuple("AddressFlags", ["crimea", "donetsk", "luhansk"])
+
+
+def _compile_any(markers, flags=re.U | re.I):
+    # Alternation backtracks to the next variant when the previous one
+    # fails, so it matches exactly when any of the markers matches
+    return re.compile("|".join("(?:{})".format(m) for m in markers), flags=flags)
+
+
+class TerritoryClassifier(object):
+    """
+    Tells if the address is in Crimea or on the occupied territories of
+    Donetsk/Luhansk regions and which countries are mentioned in the record.
+    Every family of markers is compiled into one regex, so the address is
+    scanned once per family instead of once per marker.
+    Addresses repeat a lot, so results for them are memoised
+    """
+
+    def __init__(self, cache_size=100000):
+        self.crimea = _compile_any(CRIMEA_MARKERS)
+        self.donetsk = (
+            _compile_any(DONETSK_MARKERS_LEVEL1),
+            _compile_any(DONETSK_MARKERS_LEVEL2),
+        )
+        self.luhansk = (
+            _compile_any(LUHANSK_MARKERS_LEVEL1),
+            _compile_any(LUHANSK_MARKERS_LEVEL2),
+        )
+        self.countries = [
+            (country, _compile_any(map(re.escape, markers), flags=re.I))
+            for country, markers in COUNTRY_MARKERS.items()
+        ]
+
+        self.classify_address = lru_cache(maxsize=cache_size)(self._classify_address)
+
+    def _classify_address(self, address):
+        """
+        :returns: flags for the address
+        :rtype: AddressFlags
+        """
+        return AddressFlags(
+            crimea=self.crimea.search(address) is not None,
+            donetsk=all(r.search(address) is not None for r in self.donetsk),
+            luhansk=all(r.search(address) is not None for r in self.luhansk),
+        )
+
+    def find_countries(self, raw_record):
+        """
+        :returns: countries mentioned in the raw record
+        :rtype: set
+        """
+        return set(
+            country for country, r in self.countries if r.search(raw_record)
+        )
+
+
+territory_classifier = TerritoryClassifier()
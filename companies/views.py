@@ -9,7 +9,7 @@ from django.utils.html import strip_tags
 from elasticsearch_dsl.query import Q
 from elasticsearch_dsl import MultiSearch
 
-from companies.models import Company, Revision, Person
+from companies.models import Company, CompanyHistory, Revision, Person
 from companies.elastic_models import Company as ElasticCompany
 from companies.tools.paginator import paginated
 
@@ -21,12 +21,21 @@ class RevisionDetail(DetailView):
 
 class CompanyDetail(DetailView):
     context_object_name = "company"
-    queryset = Company.objects.prefetch_related("records", "persons")
+    queryset = Company.objects.select_related("history")
 
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context.update(kwargs["object"].get_grouped_record())
+        company = kwargs["object"]
+
+        # Packed history is used unless it's missing or outdated
+        grouped = None
+        try:
+            grouped = company.history.unpack()
+        except CompanyHistory.DoesNotExist:
+            pass
+
+        context.update(grouped or company.get_grouped_record())
 
         return context
 
@@ -35,18 +44,16 @@ class APIView(View):
     def get(self, request):
         edrpous = map(lambda x: x.lstrip("0"), request.GET.getlist("edrpou", []))
 
-        queryset = Company.objects.prefetch_related("records", "persons").filter(
-            pk__in=list(edrpous)
-        )
+        companies = list(Company.objects.filter(pk__in=list(edrpous)))
 
         return JsonResponse(
             {
                 c.pk: {
                     k: v
-                    for k, v in c.to_dict().items()
+                    for k, v in doc.items()
                     if k in ["raw_persons", "latest_record"]
                 }
-                for c in queryset.iterator()
+                for c, doc in zip(companies, Company.to_dicts(companies))
             },
             safe=False,
         )